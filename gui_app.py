@@ -1,9 +1,7 @@
 import sys
 import os
 import json
-import socket
 import threading
-import base64
 import io
 import subprocess
 import psutil
@@ -12,70 +10,74 @@ from PyQt5.QtWidgets import (QApplication, QMainWindow, QVBoxLayout, QHBoxLayout
                              QWidget, QPushButton, QLabel, QMessageBox, QFileDialog,
                              QProgressDialog)
 from PyQt5.QtGui import QPixmap, QImage
-from PyQt5.QtCore import Qt, QThread, pyqtSignal, QTimer
+from PyQt5.QtCore import Qt, QObject, pyqtSignal, QTimer
 
-class MapClient(QThread):
-    """地图客户端线程"""
-    map_received = pyqtSignal(str)
+from ranmap_client import MapConnection
+
+class MapClient(QObject):
+    """
+    地图客户端（使用二进制分帧协议）
+    
+    所有命令共用一条持久连接，可以同时有多个请求在途；连接断开后下一个命令自动重连。
+    响应在后台线程中到达，通过信号交给GUI线程处理。
+    """
+    # (数据, 种子)：图像为PNG数据（bytes），其他成功响应为消息文本（str），没有种子时为None
+    map_received = pyqtSignal(object, object)
+    # 完整地图之前先到达的低分辨率预览（PNG数据）和生成进度文本
+    preview_received = pyqtSignal(bytes)
+    progress_changed = pyqtSignal(str)
     error_occurred = pyqtSignal(str)
     
     def __init__(self, host='localhost', port=5000):
         super().__init__()
-        self.host = host
-        self.port = port
-        self.command = None
-        self.filename = None
-        
-    def set_command(self, command, filename=None):
-        """设置命令"""
-        self.command = command
-        self.filename = filename
-        
-    def run(self):
-        """执行命令"""
+        self.connection = MapConnection(host, port)
+        
+    def send_command(self, command, filename=None, seed=None):
+        """发送命令，不等待响应"""
+        request = {'command': command}
+        if filename:
+            request['filename'] = filename
+        if seed is not None:
+            request['seed'] = seed
+        if command == 'generate':
+            # 先接收低分辨率预览，完整地图随后到达
+            request['progressive'] = True
         try:
-            client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client.settimeout(10)
-            client.connect((self.host, self.port))
-            
-            # 构建请求
-            request = {'command': self.command}
-            if self.filename:
-                request['filename'] = self.filename
-                
-            client.send(json.dumps(request).encode('utf-8'))
-            
-            # 接收响应
-            response_data = b''
-            while True:
-                chunk = client.recv(4096)
-                if not chunk:
-                    break
-                response_data += chunk
-                
-                # 检查是否收到完整JSON
-                try:
-                    response = json.loads(response_data.decode('utf-8'))
-                    break
-                except json.JSONDecodeError:
-                    continue
-            
-            client.close()
-            
-            if response.get('status') == 'success':
-                if 'image' in response:
-                    self.map_received.emit(response['image'])
-                else:
-                    self.map_received.emit(response['message'])
-            else:
-                self.error_occurred.emit(response.get('message', '未知错误'))
-                
-        except socket.timeout:
-            self.error_occurred.emit('连接超时，请检查服务器是否运行')
+            future = self.connection.submit(request, on_event=self.on_event)
+        except Exception as e:
+            self.error_occurred.emit(str(e))
+            return
+        future.add_done_callback(self.on_response)
+        
+    def on_response(self, future):
+        """处理最终响应（图像为原始PNG字节）"""
+        try:
+            response, payload = future.result()
         except ConnectionRefusedError:
             self.error_occurred.emit('无法连接到服务器，请确保服务器已启动')
+            return
         except Exception as e:
             self.error_occurred.emit(str(e))
+            return
+        
+        if response.get('status') == 'success':
+            if payload:
+                self.map_received.emit(payload, response.get('seed'))
+            else:
+                self.map_received.emit(response['message'], None)
+        else:
+            self.error_occurred.emit(response.get('message', '未知错误'))
+
+    def on_event(self, header, payload):
+        """处理最终响应之前的中间事件"""
+        if header.get('event') == 'preview' and payload:
+            self.preview_received.emit(payload)
+        elif header.get('event') == 'progress':
+            self.progress_changed.emit(f"{header.get('stage')} ({header.get('elapsed_ms')} ms)")
+    
+    def close(self):
+        """关闭连接"""
+        self.connection.close()
 
 class RandomMapGUI(QMainWindow):
     """随机地图GUI主窗口"""
@@ -84,9 +86,13 @@ class RandomMapGUI(QMainWindow):
         super().__init__()
         self.client = MapClient()
         self.client.map_received.connect(self.on_map_received)
+        self.client.preview_received.connect(self.on_preview_received)
+        self.client.progress_changed.connect(self.on_progress_changed)
         self.client.error_occurred.connect(self.on_error)
         
         self.progress_dialog = None
+        # 当前显示的完整地图的种子；只显示预览或还没有地图时为None，此时不能保存
+        self.current_seed = None
         self.init_ui()
         
         # 启动时自动加载第一张地图
@@ -126,6 +132,8 @@ class RandomMapGUI(QMainWindow):
         self.save_btn = QPushButton('保存图片')
         self.save_btn.setFixedSize(120, 40)
         self.save_btn.clicked.connect(self.save_image)
+        # 收到完整地图之前不能保存
+        self.save_btn.setEnabled(False)
         
         self.exit_btn = QPushButton('退出')
         self.exit_btn.setFixedSize(120, 40)
@@ -165,16 +173,16 @@ class RandomMapGUI(QMainWindow):
     def load_initial_map(self):
         """加载初始地图"""
         self.show_progress("正在加载初始地图...")
-        self.client.set_command('get_image')
-        self.client.start()
+        self.client.send_command('get_image')
         
     def regenerate_map(self):
         """重新生成地图"""
         self.regenerate_btn.setEnabled(False)
+        # 预览期间服务器上的当前地图仍是上一张，完整地图到达之前禁止保存
+        self.save_btn.setEnabled(False)
         self.show_progress("正在重新生成地图...")
         
-        self.client.set_command('generate')
-        self.client.start()
+        self.client.send_command('generate')
         
     def save_image(self):
         """保存当前图片到maps文件夹，使用序号作为文件名"""
@@ -203,10 +211,9 @@ class RandomMapGUI(QMainWindow):
         # 生成文件名
         filename = os.path.join(maps_dir, f"{current_number}.png")
         
-        # 保存图片
+        # 保存图片（带上显示的地图的种子，服务器上的当前地图不是这张时不保存）
         self.show_progress("正在保存图片...")
-        self.client.set_command('save_image', filename)
-        self.client.start()
+        self.client.send_command('save_image', filename, self.current_seed)
         
         # 更新JSON文件中的序号
         try:
@@ -234,25 +241,43 @@ class RandomMapGUI(QMainWindow):
             self.progress_dialog.close()
             self.progress_dialog = None
             
-    def on_map_received(self, data):
+    def show_image(self, data):
+        """显示PNG图像数据，缩放以适应窗口"""
+        image = QImage()
+        image.loadFromData(data)
+        
+        # 调整图片大小以适应窗口
+        pixmap = QPixmap.fromImage(image)
+        scaled_pixmap = pixmap.scaled(
+            self.image_label.size(), 
+            Qt.KeepAspectRatio, 
+            Qt.SmoothTransformation
+        )
+        self.image_label.setPixmap(scaled_pixmap)
+        
+    def on_preview_received(self, data):
+        """先显示低分辨率预览，完整地图到达后替换"""
+        self.close_progress()
+        self.current_seed = None
+        self.save_btn.setEnabled(False)
+        try:
+            self.show_image(data)
+        except Exception as e:
+            print(f"显示预览失败: {e}")
+        
+    def on_progress_changed(self, message):
+        """在状态栏显示生成进度"""
+        self.statusBar().showMessage(f"生成进度: {message}", 3000)
+        
+    def on_map_received(self, data, seed=None):
         """收到地图数据的处理"""
         self.close_progress()
         
         try:
             # 检查是否是图片数据
-            if data.startswith('iVBOR') or len(data) > 100:  # PNG base64 前缀
-                image_data = base64.b64decode(data)
-                image = QImage()
-                image.loadFromData(image_data)
-                
-                # 调整图片大小以适应窗口
-                pixmap = QPixmap.fromImage(image)
-                scaled_pixmap = pixmap.scaled(
-                    self.image_label.size(), 
-                    Qt.KeepAspectRatio, 
-                    Qt.SmoothTransformation
-                )
-                self.image_label.setPixmap(scaled_pixmap)
+            if isinstance(data, bytes):
+                self.show_image(data)
+                self.current_seed = seed
             else:
                 # 显示消息
                 self.image_label.setText(data)
@@ -261,12 +286,14 @@ class RandomMapGUI(QMainWindow):
             self.on_error(f"显示图片失败: {e}")
             
         self.regenerate_btn.setEnabled(True)
+        self.save_btn.setEnabled(self.current_seed is not None)
         
     def on_error(self, error_message):
         """处理错误"""
         self.close_progress()
         QMessageBox.critical(self, "错误", error_message)
         self.regenerate_btn.setEnabled(True)
+        self.save_btn.setEnabled(self.current_seed is not None)
         
     def closeEvent(self, event):
         """关闭事件"""
@@ -279,8 +306,7 @@ class RandomMapGUI(QMainWindow):
         try:
             # 1. 发送停止命令到服务器
             self.show_progress("正在停止服务器...")
-            self.client.set_command('stop_server')
-            self.client.start()
+            self.client.send_command('stop_server')
             
             # 等待一小段时间让服务器处理停止命令
             QTimer.singleShot(1000, self.cleanup_cache)
@@ -319,6 +345,9 @@ class RandomMapGUI(QMainWindow):
                     except:
                         pass
             
+            # 关闭与服务器的连接
+            self.client.close()
+            
             # 强制终止python ranmap_server.py进程
             self.kill_server_process()
             
@@ -1,19 +1,97 @@
+import io
+import os
+import tempfile
+import threading
+from collections import OrderedDict
 import numpy as np
-import matplotlib.pyplot as plt
-import random
+import matplotlib
 from matplotlib.patches import Polygon
-from scipy.interpolate import splprep, splev
 from matplotlib.path import Path
 from matplotlib.widgets import Button
 import matplotlib.patches as patches
-from scipy.ndimage import gaussian_filter
+from scipy.ndimage import distance_transform_edt
+from scipy.spatial import cKDTree
+import ranmap_encode
+import ranmap_figure
+import ranmap_noise
+import ranmap_render
+import ranmap_trace
 
 # 全局matplotlib设置，禁用自动标题生成
-plt.rcParams['axes.titlesize'] = 0  # 标题字体大小设为0
-plt.rcParams['figure.titlesize'] = 0  # 图形标题大小设为0
-plt.rcParams['axes.titlepad'] = 0  # 标题填充设为0
+matplotlib.rcParams['axes.titlesize'] = 0  # 标题字体大小设为0
+matplotlib.rcParams['figure.titlesize'] = 0  # 图形标题大小设为0
+matplotlib.rcParams['axes.titlepad'] = 0  # 标题填充设为0
 
-def generate_complex_map(width=100, height=100, num_points=80):
+# 参考网格分辨率：随机场先在覆盖整张地图的参考网格上生成，再插值到目标分辨率，
+# 使任意分辨率下的地形都像参考网格地图的上采样，而不是不同的噪声形态
+REFERENCE_RESOLUTION = 100
+
+# 多尺度噪声：(高斯滤波标准差, 权重)，标准差以参考网格单元为单位
+NOISE_OCTAVES = ((30, 0.5), (15, 0.3), (5, 0.2))
+
+# 默认噪声模式，见 ranmap_noise.NOISE_MODES
+NOISE_MODE = 'spectral'
+
+# 海岸过渡带宽度与近岸缓坡宽度（世界坐标单位）
+TRANSITION_WIDTH = 8
+COASTAL_SHELF_WIDTH = 2
+
+# 海岸线细节谱：(截止谐波数占边界点数的比例, 衰减指数)
+COASTLINE_DETAIL_SPECTRUM = (0.3, 2.0)
+
+# 每个线程缓存的生成上下文数量（最近使用的优先保留），
+# 2 个可以同时容纳渐进式生成的预览和完整分辨率
+MAX_CACHED_CONTEXTS = 2
+
+@ranmap_trace.traced('coastline.smooth')
+def smooth_closed_curve(points, num_points, cutoff=None, rolloff=2.0, spectrum=None):
+    """
+    在频域中平滑闭合曲线并重采样
+    
+    先按弧长把曲线均匀采样，将 x + iy 视为周期信号做FFT，
+    乘以低通增益 exp(-(k / cutoff) ** rolloff)（k 为谐波序号），
+    再通过截断或补零频谱一次性重采样为 num_points 个点。
+    整个过程为 O(n log n)，没有拟合失败的情况。
+    
+    参数:
+        points: 曲线顶点数组，形状为 (n, 2)，首尾无需重复
+        num_points: 输出点数
+        cutoff: 低通截止谐波数，为空时不做低通
+        rolloff: 增益衰减指数，越大截止越陡峭
+        spectrum: 可选的附加增益函数，输入谐波序号数组，返回同形状的增益
+    
+    返回:
+        smooth_points: 形状为 (num_points, 2) 的平滑曲线坐标
+    """
+    points = np.asarray(points, dtype=float)
+    closed = np.vstack((points, points[:1]))
+    
+    # 按弧长均匀采样，采样数不少于输入点数和输出点数
+    arc_length = np.concatenate(([0], np.cumsum(np.hypot(*np.diff(closed, axis=0).T))))
+    samples = max(len(points), num_points)
+    t = np.linspace(0, arc_length[-1], samples, endpoint=False)
+    signal = np.interp(t, arc_length, closed[:, 0]) + 1j * np.interp(t, arc_length, closed[:, 1])
+    
+    coefficients = np.fft.fft(signal) / samples
+    harmonics = np.abs(np.fft.fftfreq(samples, 1 / samples))
+    if cutoff is not None:
+        coefficients *= np.exp(-(harmonics / cutoff) ** rolloff)
+    if spectrum is not None:
+        coefficients *= spectrum(harmonics)
+    
+    # 只保留两种点数都能无混叠表示的谐波，然后逆变换到输出点数
+    keep = (min(samples, num_points) - 1) // 2
+    resampled = np.zeros(num_points, dtype=complex)
+    resampled[:keep + 1] = coefficients[:keep + 1]
+    if keep > 0:
+        resampled[-keep:] = coefficients[-keep:]
+    curve = np.fft.ifft(resampled) * num_points
+    
+    return np.column_stack((curve.real, curve.imag))
+
+@ranmap_trace.traced('coastline')
+def generate_complex_map(width=100, height=100, num_points=80, rng=None,
+                         detail_spectrum=COASTLINE_DETAIL_SPECTRUM):
     """
     生成复杂的随机地形形状，创建曲折丰富的海岸线
     
@@ -21,13 +99,17 @@ def generate_complex_map(width=100, height=100, num_points=80):
         width: 地图宽度
         height: 地图高度
         num_points: 岛屿边界点数
+        rng: numpy随机数生成器或种子，为空时新建一个
+        detail_spectrum: 海岸线最终低通滤波的 (截止频率/点数, 滚降指数)
     
     返回:
         map_points: 岛屿边界点坐标列表
     """
+    rng = np.random.default_rng(rng)
+    
     # 生成随机中心点
-    center_x = width // 2 + random.randint(-width//4, width//4)
-    center_y = height // 2 + random.randint(-height//4, height//4)
+    center_x = width // 2 + rng.integers(-(width//4), width//4, endpoint=True)
+    center_y = height // 2 + rng.integers(-(height//4), height//4, endpoint=True)
     
     # 生成随机基础半径
     base_radius = min(width, height) // 4
@@ -36,124 +118,64 @@ def generate_complex_map(width=100, height=100, num_points=80):
     angles = np.linspace(0, 2*np.pi, num_points//3, endpoint=False)
     
     # 为每个角度生成多层随机半径，创建更丰富的变化
-    radii = []
-    for i, angle in enumerate(angles):
-        # 大尺度变化：创建主要的半岛和海湾（减少变化范围）
-        macro_variation = random.uniform(0.7, 1.5)
-        
-        # 中尺度变化：增加中等大小的起伏（增加变化范围）
-        medium_variation = random.uniform(0.5, 1.8)
-        
-        # 小尺度变化：添加细节和纹理（增加变化范围）
-        fine_variation = random.uniform(0.6, 1.6)
-        
-        # 微尺度变化：创建非常精细的细节
-        micro_variation = random.uniform(0.85, 1.2)
-        
-        # 添加位置相关的变化，使不同区域有不同的特征
-        position_factor = i / len(angles)
-        regional_variation = 1.0 + 0.4 * np.sin(position_factor * 3 * np.pi) * np.cos(position_factor * 5 * np.pi)
-        
-        # 组合所有变化层次
-        radius = base_radius * macro_variation * medium_variation * fine_variation * micro_variation * regional_variation
-        radii.append(radius)
+    # 四列分别为：大尺度变化（主要的半岛和海湾）、中尺度变化（中等大小的起伏）、
+    # 小尺度变化（细节和纹理）、微尺度变化（非常精细的细节）
+    variation = rng.uniform([0.7, 0.5, 0.6, 0.85], [1.5, 1.8, 1.6, 1.2], size=(len(angles), 4))
+    
+    # 添加位置相关的变化，使不同区域有不同的特征
+    position_factor = np.arange(len(angles)) / len(angles)
+    regional_variation = 1.0 + 0.4 * np.sin(position_factor * 3 * np.pi) * np.cos(position_factor * 5 * np.pi)
+    
+    # 组合所有变化层次
+    radii = base_radius * variation.prod(axis=1) * regional_variation
     
     # 计算基础边界点坐标
-    base_points = []
-    for i, angle in enumerate(angles):
-        x = center_x + radii[i] * np.cos(angle)
-        y = center_y + radii[i] * np.sin(angle)
-        base_points.append([x, y])
-    
-    # 添加第一个点以闭合曲线
-    base_points.append(base_points[0])
-    base_points = np.array(base_points)
-    
-    # 使用样条插值创建更精细的边缘
-    try:
-        # 使用样条插值，提高平滑度参数以创建更圆滑的曲线
-        tck, u = splprep([base_points[:, 0], base_points[:, 1]], s=3.0, per=True)
-        
-        # 生成更密集的点以增加细节
-        u_new = np.linspace(0, 1, num_points)
-        smooth_points = splev(u_new, tck)
-        
-        # 适当减少随机扰动强度，创建更圆滑的海岸线
-        for i in range(len(smooth_points[0])):
-            # 根据位置添加多层次的扰动
-            position_factor = i / len(smooth_points[0])
-            
-            # 基础噪声强度 - 减少强度以增加圆滑度
-            base_noise = 1.5 + 0.8 * np.sin(position_factor * 6 * np.pi)
-            
-            # 中等频率扰动 - 减少强度
-            medium_noise = 0.5 * np.sin(position_factor * 12 * np.pi + random.uniform(0, 2*np.pi))
-            
-            # 高频扰动 - 减少强度
-            high_noise = 0.2 * np.sin(position_factor * 24 * np.pi + random.uniform(0, 2*np.pi))
-            
-            # 超高频扰动 - 大幅减少强度
-            ultra_high_noise = 0.1 * np.sin(position_factor * 48 * np.pi + random.uniform(0, 2*np.pi))
-            
-            # 组合所有扰动
-            total_noise_strength = base_noise + medium_noise + high_noise + ultra_high_noise
-            
-            # 添加适度的随机扰动
-            noise_x = random.uniform(-total_noise_strength, total_noise_strength)
-            noise_y = random.uniform(-total_noise_strength, total_noise_strength)
-            
-            # 应用扰动
-            smooth_points[0][i] += noise_x
-            smooth_points[1][i] += noise_y
-        
-        # 添加适度的随机细节以保持圆滑度
-        for i in range(0, len(smooth_points[0]), 3):
-            detail_factor = random.uniform(0.5, 1.2)
-            angle_offset = random.uniform(-0.2, 0.2)
-            radius_offset = random.uniform(-0.8, 0.8) * detail_factor
-            
-            # 计算当前点的极坐标
-            current_x = smooth_points[0][i] - center_x
-            current_y = smooth_points[1][i] - center_y
-            current_radius = np.sqrt(current_x**2 + current_y**2)
-            current_angle = np.arctan2(current_y, current_x)
-            
-            # 应用细节变化
-            new_radius = current_radius + radius_offset
-            new_angle = current_angle + angle_offset
-            
-            # 转换回笛卡尔坐标
-            smooth_points[0][i] = center_x + new_radius * np.cos(new_angle)
-            smooth_points[1][i] = center_y + new_radius * np.sin(new_angle)
-        
-        # 第三次样条插值以进一步平滑所有曲线，创建更加圆滑的转角
-        try:
-            final_points = np.column_stack((smooth_points[0], smooth_points[1]))
-            tck_final, u_final = splprep([final_points[:, 0], final_points[:, 1]], s=4.0, per=True)
-            u_final_new = np.linspace(0, 1, num_points)
-            final_smooth = splev(u_final_new, tck_final)
-            
-            # 最终平滑处理：使用更高的平滑度参数确保转角圆滑
-            tck_ultra, u_ultra = splprep([final_smooth[0], final_smooth[1]], s=6.0, per=True)
-            u_ultra_new = np.linspace(0, 1, num_points)
-            ultra_smooth = splev(u_ultra_new, tck_ultra)
-            map_points = np.column_stack((ultra_smooth[0], ultra_smooth[1]))
-        except:
-            try:
-                final_points = np.column_stack((smooth_points[0], smooth_points[1]))
-                tck_final, u_final = splprep([final_points[:, 0], final_points[:, 1]], s=4.0, per=True)
-                u_final_new = np.linspace(0, 1, num_points)
-                final_smooth = splev(u_final_new, tck_final)
-                map_points = np.column_stack((final_smooth[0], final_smooth[1]))
-            except:
-                map_points = np.column_stack((smooth_points[0], smooth_points[1]))
-        
-    except:
-        # 如果插值失败，使用原始点但添加一些随机扰动
-        map_points = base_points[:-1]
-        for i in range(len(map_points)):
-            map_points[i][0] += random.uniform(-1.0, 1.0)
-            map_points[i][1] += random.uniform(-1.0, 1.0)
+    base_points = np.column_stack((center_x + radii * np.cos(angles),
+                                   center_y + radii * np.sin(angles)))
+    
+    # 在频域中平滑基础形状并重采样为更密集的点以增加细节
+    # 只保留基础点数能够表达的低频谐波，得到圆滑的闭合曲线
+    smooth_points = smooth_closed_curve(base_points, num_points,
+                                        cutoff=len(base_points), rolloff=4.0)
+    smooth_x, smooth_y = smooth_points[:, 0], smooth_points[:, 1]
+    count = len(smooth_x)
+    
+    # 适当减少随机扰动强度，创建更圆滑的海岸线
+    # 根据位置添加多层次的扰动
+    position_factor = np.arange(count) / count
+    phases = rng.uniform(0, 2*np.pi, size=(count, 3))
+    
+    # 基础噪声强度 - 减少强度以增加圆滑度
+    # 中等频率、高频、超高频扰动 - 逐级减少强度
+    total_noise_strength = (1.5 + 0.8 * np.sin(position_factor * 6 * np.pi)
+                            + 0.5 * np.sin(position_factor * 12 * np.pi + phases[:, 0])
+                            + 0.2 * np.sin(position_factor * 24 * np.pi + phases[:, 1])
+                            + 0.1 * np.sin(position_factor * 48 * np.pi + phases[:, 2]))
+    
+    # 添加适度的随机扰动
+    noise = rng.uniform(-1, 1, size=(count, 2)) * total_noise_strength[:, None]
+    smooth_x = smooth_x + noise[:, 0]
+    smooth_y = smooth_y + noise[:, 1]
+    
+    # 添加适度的随机细节以保持圆滑度（每隔两个点调整一次）
+    detail_index = np.arange(0, count, 3)
+    detail_factor = rng.uniform(0.5, 1.2, len(detail_index))
+    angle_offset = rng.uniform(-0.2, 0.2, len(detail_index))
+    radius_offset = rng.uniform(-0.8, 0.8, len(detail_index)) * detail_factor
+    
+    # 计算这些点的极坐标并应用细节变化
+    current_x = smooth_x[detail_index] - center_x
+    current_y = smooth_y[detail_index] - center_y
+    new_radius = np.hypot(current_x, current_y) + radius_offset
+    new_angle = np.arctan2(current_y, current_x) + angle_offset
+    
+    # 转换回笛卡尔坐标
+    smooth_x[detail_index] = center_x + new_radius * np.cos(new_angle)
+    smooth_y[detail_index] = center_y + new_radius * np.sin(new_angle)
+    # 最终在频域中低通滤波，保留细节谱中的中低频起伏，去除尖锐转角
+    detail_cutoff, detail_rolloff = detail_spectrum
+    map_points = smooth_closed_curve(np.column_stack((smooth_x, smooth_y)), num_points,
+                                     cutoff=detail_cutoff * num_points, rolloff=detail_rolloff)
     
     return map_points
 
@@ -186,345 +208,1115 @@ def calculate_distance_to_boundary(x, y, boundary_points):
     返回:
         到边界的距离
     """
-    min_distance = float('inf')
-    for i in range(len(boundary_points)):
-        p1 = boundary_points[i]
-        p2 = boundary_points[(i + 1) % len(boundary_points)]
+    return float(distance_to_coast(boundary_points, [[x, y]], signed=False)[0])
+
+def _segment_distance(px, py, ax, ay, bx, by):
+    """
+    批量计算点到线段的距离（支持广播）
+    
+    参数:
+        px, py: 查询点坐标
+        ax, ay: 线段起点坐标
+        bx, by: 线段终点坐标
+    
+    返回:
+        点到线段的最短距离
+    """
+    sx = bx - ax
+    sy = by - ay
+    t = ((px - ax) * sx + (py - ay) * sy) / (sx * sx + sy * sy)
+    t = np.clip(t, 0, 1)
+    return np.hypot(px - (ax + t * sx), py - (ay + t * sy))
+
+@ranmap_trace.traced('distance_field')
+def distance_to_coast(boundary_points, query, signed=True, method='exact',
+                      mask=None, max_distance=None, chunk_size=65536):
+    """
+    批量计算到海岸线的（有符号）距离场
+    
+    精确模式使用线段中点的KD树筛选候选线段：先取最近的若干条线段求精确距离，
+    再用"第k近中点距离 - 最大半线段长"作为下界判断结果是否可靠，
+    不可靠的少数点回退到全量线段计算，因此结果与逐线段遍历完全一致。
+    近似模式对网格使用欧氏距离变换（EDT），误差约为一个网格单元，
+    且看不到网格范围之外的海岸线。
+    
+    参数:
+        boundary_points: 海岸线边界点数组，形状为 (n, 2)，自动闭合
+        query: 查询点数组 (m, 2)，或网格坐标轴元组 (x, y)
+        signed: 是否返回有符号距离（陆地为正，海洋为负）
+        method: 'exact' 精确距离，或 'edt' 距离变换近似（仅支持网格）
+        mask: 网格查询时可传入已计算的陆地掩码，避免重复栅格化
+        max_distance: 距离上限，超过该值的距离截断为 max_distance，
+                      远离海岸的点可提前结束搜索
+        chunk_size: 每批处理的查询点数量，限制临时数组内存
+    
+    返回:
+        distance: 点查询返回形状为 (m,) 的数组，网格查询返回 (len(y), len(x)) 的数组
+    """
+    boundary = np.asarray(boundary_points, dtype=float)
+    is_grid = isinstance(query, tuple)
+    
+    if is_grid:
+        x = np.asarray(query[0], dtype=float)
+        y = np.asarray(query[1], dtype=float)
+        if mask is None and (signed or method == 'edt'):
+            mask = rasterize_polygon(boundary, x, y)
         
-        # 计算点到线段的距离
-        segment_length = np.sqrt((p2[0] - p1[0])**2 + (p2[1] - p1[1])**2)
-        if segment_length == 0:
-            continue
+        if method == 'edt':
+            # 距离变换近似：分别计算陆地内部和海洋到对岸的距离
+            sampling = (y[1] - y[0] if len(y) > 1 else 1.0,
+                        x[1] - x[0] if len(x) > 1 else 1.0)
+            inside = distance_transform_edt(mask, sampling=sampling)
+            if not signed:
+                outside = distance_transform_edt(~mask, sampling=sampling)
+                return np.where(mask, inside, outside)
+            return inside - distance_transform_edt(~mask, sampling=sampling)
+        
+        X, Y = np.meshgrid(x, y)
+        points = np.column_stack((X.ravel(), Y.ravel()))
+    else:
+        if method != 'exact':
+            raise ValueError(f"点查询仅支持精确模式: {method}")
+        points = np.asarray(query, dtype=float).reshape(-1, 2)
+    
+    # 构建线段列表，跳过长度为0的线段
+    start = boundary
+    end = np.roll(boundary, -1, axis=0)
+    lengths = np.hypot(end[:, 0] - start[:, 0], end[:, 1] - start[:, 1])
+    valid = lengths > 0
+    start, end, lengths = start[valid], end[valid], lengths[valid]
+    
+    distance = np.full(len(points), np.inf)
+    if len(start) > 0 and len(points) > 0:
+        # 将过长的线段细分为不超过中位长度的子线段，收紧下界估计
+        # 子线段的并集与原线段相同，因此最短距离不变
+        piece_length = np.median(lengths)
+        pieces = np.ceil(lengths / piece_length).astype(int)
+        owner = np.repeat(np.arange(len(start)), pieces)
+        step = np.arange(len(owner)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+        t0 = (step / pieces[owner])[:, None]
+        t1 = ((step + 1) / pieces[owner])[:, None]
+        direction = end[owner] - start[owner]
+        start, end = start[owner] + t0 * direction, start[owner] + t1 * direction
+        num_segments = len(start)
+        
+        midpoints = (start + end) / 2
+        max_half_length = np.hypot(end[:, 0] - start[:, 0], end[:, 1] - start[:, 1]).max() / 2
+        tree = cKDTree(midpoints)
+        
+        # 设置距离上限时，KD树只需搜索上限范围内的中点
+        search_radius = np.inf if max_distance is None else max_distance + max_half_length
+        
+        for lo in range(0, len(points), chunk_size):
+            chunk = points[lo:lo + chunk_size]
+            d = np.full(len(chunk), np.inf)
+            unsure = np.arange(len(chunk))
+            
+            # 逐级扩大候选线段数量；候选之外的线段距离不小于
+            # "第k近中点距离 - 最大半线段长"，该下界不小于当前结果即可确认
+            for k in (8, 64, 512):
+                k = min(k, num_segments)
+                mid_distance, candidates = tree.query(chunk[unsure], k=k,
+                                                      distance_upper_bound=search_radius)
+                mid_distance = mid_distance.reshape(len(unsure), k)
+                candidates = candidates.reshape(len(unsure), k)
+                
+                # 搜索范围内不足k个中点时，缺失的候选以无穷远处理
+                missing = candidates == num_segments
+                candidates[missing] = 0
+                segment_distance = _segment_distance(chunk[unsure, 0:1], chunk[unsure, 1:2],
+                                                     start[candidates, 0], start[candidates, 1],
+                                                     end[candidates, 0], end[candidates, 1])
+                segment_distance[missing] = np.inf
+                d[unsure] = segment_distance.min(axis=1)
+                if k == num_segments:
+                    unsure = unsure[:0]
+                    break
+                lower_bound = mid_distance[:, -1] - max_half_length
+                if max_distance is not None:
+                    # 下界已超过距离上限的点无需继续搜索
+                    far = np.minimum(d[unsure], lower_bound) >= max_distance
+                    d[unsure[far]] = max_distance
+                    lower_bound[far] = np.inf
+                unsure = unsure[lower_bound < d[unsure]]
+                if len(unsure) == 0:
+                    break
             
-        # 计算投影点
-        t = max(0, min(1, ((x - p1[0]) * (p2[0] - p1[0]) + (y - p1[1]) * (p2[1] - p1[1])) / (segment_length**2)))
-        projection_x = p1[0] + t * (p2[0] - p1[0])
-        projection_y = p1[1] + t * (p2[1] - p1[1])
+            # 仍无法确认的少数点（如位于近似圆形海岸的中心）回退到全量计算
+            batch = max(1, chunk_size // num_segments)
+            for i in range(0, len(unsure), batch):
+                rows = unsure[i:i + batch]
+                d[rows] = _segment_distance(chunk[rows, 0:1], chunk[rows, 1:2],
+                                            start[:, 0], start[:, 1],
+                                            end[:, 0], end[:, 1]).min(axis=1)
+            
+            distance[lo:lo + chunk_size] = d
         
-        distance = np.sqrt((x - projection_x)**2 + (y - projection_y)**2)
-        min_distance = min(min_distance, distance)
+        if max_distance is not None:
+            distance = np.minimum(distance, max_distance)
+    
+    if signed:
+        if is_grid:
+            inside = mask.ravel()
+        else:
+            inside = Path(boundary).contains_points(points)
+        distance = np.where(inside, distance, -distance)
     
-    return min_distance
+    if is_grid:
+        return distance.reshape(len(y), len(x))
+    return distance
 
-def generate_elevation_data(main_boundary_points, small_boundary_points_list, width, height):
+@ranmap_trace.traced('mask')
+def rasterize_polygon(polygon_points, x, y):
     """
-    生成高程数据
+    使用扫描线奇偶填充规则将闭合多边形栅格化为布尔掩码
+
+    对每一行扫描线一次性求出所有边的交点，在交点右侧的第一个格点处
+    翻转奇偶位，再沿行方向做异或累积，得到整个网格的内外判断。
+    计算量与"交点数 + 格点数"成正比，不再逐点调用 contains_point。
+
+    参数:
+        polygon_points: 多边形顶点坐标数组，形状为 (n, 2)，首尾无需重复
+        x: 网格列坐标（一维，递增）
+        y: 网格行坐标（一维，递增）
+
+    返回:
+        mask: 布尔数组，形状为 (len(y), len(x))，多边形内部为 True
+    """
+    points = np.asarray(polygon_points, dtype=float)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    rows, cols = len(y), len(x)
+
+    # 每条边的起点和终点（自动闭合）
+    x0, y0 = points[:, 0], points[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+
+    # 每条边覆盖的扫描线范围，采用半开区间 [min(y0, y1), max(y0, y1)) 避免顶点重复计数
+    y_low = np.minimum(y0, y1)
+    y_high = np.maximum(y0, y1)
+    row_start = np.searchsorted(y, y_low, side='left')
+    row_end = np.searchsorted(y, y_high, side='left')
+    counts = np.maximum(row_end - row_start, 0)
+
+    total = int(counts.sum())
+    if total == 0:
+        return np.zeros((rows, cols), dtype=bool)
+
+    # 将 (边, 扫描线) 对展开为一维数组
+    edge_index = np.repeat(np.arange(len(points)), counts)
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    row_index = row_start[edge_index] + offsets
+
+    # 计算交点横坐标
+    scan_y = y[row_index]
+    ex0, ey0 = x0[edge_index], y0[edge_index]
+    ex1, ey1 = x1[edge_index], y1[edge_index]
+    cross_x = ex0 + (scan_y - ey0) * (ex1 - ex0) / (ey1 - ey0)
+
+    # 交点右侧第一个格点处翻转奇偶位，超出右边界的交点直接忽略
+    col_index = np.searchsorted(x, cross_x, side='right')
+    flat_index = row_index * (cols + 1) + col_index
+    unique_index, hit_counts = np.unique(flat_index, return_counts=True)
+
+    toggles = np.zeros(rows * (cols + 1), dtype=np.uint8)
+    toggles[unique_index] = hit_counts & 1
+    toggles = toggles.reshape(rows, cols + 1)[:, :cols]
+
+    return np.bitwise_xor.accumulate(toggles, axis=1).astype(bool)
+
+def _lattice_weights(index, resolution):
+    """
+    计算目标网格索引在参考网格上的线性插值位置
     
     参数:
-        main_boundary_points: 主地形边界点列表
-        small_boundary_points_list: 附加地形边界点列表
-        width: 地图宽度
-        height: 地图高度
+        index: 目标网格的行或列索引（一维整数数组）
+        resolution: 目标网格分辨率
     
     返回:
-        X, Y, Z: 网格坐标和高程数据
+        lower, t: 参考网格上的下侧索引和插值权重
+    """
+    position = index * (REFERENCE_RESOLUTION - 1) / max(resolution - 1, 1)
+    lower = np.minimum(np.floor(position).astype(int), REFERENCE_RESOLUTION - 2)
+    return lower, position - lower
+
+def upsample_lattice(field, rows, cols, resolution):
     """
-    # 定义网格分辨率
-    resolution = 100
+    将参考网格上的随机场双线性插值到目标网格的指定行列
     
-    # 创建网格坐标
-    x = np.linspace(0, width, resolution)
-    y = np.linspace(0, height, resolution)
-    X, Y = np.meshgrid(x, y)
+    参考网格与目标网格覆盖相同的地图范围且四角对齐，插值按行、列分离进行，
+    计算量和内存都与输出格点数成正比。分辨率等于参考分辨率时原样返回对应格点。
     
-    # 初始化高程数据
-    Z = np.zeros((resolution, resolution))
+    参数:
+        field: 参考网格上的二维数组
+        rows: 目标网格的行索引（一维整数数组）
+        cols: 目标网格的列索引（一维整数数组）
+        resolution: 目标网格分辨率
+    
+    返回:
+        形状为 (len(rows), len(cols)) 的插值结果
+    """
+    rows = np.asarray(rows)
+    cols = np.asarray(cols)
+    if resolution == REFERENCE_RESOLUTION:
+        return field[np.ix_(rows, cols)]
+    
+    row_lower, row_t = _lattice_weights(rows, resolution)
+    col_lower, col_t = _lattice_weights(cols, resolution)
+    # 插值权重与随机场保持同一精度，避免float32随机场被提升为float64
+    row_t = row_t.astype(field.dtype, copy=False)
+    col_t = col_t.astype(field.dtype, copy=False)
+    
+    # 先沿行方向插值，再沿列方向插值
+    row_t = row_t[:, None]
+    blended = field[row_lower] * (1 - row_t) + field[row_lower + 1] * row_t
+    col_t = col_t[None, :]
+    return blended[:, col_lower] * (1 - col_t) + blended[:, col_lower + 1] * col_t
+
+# 各地形类型在参考网格上需要的随机场（正态分布标准差，按抽取顺序）
+FEATURE_NOISE_SCALES = {
+    'mountain': (0.3,),
+    'plateau': (0.25, 1),
+    'plain': (1.0,),
+    'basin': (0.3, 1),
+    'hills': (0.25,),
+}
+
+# 地形特征权重的截断阈值：权重绝对值上界低于该值的区域不参与计算，
+# 地形特征只在其包围窗口内求值；设为0时对整个网格求值
+FEATURE_CUTOFF = 1e-4
+
+@ranmap_trace.traced('noise')
+def plan_noise(rng, noise_mode=NOISE_MODE):
+    """
+    在参考网格上生成归一化到 [0, 1] 的多尺度基础噪声
+    
+    参数:
+        rng: numpy随机数生成器
+        noise_mode: 多尺度噪声的生成方式，见 ranmap_noise.NOISE_MODES
+    
+    返回:
+        combined_noise: 参考网格上的噪声场
+    """
+    lattice_shape = (REFERENCE_RESOLUTION, REFERENCE_RESOLUTION)
+    
+    # 使用多层噪声生成复杂地形
+    # 在参考网格上组合不同尺度的噪声（大尺度地形、中尺度地形、小尺度地形），
+    # 开销与目标分辨率无关
+    combined_noise = ranmap_noise.fractal_noise(lattice_shape, NOISE_OCTAVES, rng, noise_mode)
+    return (combined_noise - combined_noise.min()) / (combined_noise.max() - combined_noise.min())
+
+@ranmap_trace.traced('features.plan')
+def plan_features(map_points_list, map_type, rng):
+    """
+    为一个地形抽取最高海拔和各地形特征（形状参数、噪声场、随机相位）
+    
+    参数:
+        map_points_list: 地形边界点，特征中心位于其包围盒内
+        map_type: 'main' 或 'small'
+        rng: numpy随机数生成器
+    
+    返回:
+        max_elevation, features
+    """
+    lattice_shape = (REFERENCE_RESOLUTION, REFERENCE_RESOLUTION)
     
     # 定义地形类型
     terrain_types = ['mountain', 'plateau', 'plain', 'basin', 'hills']
     
+    # 随机选择主要地形特征数量
+    if map_type == 'main':
+        num_features = rng.integers(4, 7, endpoint=True)
+        max_elevation = rng.uniform(70, 100)
+    else:
+        num_features = rng.integers(2, 4, endpoint=True)
+        max_elevation = rng.uniform(25, 45)
+    
+    # 获取岛屿边界范围
+    min_x, max_x = np.min(map_points_list[:, 0]), np.max(map_points_list[:, 0])
+    min_y, max_y = np.min(map_points_list[:, 1]), np.max(map_points_list[:, 1])
+    
+    # 预生成随机形状参数
+    shape_params = []
+    for _ in range(num_features):
+        terrain_type = terrain_types[rng.integers(len(terrain_types))]
+        
+        # 随机中心位置，避免过于集中
+        margin_x = (max_x - min_x) * 0.15
+        margin_y = (max_y - min_y) * 0.15
+        center_x = rng.uniform(min_x + margin_x, max_x - margin_x)
+        center_y = rng.uniform(min_y + margin_y, max_y - margin_y)
+        
+        # 随机形状参数
+        max_distance = rng.uniform(min(max_x - min_x, max_y - min_y) / 4, 
+                                    min(max_x - min_x, max_y - min_y) / 2.5)
+        
+        # 随机椭圆变形
+        angle = rng.uniform(0, 2*np.pi)
+        stretch_x = rng.uniform(0.7, 1.3)
+        stretch_y = rng.uniform(0.7, 1.3)
+        
+        shape_params.append((terrain_type, center_x, center_y, max_distance, angle, stretch_x, stretch_y))
+    
+    # 按地形特征顺序抽取各自的噪声场
+    features = []
+    for params in shape_params:
+        terrain_type = params[0]
+        fields = [rng.normal(0, scale, lattice_shape)
+                  for scale in FEATURE_NOISE_SCALES[terrain_type]]
+        # 丘陵额外需要一个随机相位
+        phase = rng.normal(0, 1) if terrain_type == 'hills' else 0.0
+        features.append((params, fields, phase))
+    
+    return max_elevation, features
+
+def plan_terrain(main_boundary_points, small_boundary_points_list, rng=None,
+                 noise_mode=NOISE_MODE):
+    """
+    预先抽取生成高程所需的全部随机量
+    
+    所有随机场都位于参考网格上，与目标分辨率和分块方式无关，
+    因此同一份规划在整图计算和分块计算中得到完全相同的结果。
+    
+    参数:
+        main_boundary_points: 主地形边界点列表
+        small_boundary_points_list: 附加地形边界点列表
+        rng: numpy随机数生成器或种子，为空时新建一个
+        noise_mode: 多尺度噪声的生成方式，见 ranmap_noise.NOISE_MODES
+    
+    返回:
+        plans: 每个地形一份规划字典的列表
+    """
+    rng = np.random.default_rng(rng)
+    
     # 处理所有地形（主地形和附加地形）
     all_maps = [(main_boundary_points, 'main')] + [(small_map, 'small') for small_map in small_boundary_points_list]
     
+    plans = []
     for map_points_list, map_type in all_maps:
-        # 为每个岛屿创建路径
-        map_path = Path(map_points_list)
-        
-        # 创建岛屿掩码
-        map_mask = np.zeros((resolution, resolution), dtype=bool)
-        for i in range(resolution):
-            for j in range(resolution):
-                point = (X[i, j], Y[i, j])
-                map_mask[i, j] = map_path.contains_point(point)
-        
-        # 使用多层噪声生成复杂地形
-        # 生成基础噪声
-        noise = np.random.normal(0, 1, (resolution, resolution))
-        large_scale = gaussian_filter(noise, sigma=30)  # 大尺度地形
-        medium_scale = gaussian_filter(noise, sigma=15)  # 中尺度地形
-        small_scale = gaussian_filter(noise, sigma=5)   # 小尺度地形
-        
-        # 组合不同尺度的噪声
-        combined_noise = (large_scale * 0.5 + medium_scale * 0.3 + small_scale * 0.2)
-        combined_noise = (combined_noise - combined_noise.min()) / (combined_noise.max() - combined_noise.min())
-        
-        # 为每个地形特征创建权重
-        terrain_weights = np.zeros((resolution, resolution))
-        
-        # 随机选择主要地形特征数量
-        if map_type == 'main':
-            num_features = random.randint(4, 7)
-            max_elevation = random.uniform(70, 100)
-        else:
-            num_features = random.randint(2, 4)
-            max_elevation = random.uniform(25, 45)
+        combined_noise = plan_noise(rng, noise_mode)
+        plans.append(plan_map(map_points_list, map_type, combined_noise, rng))
+    
+    return plans
+
+def plan_map(map_points_list, map_type, combined_noise, rng):
+    """
+    在基础噪声之后为一个地形抽取地形特征和随机变化，组成该地形的规划
+    
+    参数:
+        map_points_list: 地形边界点
+        map_type: 'main' 或 'small'
+        combined_noise: plan_noise 生成的基础噪声
+        rng: numpy随机数生成器
+    
+    返回:
+        plan: 规划字典
+    """
+    lattice_shape = (REFERENCE_RESOLUTION, REFERENCE_RESOLUTION)
+    max_elevation, features = plan_features(map_points_list, map_type, rng)
+    
+    # 添加随机变化使地形更自然
+    random_variation = rng.normal(0, max_elevation * 0.05, lattice_shape)
+    
+    return {
+        'points': map_points_list,
+        'combined_noise': combined_noise,
+        'features': features,
+        'max_elevation': max_elevation,
+        'random_variation': random_variation,
+    }
+
+def _feature_weight(feature, X, Y, rows, cols, resolution):
+    """
+    计算单个地形特征在指定网格窗口上的权重
+    
+    参数:
+        feature: plan_terrain 生成的 (形状参数, 噪声场, 随机相位)
+        X, Y: 窗口内的网格坐标
+        rows, cols: 窗口在整个网格中的行列索引
+        resolution: 网格分辨率
+    
+    返回:
+        weight: 与 X 形状相同的权重数组
+    """
+    (terrain_type, center_x, center_y, max_distance, angle, stretch_x, stretch_y), fields, phase = feature
+    fields = [upsample_lattice(field, rows, cols, resolution) for field in fields]
+    
+    # 创建椭圆变形距离场
+    dx = X - center_x
+    dy = Y - center_y
+    
+    # 应用旋转和拉伸
+    rotated_x = dx * np.cos(angle) + dy * np.sin(angle)
+    rotated_y = -dx * np.sin(angle) + dy * np.cos(angle)
+    
+    # 椭圆距离
+    elliptical_distance = np.sqrt((rotated_x/stretch_x)**2 + (rotated_y/stretch_y)**2)
+    
+    # 根据地形类型创建不规则的自然形状
+    if terrain_type == 'mountain':
+        # 山脉：不规则山峰，使用椭圆距离和噪声
+        noise_shape, = fields
+        mountain_base = np.exp(-elliptical_distance**1.8 / (2 * (max_distance/4)**2)) * (0.7 + noise_shape * 0.3)
+        # 添加不规则边界
+        mountain_base *= (1 + 0.2 * np.sin(elliptical_distance * 8) * np.exp(-elliptical_distance/2))
+        weight = np.clip(mountain_base, 0, 1) * 0.9
         
-        # 获取岛屿边界范围
-        min_x, max_x = np.min(map_points_list[:, 0]), np.max(map_points_list[:, 0])
-        min_y, max_y = np.min(map_points_list[:, 1]), np.max(map_points_list[:, 1])
+    elif terrain_type == 'plateau':
+        # 高原：不规则的高原地形
+        plateau_noise, edge_noise = fields
+        plateau_base = np.exp(-elliptical_distance**1.5 / (2 * (max_distance/3)**2))
+        plateau_shape = plateau_base * (0.8 + plateau_noise * 0.2)
+        # 添加边缘不规则性
+        plateau_shape *= (1 - 0.15 * edge_noise * 
+                        np.exp(-elliptical_distance))
+        weight = np.clip(plateau_shape, 0, 1) * 0.7
         
-        # 预生成随机形状参数
-        shape_params = []
-        for _ in range(num_features):
-            terrain_type = random.choice(terrain_types)
-            
-            # 随机中心位置，避免过于集中
-            margin_x = (max_x - min_x) * 0.15
-            margin_y = (max_y - min_y) * 0.15
-            center_x = random.uniform(min_x + margin_x, max_x - margin_x)
-            center_y = random.uniform(min_y + margin_y, max_y - margin_y)
-            
-            # 随机形状参数
-            max_distance = random.uniform(min(max_x - min_x, max_y - min_y) / 4, 
-                                        min(max_x - min_x, max_y - min_y) / 2.5)
-            
-            # 随机椭圆变形
-            angle = random.uniform(0, 2*np.pi)
-            stretch_x = random.uniform(0.7, 1.3)
-            stretch_y = random.uniform(0.7, 1.3)
-            
-            shape_params.append((terrain_type, center_x, center_y, max_distance, angle, stretch_x, stretch_y))
+    elif terrain_type == 'plain':
+        # 平原：不规则的平坦区域
+        plain_noise, = fields
+        plain_shape = np.exp(-elliptical_distance**2 / (2 * (max_distance/1.5)**2))
+        plain_shape = plain_shape * (0.4 + plain_noise * 0.15)
+        # 添加随机起伏
+        plain_shape += 0.1 * np.sin(elliptical_distance * 3 + plain_noise * 5) * np.exp(-elliptical_distance/3)
+        weight = np.clip(plain_shape, 0, 0.5)
         
-        for terrain_type, center_x, center_y, max_distance, angle, stretch_x, stretch_y in shape_params:
-            # 创建椭圆变形距离场
-            dx = X - center_x
-            dy = Y - center_y
-            
-            # 应用旋转和拉伸
-            rotated_x = dx * np.cos(angle) + dy * np.sin(angle)
-            rotated_y = -dx * np.sin(angle) + dy * np.cos(angle)
-            
-            # 椭圆距离
-            elliptical_distance = np.sqrt((rotated_x/stretch_x)**2 + (rotated_y/stretch_y)**2)
-            
-            # 根据地形类型创建不规则的自然形状
-            if terrain_type == 'mountain':
-                # 山脉：不规则山峰，使用椭圆距离和噪声
-                noise_shape = np.random.normal(0, 0.3, elliptical_distance.shape)
-                mountain_base = np.exp(-elliptical_distance**1.8 / (2 * (max_distance/4)**2)) * (0.7 + noise_shape * 0.3)
-                # 添加不规则边界
-                mountain_base *= (1 + 0.2 * np.sin(elliptical_distance * 8) * np.exp(-elliptical_distance/2))
-                weight = np.clip(mountain_base, 0, 1) * 0.9
-                
-            elif terrain_type == 'plateau':
-                # 高原：不规则的高原地形
-                plateau_noise = np.random.normal(0, 0.25, elliptical_distance.shape)
-                plateau_base = np.exp(-elliptical_distance**1.5 / (2 * (max_distance/3)**2))
-                plateau_shape = plateau_base * (0.8 + plateau_noise * 0.2)
-                # 添加边缘不规则性
-                plateau_shape *= (1 - 0.15 * np.random.normal(0, 1, plateau_shape.shape) * 
-                                np.exp(-elliptical_distance))
-                weight = np.clip(plateau_shape, 0, 1) * 0.7
-                
-            elif terrain_type == 'plain':
-                # 平原：不规则的平坦区域
-                plain_noise = np.random.normal(0, 1.0, elliptical_distance.shape)
-                plain_shape = np.exp(-elliptical_distance**2 / (2 * (max_distance/1.5)**2))
-                plain_shape = plain_shape * (0.4 + plain_noise * 0.15)
-                # 添加随机起伏
-                plain_shape += 0.1 * np.sin(elliptical_distance * 3 + plain_noise * 5) * np.exp(-elliptical_distance/3)
-                weight = np.clip(plain_shape, 0, 0.5)
-                
-            elif terrain_type == 'basin':
-                # 盆地：不规则的凹陷地形
-                basin_noise = np.random.normal(0, 0.3, elliptical_distance.shape)
-                basin_base = -np.exp(-elliptical_distance**2 / (2 * (max_distance/2.5)**2))
-                basin_shape = basin_base * (0.6 + basin_noise * 0.2)
-                # 添加不规则边缘
-                basin_shape -= 0.1 * np.random.normal(0, 1, basin_shape.shape) * np.exp(-elliptical_distance/2)
-                weight = np.clip(basin_shape, -0.7, 0) * 0.6
-                
-            else:  # hills
-                # 丘陵：不规则的起伏地形
-                hill_noise = np.random.normal(0, 0.25, elliptical_distance.shape)
-                hill_pattern = np.sin(elliptical_distance * 2.5 + hill_noise * 4) * \
-                               np.exp(-elliptical_distance / (max_distance * 0.7))
-                hill_shape = hill_pattern * (0.5 + hill_noise * 0.2)
-                # 添加更多不规则性
-                hill_shape += 0.1 * np.sin(elliptical_distance * 6 + np.random.normal(0, 1)) * \
-                             np.exp(-elliptical_distance/1.5)
-                weight = np.clip(hill_shape, -0.4, 0.4) * 0.5
-            
-            # 使用最大值而非叠加来避免高度叠加，确保地形自然融合
-            terrain_weights = np.maximum(terrain_weights, weight)
-        
-        # 结合噪声和地形特征
-        elevation = combined_noise * 0.3 + terrain_weights
-        
-        # 归一化到0-1范围
-        elevation = (elevation - elevation.min()) / (elevation.max() - elevation.min())
-        
-        # 应用岛屿掩码和缩放高程
-        elevation = elevation * map_mask * max_elevation
-        
-        # 添加随机变化使地形更自然
-        random_variation = np.random.normal(0, max_elevation * 0.05, (resolution, resolution))
-        elevation = elevation + random_variation * map_mask
-        
-        # 确保边界处高程平滑过渡到0，使用更平缓的坡度
-        for i in range(resolution):
-            for j in range(resolution):
-                if map_mask[i, j]:
-                    distance_to_boundary = calculate_distance_to_boundary(X[i, j], Y[i, j], map_points_list)
-                    # 增加过渡区域宽度，从3扩展到8
-                    transition_width = 8
-                    if distance_to_boundary < transition_width:
-                        # 使用指数衰减函数，使坡度更加平缓
-                        # 当距离为0时，衰减因子为0；当距离接近transition_width时，衰减因子接近1
-                        smooth_factor = 1 - np.exp(-3 * distance_to_boundary / transition_width)
-                        elevation[i, j] *= smooth_factor
-                        
-                        # 向外扩展岛屿范围，在边界外创建渐变区域
-                        if distance_to_boundary < 2:
-                            # 在边界外1个单位范围内，创建非常平缓的过渡
-                            extended_factor = distance_to_boundary / 2
-                            elevation[i, j] *= (0.3 + 0.7 * extended_factor)
-        
-        # 确保高程非负
-        elevation = np.clip(elevation, 0, None)
+    elif terrain_type == 'basin':
+        # 盆地：不规则的凹陷地形
+        basin_noise, edge_noise = fields
+        basin_base = -np.exp(-elliptical_distance**2 / (2 * (max_distance/2.5)**2))
+        basin_shape = basin_base * (0.6 + basin_noise * 0.2)
+        # 添加不规则边缘
+        basin_shape -= 0.1 * edge_noise * np.exp(-elliptical_distance/2)
+        weight = np.clip(basin_shape, -0.7, 0) * 0.6
         
-        # 合并到总高程数据
-        Z = np.maximum(Z, elevation)
+    else:  # hills
+        # 丘陵：不规则的起伏地形
+        hill_noise, = fields
+        hill_pattern = np.sin(elliptical_distance * 2.5 + hill_noise * 4) * \
+                       np.exp(-elliptical_distance / (max_distance * 0.7))
+        hill_shape = hill_pattern * (0.5 + hill_noise * 0.2)
+        # 添加更多不规则性
+        hill_shape += 0.1 * np.sin(elliptical_distance * 6 + phase) * \
+                     np.exp(-elliptical_distance/1.5)
+        weight = np.clip(hill_shape, -0.4, 0.4) * 0.5
     
-    return X, Y, Z
+    return weight
 
-class mapMapGenerator:
-    def __init__(self, width=100, height=100, num_points=80):
-        self.width = width
-        self.height = height
-        self.num_points = num_points
-        self.fig = None
-        self.ax = None
-        self.canvas = None
+def _feature_support(feature, cutoff):
+    """
+    估计地形特征的影响半径（世界坐标）
+    
+    每种地形的权重都被若干项 A * exp(-(d/L)**p) 从上方界住（d 为椭圆距离，
+    噪声取其在参考网格上的实际最大幅值），取每一项都低于 cutoff/项数 的距离，
+    再按最大拉伸系数换算为世界坐标半径。盆地权重恒不大于0，
+    在与0取最大值的合并中不起作用，返回None表示可以跳过。
+    
+    参数:
+        feature: plan_terrain 生成的 (形状参数, 噪声场, 随机相位)
+        cutoff: 权重截断阈值，不大于0时返回无穷大
+    
+    返回:
+        影响半径，或 None
+    """
+    (terrain_type, center_x, center_y, max_distance, angle, stretch_x, stretch_y), fields, phase = feature
+    if terrain_type == 'basin':
+        return None
+    if cutoff <= 0:
+        return np.inf
+    noise = [np.abs(field).max() for field in fields]
+    
+    # (幅值上界, 衰减长度, 指数)
+    if terrain_type == 'mountain':
+        terms = [(0.9 * 1.2 * (0.7 + 0.3 * noise[0]), (2 * (max_distance/4)**2) ** (1 / 1.8), 1.8)]
+    elif terrain_type == 'plateau':
+        terms = [(0.7 * (0.8 + 0.2 * noise[0]) * (1 + 0.15 * noise[1]),
+                  (2 * (max_distance/3)**2) ** (1 / 1.5), 1.5)]
+    elif terrain_type == 'plain':
+        terms = [(0.4 + 0.15 * noise[0], np.sqrt(2) * max_distance / 1.5, 2), (0.1, 3, 1)]
+    else:  # hills
+        terms = [(0.5 * (0.5 + 0.2 * noise[0]), max_distance * 0.7, 1), (0.5 * 0.1, 1.5, 1)]
+    
+    radius = 0.0
+    for amplitude, length, power in terms:
+        ratio = len(terms) * amplitude / cutoff
+        if ratio > 1:
+            radius = max(radius, length * np.log(ratio) ** (1 / power))
+    return radius * max(stretch_x, stretch_y)
+
+def _raw_elevation(plan, X, Y, rows, cols, resolution, cutoff=FEATURE_CUTOFF, out=None):
+    """
+    计算归一化之前的地形高度（噪声与地形特征的组合）
+    
+    每个地形特征只在其影响半径覆盖的子窗口内求值，计算量与特征面积成正比。
+    
+    参数:
+        plan: plan_terrain 生成的单个地形规划
+        X, Y: 窗口内的网格坐标（由 meshgrid 生成，行列坐标递增）
+        rows, cols: 窗口在整个网格中的行列索引
+        resolution: 网格分辨率
+        cutoff: 地形特征权重截断阈值
+        out: 可选的输出缓冲区（与 X 同形状同类型）
+    
+    返回:
+        未归一化的高度数组（给定 out 时即为 out）
+    """
+    x, y = X[0], Y[:, 0]
+    
+    # 为每个地形特征创建权重
+    if out is None:
+        terrain_weights = np.zeros(X.shape, dtype=X.dtype)
+    else:
+        terrain_weights = out
+        terrain_weights.fill(0)
+    for feature in plan['features']:
+        radius = _feature_support(feature, cutoff)
+        if radius is None:
+            continue
         
-    def generate_map(self):
-        """
-        生成完整的地形地图
-        """
-        # 动态创建fig和ax对象
-        self.fig, self.ax = plt.subplots(1, 1, figsize=(12, 10))
+        # 影响半径对应的子窗口
+        center_x, center_y = feature[0][1], feature[0][2]
+        c0, c1 = np.searchsorted(x, center_x - radius), np.searchsorted(x, center_x + radius, 'right')
+        r0, r1 = np.searchsorted(y, center_y - radius), np.searchsorted(y, center_y + radius, 'right')
+        if c0 >= c1 or r0 >= r1:
+            continue
+        window = (slice(r0, r1), slice(c0, c1))
         
-        # 如果是交互模式，设置键盘事件
-        try:
-            self.canvas = self.fig.canvas
-            self.canvas.mpl_connect('key_press_event', self.on_key_press)
-        except:
-            # 在非交互模式下（如服务器端）忽略键盘事件
-            pass
+        # 使用最大值而非叠加来避免高度叠加，确保地形自然融合
+        with ranmap_trace.span('feature.' + feature[0][0], cells=int((r1 - r0) * (c1 - c0))):
+            np.maximum(terrain_weights[window],
+                       _feature_weight(feature, X[window], Y[window], rows[r0:r1], cols[c0:c1], resolution),
+                       out=terrain_weights[window])
+    
+    # 结合噪声和地形特征
+    combined_noise = upsample_lattice(plan['combined_noise'], rows, cols, resolution)
+    combined_noise *= 0.3
+    terrain_weights += combined_noise
+    return terrain_weights
+
+def _finish_elevation(plan, raw, raw_min, raw_max, X, Y, map_mask, rows, cols, resolution,
+                      transition_width=TRANSITION_WIDTH):
+    """
+    对窗口内的地形高度做归一化、掩码、随机扰动和海岸过渡
+    
+    参数:
+        plan: plan_terrain 生成的单个地形规划
+        raw: _raw_elevation 计算的高度，会被原地改写为结果
+        raw_min, raw_max: 整个网格上 raw 的最小值和最大值
+        X, Y: 窗口内的网格坐标
+        map_mask: 窗口内的岛屿掩码
+        rows, cols: 窗口在整个网格中的行列索引
+        resolution: 网格分辨率
+        transition_width: 海岸过渡带宽度
+    
+    返回:
+        elevation: 该地形在窗口内的高程（即 raw 本身）
+    """
+    max_elevation = plan['max_elevation']
+    
+    # 归一化到0-1范围
+    elevation = raw
+    elevation -= raw_min
+    elevation /= raw_max - raw_min
+    
+    # 应用岛屿掩码和缩放高程
+    elevation *= map_mask
+    elevation *= max_elevation
+    
+    # 添加随机变化使地形更自然
+    random_variation = upsample_lattice(plan['random_variation'], rows, cols, resolution)
+    random_variation *= map_mask
+    elevation += random_variation
+    
+    # 确保边界处高程平滑过渡到0，使用更平缓的坡度
+    # 一次性计算所有陆地格点到海岸线的距离，过渡带以外的距离无需精确值
+    land_points = np.column_stack((X[map_mask], Y[map_mask]))
+    distance_to_boundary = distance_to_coast(plan['points'], land_points, signed=False,
+                                             max_distance=transition_width)
+    
+    # 使用指数衰减函数，使坡度更加平缓
+    # 当距离为0时，衰减因子为0；当距离接近transition_width时，衰减因子接近1
+    smooth_factor = np.where(distance_to_boundary < transition_width,
+                             1 - np.exp(-3 * distance_to_boundary / transition_width), 1.0)
+    
+    # 向外扩展岛屿范围，在边界外创建渐变区域
+    # 在边界外1个单位范围内，创建非常平缓的过渡
+    extended_factor = distance_to_boundary / COASTAL_SHELF_WIDTH
+    smooth_factor = np.where(distance_to_boundary < COASTAL_SHELF_WIDTH,
+                             smooth_factor * (0.3 + 0.7 * extended_factor), smooth_factor)
+    elevation[map_mask] *= smooth_factor
+    
+    # 确保高程非负
+    return np.clip(elevation, 0, None, out=elevation)
+
+def _plan_astype(plan, dtype):
+    """
+    将地形规划中的参考网格随机场转换为指定精度（返回新的规划字典）
+    """
+    if np.dtype(dtype) == np.float64:
+        return plan
+    plan = dict(plan)
+    plan['combined_noise'] = plan['combined_noise'].astype(dtype)
+    plan['random_variation'] = plan['random_variation'].astype(dtype)
+    plan['features'] = [(params, [field.astype(dtype) for field in fields], phase)
+                        for params, fields, phase in plan['features']]
+    return plan
+
+class GeneratorContext:
+    """
+    可复用的高程生成上下文
+    
+    同一 (width, height, resolution, dtype) 的地图共享不变的坐标网格，
+    并复用预先分配的工作区（高程、陆地掩码和中间高度缓冲区），
+    避免每张地图重复构造网格和分配整幅数组。
+    
+    使用上下文时 generate_elevation_data 返回的 Z 和 land_mask 就是工作区本身，
+    在下一次使用同一上下文生成之前有效，需要保留时应自行复制。
+    上下文不是线程安全的，多线程时每个线程应使用各自的上下文（见 get_context）。
+    """
+    def __init__(self, width, height, resolution=REFERENCE_RESOLUTION, dtype=np.float64):
+        self.width = width
+        self.height = height
+        self.resolution = resolution
+        self.dtype = np.dtype(dtype)
         
-        # 生成复杂地形边界
-        main_points = generate_complex_map(self.width, self.height, self.num_points)
+        # 不变的坐标网格
+        self.x = np.linspace(0, width, resolution).astype(self.dtype, copy=False)
+        self.y = np.linspace(0, height, resolution).astype(self.dtype, copy=False)
+        self.X, self.Y = np.meshgrid(self.x, self.y)
+        self.grid_index = np.arange(resolution)
         
-        # 生成附加地形
-        small_terrain_list = generate_small_maps(main_points, self.width, self.height)
+        # 预先分配的工作区
+        shape = (resolution, resolution)
+        self.Z = np.empty(shape, dtype=self.dtype)
+        self.land_mask = np.empty(shape, dtype=bool)
+        self.raw = np.empty(shape, dtype=self.dtype)
+    
+    @property
+    def key(self):
+        return (self.width, self.height, self.resolution, self.dtype)
+
+# 每个线程各自缓存的生成上下文
+_context_cache = threading.local()
+
+def get_context(width, height, resolution=REFERENCE_RESOLUTION, dtype=np.float64):
+    """
+    获取当前线程中对应尺寸和精度的生成上下文，不存在时创建并缓存
+    
+    每个线程最多保留 MAX_CACHED_CONTEXTS 个最近使用的上下文，更早的上下文
+    （及其整幅工作区）被丢弃，内存占用不会随请求过的分辨率种类增长。
+    
+    参数:
+        width: 地图宽度
+        height: 地图高度
+        resolution: 网格分辨率
+        dtype: 高程数据类型（np.float64 或 np.float32）
+    
+    返回:
+        GeneratorContext
+    """
+    contexts = getattr(_context_cache, 'contexts', None)
+    if contexts is None:
+        contexts = _context_cache.contexts = OrderedDict()
+    key = (width, height, resolution, np.dtype(dtype))
+    context = contexts.get(key)
+    if context is not None:
+        contexts.move_to_end(key)
+        return context
+    # 先淘汰再创建，避免新旧工作区同时占用内存
+    while contexts and len(contexts) >= MAX_CACHED_CONTEXTS:
+        contexts.popitem(last=False)
+    context = contexts[key] = GeneratorContext(width, height, resolution, dtype)
+    return context
+
+def clear_contexts():
+    """
+    丢弃当前线程缓存的所有生成上下文，释放其工作区
+    
+    之前取得的上下文和引用其工作区的数组仍然有效，只是不再被缓存复用。
+    """
+    contexts = getattr(_context_cache, 'contexts', None)
+    if contexts is not None:
+        contexts.clear()
+
+@ranmap_trace.traced('elevation')
+def generate_elevation_data(main_boundary_points, small_boundary_points_list, width, height,
+                            return_mask=False, resolution=REFERENCE_RESOLUTION, rng=None,
+                            feature_cutoff=FEATURE_CUTOFF, context=None, noise_mode=NOISE_MODE,
+                            plans=None, transition_width=TRANSITION_WIDTH):
+    """
+    生成高程数据
+
+    参数:
+        main_boundary_points: 主地形边界点列表
+        small_boundary_points_list: 附加地形边界点列表
+        width: 地图宽度
+        height: 地图高度
+        return_mask: 是否同时返回陆地掩码，供渲染阶段复用
+        resolution: 网格分辨率（每个方向的格点数），地形参数均以世界坐标表示，
+                    不同分辨率得到同一风格的地形
+        rng: numpy随机数生成器或种子，为空时新建一个
+        feature_cutoff: 地形特征权重截断阈值，为0时在整个网格上求值
+        context: 可复用的 GeneratorContext（尺寸须一致），为空时使用一次性的上下文；
+                 给定时返回的数组是上下文的工作区，精度由上下文决定
+        noise_mode: 多尺度噪声的生成方式，见 ranmap_noise.NOISE_MODES
+        plans: 预先生成的地形规划（见 plan_terrain），给定时不再抽取随机量
+        transition_width: 海岸过渡带宽度
+
+    返回:
+        X, Y, Z: 网格坐标和高程数据
+        （return_mask 为 True 时额外返回陆地掩码 land_mask）
+    """
+    if context is None:
+        context = GeneratorContext(width, height, resolution)
+    elif context.key[:3] != (width, height, resolution):
+        raise ValueError(f"生成上下文尺寸 {context.key[:3]} 与请求 {(width, height, resolution)} 不一致")
+    x, y, X, Y = context.x, context.y, context.X, context.Y
+    grid_index = context.grid_index
+    
+    # 初始化高程数据
+    Z = context.Z
+    Z.fill(0)
+
+    # 所有地形掩码的并集，供渲染阶段复用
+    land_mask = context.land_mask
+    land_mask.fill(False)
+    
+    if plans is None:
+        plans = plan_terrain(main_boundary_points, small_boundary_points_list, rng, noise_mode)
+    
+    for plan in plans:
+        plan = _plan_astype(plan, context.dtype)
         
-        # 生成高程数据
-        X, Y, Z = generate_elevation_data(main_points, small_terrain_list, self.width, self.height)
+        # 创建岛屿掩码（扫描线栅格化，一次完成整个网格）
+        map_mask = rasterize_polygon(plan['points'], x, y)
+        land_mask |= map_mask
         
-        # 设置背景为深蓝色（海洋）
-        self.ax.set_facecolor('#1E90FF')
+        raw = _raw_elevation(plan, X, Y, grid_index, grid_index, resolution, feature_cutoff,
+                             out=context.raw)
+        elevation = _finish_elevation(plan, raw, raw.min(), raw.max(), X, Y, map_mask,
+                                      grid_index, grid_index, resolution, transition_width)
         
-        # 不绘制等高线轮廓线，只显示填充区域
+        # 合并到总高程数据
+        np.maximum(Z, elevation, out=Z)
+
+    if return_mask:
+        return X, Y, Z, land_mask
+    return X, Y, Z
+
+@ranmap_trace.traced('elevation.tiled')
+def generate_elevation_data_tiled(main_boundary_points, small_boundary_points_list, width, height,
+                                  resolution=REFERENCE_RESOLUTION, tile_size=1024, filename=None,
+                                  rng=None, feature_cutoff=FEATURE_CUTOFF, dtype=np.float64,
+                                  noise_mode=NOISE_MODE, transition_width=TRANSITION_WIDTH):
+    """
+    分块生成高程数据，结果写入内存映射文件，适用于无法整体放入内存的超大地图
+    
+    随机场和高斯滤波都在参考网格上完成，分块之间除全局归一化外没有依赖，
+    因此无需为滤波保留重叠边界。每个地形先扫描一遍所有分块求出归一化所需的
+    最小值和最大值，再逐块计算并写入输出，工作内存只与分块大小有关。
+    在两种方式都能运行的尺寸下，结果与 generate_elevation_data 逐位一致。
+    
+    参数:
+        main_boundary_points: 主地形边界点列表
+        small_boundary_points_list: 附加地形边界点列表
+        width: 地图宽度
+        height: 地图高度
+        resolution: 网格分辨率（每个方向的格点数）
+        tile_size: 分块边长（格点数）
+        filename: 输出的 .npy 文件路径，为空时使用临时文件（由调用方负责删除）
+        rng: numpy随机数生成器或种子，为空时新建一个
+        feature_cutoff: 地形特征权重截断阈值，为0时在整个网格上求值
+        dtype: 高程数据类型（np.float64 或 np.float32）
+        noise_mode: 多尺度噪声的生成方式，见 ranmap_noise.NOISE_MODES
+        transition_width: 海岸过渡带宽度
+    
+    返回:
+        x, y, Z: 网格行列坐标（一维）和内存映射的高程数组
+    """
+    x = np.linspace(0, width, resolution).astype(dtype, copy=False)
+    y = np.linspace(0, height, resolution).astype(dtype, copy=False)
+    
+    if filename is None:
+        handle, filename = tempfile.mkstemp(suffix='.npy')
+        os.close(handle)
+    Z = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                  shape=(resolution, resolution))
+    
+    tiles = [(np.arange(row, min(row + tile_size, resolution)),
+              np.arange(col, min(col + tile_size, resolution)))
+             for row in range(0, resolution, tile_size)
+             for col in range(0, resolution, tile_size)]
+    
+    for plan in plan_terrain(main_boundary_points, small_boundary_points_list, rng, noise_mode):
+        plan = _plan_astype(plan, dtype)
         
-        # 简化等高线系统 - 减少等高线数量并取消高度标注
-        # 为丰富地形定义颜色渐变（8个层次）
-        colors = ['#1E90FF', '#228B22', '#32CD32', '#9ACD32',  # 蓝色海洋到绿色平原
-                  '#DAA520', '#CD853F', '#8B4513', '#FFFFFF']   # 黄土地到棕色山地到白色雪顶
+        # 第一遍：求归一化所需的全局极值
+        raw_min, raw_max = np.inf, -np.inf
+        for rows, cols in tiles:
+            X, Y = np.meshgrid(x[cols], y[rows])
+            raw = _raw_elevation(plan, X, Y, rows, cols, resolution, feature_cutoff)
+            raw_min = min(raw_min, raw.min())
+            raw_max = max(raw_max, raw.max())
         
-        # 简化的等高线数量（从15减少到8）
-        simple_levels = 8
+        # 第二遍：逐块完成高程计算并合并到输出
+        for rows, cols in tiles:
+            X, Y = np.meshgrid(x[cols], y[rows])
+            map_mask = rasterize_polygon(plan['points'], x[cols], y[rows])
+            raw = _raw_elevation(plan, X, Y, rows, cols, resolution, feature_cutoff)
+            elevation = _finish_elevation(plan, raw, raw_min, raw_max, X, Y, map_mask,
+                                          rows, cols, resolution, transition_width)
+            window = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+            np.maximum(Z[window], elevation, out=Z[window])
+    
+    Z.flush()
+    return x, y, Z
+
+def new_seed():
+    """
+    生成一个新的随机种子，用于记录并复现地图
+    
+    返回:
+        63位非负整数种子
+    """
+    return int(np.random.SeedSequence().generate_state(1, np.uint64)[0] >> np.uint64(1))
+
+# 可选的渲染器：matplotlib 等高线填充，或不创建Figure的快速栅格渲染
+RENDERERS = ('matplotlib', 'raster')
+
+class GenerationCancelled(Exception):
+    """生成在阶段之间被取消"""
+
+def draw_terrain(ax, X, Y, Z, land_mask, width=100, height=100,
+                 colors=ranmap_render.HYPSOMETRIC_COLORS, contours=True):
+    """
+    在给定的坐标轴上绘制分层设色和等高线
+    
+    参数:
+        ax: matplotlib坐标轴
+        X, Y, Z, land_mask: 网格坐标、高程和陆地掩码
+        width, height: 地图宽度和高度
+        colors: 分层颜色，分层数等于颜色数
+        contours: 是否绘制等高线
+    """
+    # 设置背景为深蓝色（海洋）
+    ax.set_facecolor(ranmap_render.OCEAN_COLOR)
+    
+    # 不绘制等高线轮廓线，只显示填充区域
+    
+    # 简化等高线系统 - 减少等高线数量并取消高度标注
+    # 为丰富地形定义颜色渐变（默认8个层次：蓝色海洋到绿色平原，黄土地到棕色山地到白色雪顶）
+    colors = list(colors)
+    
+    # 简化的等高线数量（从15减少到8）
+    simple_levels = len(colors)
+    
+    # 使用高程阶段计算好的陆地掩码，确保等高线完全闭合在岛屿边界内
+    Z_masked = np.ma.array(Z, mask=~land_mask)
+    
+    with ranmap_trace.span('contour'):
+        # 绘制等高线填充和轮廓线
+        ax.contourf(X, Y, Z_masked, levels=simple_levels, colors=colors,
+                    alpha=ranmap_render.BAND_ALPHA)
         
-        # 使用mask确保等高线只在岛屿区域内显示
-        from matplotlib.path import Path as MPath
+        # 绘制等高线轮廓线但不标注高度
+        if contours:
+            ax.contour(X, Y, Z_masked, levels=simple_levels, colors=ranmap_render.CONTOUR_COLOR,
+                       linewidths=0.8, alpha=ranmap_render.CONTOUR_ALPHA)
+    
+    # 不绘制岛屿外框线，让等高线自然显示地形
+    
+    # 设置坐标轴范围
+    ax.set_xlim(0, width)
+    ax.set_ylim(0, height)
+    
+    # 设置坐标轴比例相等
+    ax.set_aspect('equal')
+    
+    # 移除坐标轴
+    ax.set_xticks([])
+    ax.set_yticks([])
+    
+    # 不显示标题
+    ax.set_title('')
+
+def render_terrain(X, Y, Z, land_mask, width=100, height=100, renderer='matplotlib', size=None,
+                   dpi=150, format='png', encode_options=None,
+                   colors=ranmap_render.HYPSOMETRIC_COLORS, contours=True):
+    """
+    将高程数据渲染并编码为图像
+    
+    参数:
+        X, Y, Z, land_mask: 网格坐标、高程和陆地掩码
+        width, height: 地图宽度和高度
+        renderer: RENDERERS 之一
+        size: 栅格渲染器输出图像较长边的像素数
+        dpi: matplotlib渲染器的输出分辨率
+        format: ranmap_encode.IMAGE_FORMATS 之一，'png8' 为8位调色板PNG；
+                matplotlib渲染器还可以输出 ranmap_encode.VECTOR_FORMATS 中的矢量格式
+        encode_options: 传给 ranmap_encode.encode_image 的参数字典
+            （compress_level、png_filter、strategy、quality、lossless）
+        colors: 分层颜色
+        contours: 是否绘制等高线
+    
+    返回:
+        编码后的字节串
+    """
+    if renderer == 'raster':
+        if format in ranmap_encode.VECTOR_FORMATS:
+            raise ValueError(f"栅格渲染器不支持矢量格式: {format}")
+        if format == 'png' and not encode_options:
+            return ranmap_render.render_png(Z, land_mask, width, height, size,
+                                            colors=colors, contours=contours)
+        return ranmap_render.render_image(Z, land_mask, width, height, size, format,
+                                          encode_options, colors=colors, contours=contours)
+    if renderer != 'matplotlib':
+        raise ValueError(f"未知的渲染器: {renderer}")
+    
+    # 使用图形池中的图形，不经过pyplot，可在多个线程中同时渲染
+    with ranmap_figure.FIGURE_POOL.figure() as (fig, ax):
+        draw_terrain(ax, X, Y, Z, land_mask, width, height, colors, contours)
+        if format in ranmap_encode.VECTOR_FORMATS or (format == 'png' and not encode_options):
+            buffer = io.BytesIO()
+            with ranmap_trace.span('png_encode' if format == 'png' else 'savefig'):
+                fig.savefig(buffer, format=format.upper(), dpi=dpi, bbox_inches='tight',
+                            facecolor='white', edgecolor='none')
+            return buffer.getvalue()
+        # 其他格式直接取画布像素编码，不经过matplotlib的PNG编码
+        image = ranmap_figure.figure_to_rgb(fig, dpi)
+    return ranmap_encode.encode_image(image, format, **(encode_options or {}))
+
+class mapMapGenerator:
+    def __init__(self, width=100, height=100, num_points=80, resolution=REFERENCE_RESOLUTION,
+                 seed=None, renderer='matplotlib', dtype=np.float64, noise_mode=NOISE_MODE,
+                 cancel_check=None, pipeline=None):
+        if renderer not in RENDERERS:
+            raise ValueError(f"未知的渲染器: {renderer}")
+        self.width = width
+        self.height = height
+        self.num_points = num_points
+        self.resolution = resolution
+        # 指定种子时每次生成相同的地图；为空时每次使用新种子
+        self.seed = seed
+        # 最近一次生成所用的种子，可用于复现该地图
+        self.last_seed = None
+        self.renderer = renderer
+        # 高程数据类型，np.float32 可减少内存占用
+        self.dtype = dtype
+        self.noise_mode = noise_mode
+        # 无参数的函数，在生成阶段之间调用，返回True时抛出 GenerationCancelled
+        self.cancel_check = cancel_check
+        # 分阶段生成流水线（ranmap_pipeline.MapPipeline），缓存各阶段的结果，
+        # 修改渲染参数或分辨率后再次生成同一种子时只重新计算受影响的阶段；
+        # 为空时使用该生成器自己的流水线，多个生成器可以共享一个流水线
+        if pipeline is None:
+            # 延迟导入：ranmap_pipeline 依赖本模块
+            from ranmap_pipeline import MapPipeline
+            pipeline = MapPipeline()
+        self.pipeline = pipeline
+        self.last_elevation = None
+        self.fig = None
+        self.ax = None
+        self.canvas = None
         
-        # 创建岛屿边界路径
-        map_path = MPath(main_points)
+    def _checkpoint(self):
+        if self.cancel_check is not None and self.cancel_check():
+            raise GenerationCancelled('生成已取消')
         
-        # 创建mask数组，确保等高线完全闭合在岛屿边界内
-        x_flat = X.flatten()
-        y_flat = Y.flatten()
-        points = np.column_stack((x_flat, y_flat))
-        mask = ~map_path.contains_points(points).reshape(X.shape)
+    @ranmap_trace.traced('terrain')
+    def generate_terrain(self, copy=True):
+        """
+        生成地形数据（不涉及渲染）
         
-        # 应用mask，确保等高线闭合
-        Z_masked = np.ma.array(Z, mask=mask)
+        参数:
+            copy: 是否返回数组的副本。为False时 X、Y、Z、land_mask 直接引用流水线缓存中的数组，
+                  或（流水线不缓存时）当前线程生成上下文的工作区，后者在下一次生成时会被覆盖；
+                  修改它们会影响之后生成的地图，只适合用完即弃的内部调用（渲染、批量生成）
         
-        # 绘制等高线填充和轮廓线
-        contourf = self.ax.contourf(X, Y, Z_masked, levels=simple_levels, 
-                                    colors=colors, alpha=0.7)
+        返回:
+            main_points, small_terrain_list, X, Y, Z, land_mask
+        """
+        result = self._run('elevation')
+        X, Y, Z, land_mask = result['X'], result['Y'], result['Z'], result['land_mask']
+        if copy:
+            X, Y, Z, land_mask = (array.copy() for array in (X, Y, Z, land_mask))
+        return result['points'], result['small_terrain'], X, Y, Z, land_mask
+    
+    def _run(self, until, **options):
+        """
+        用当前参数运行流水线到指定阶段，返回 MapPipeline.run 的结果
+        """
+        # 整个生成流程由种子确定，与各阶段是否命中缓存无关
+        self.last_seed = self.seed if self.seed is not None else new_seed()
+        result = self.pipeline.run(self.last_seed, until, self._checkpoint, width=self.width,
+                                   height=self.height, num_points=self.num_points,
+                                   resolution=self.resolution, dtype=self.dtype,
+                                   noise_mode=self.noise_mode, **options)
+        # 保留最近一次的高程数据，供渲染后仍需要原始数组的调用方（如批量生成）使用；
+        # 数组可能属于当前线程的生成上下文，下一次生成时会被覆盖
+        self.last_elevation = (result['Z'], result['land_mask'])
+        return result
+    
+    def render_png(self, size=None, dpi=150):
+        """
+        生成地图并编码为PNG，使用构造时选择的渲染器
         
-        # 绘制等高线轮廓线但不标注高度
-        self.ax.contour(X, Y, Z_masked, levels=simple_levels, 
-                       colors='#654321', linewidths=0.8, alpha=0.6)
+        参数:
+            size: 栅格渲染器输出图像较长边的像素数
+            dpi: matplotlib渲染器的输出分辨率
         
-        # 不绘制岛屿外框线，让等高线自然显示地形
+        返回:
+            png_data, main_points, small_terrain_list
+        """
+        return self.render_image(size, dpi)
+    
+    def render_image(self, size=None, dpi=150, format='png', encode_options=None):
+        """
+        生成地图并编码为指定格式，使用构造时选择的渲染器
         
-        # 设置坐标轴范围
-        self.ax.set_xlim(0, self.width)
-        self.ax.set_ylim(0, self.height)
+        参数:
+            size: 栅格渲染器输出图像较长边的像素数
+            dpi: matplotlib渲染器的输出分辨率
+            format: ranmap_encode.IMAGE_FORMATS 之一，'png8' 为8位调色板PNG；
+                    matplotlib渲染器还可以输出 ranmap_encode.VECTOR_FORMATS 中的矢量格式
+            encode_options: 传给 ranmap_encode.encode_image 的参数字典
+                （compress_level、png_filter、strategy、quality、lossless）
         
-        # 设置坐标轴比例相等
-        self.ax.set_aspect('equal')
+        返回:
+            image_data, main_points, small_terrain_list
+        """
+        result = self._run('render', renderer=self.renderer, size=size, dpi=dpi, format=format,
+                           encode_options=encode_options)
+        return result['png'], result['points'], result['small_terrain']
+    
+    @ranmap_trace.traced('generate_map')
+    def generate_map(self, fig=None, ax=None):
+        """
+        生成完整的地形地图
         
-        # 移除坐标轴
-        self.ax.set_xticks([])
-        self.ax.set_yticks([])
+        参数:
+            fig, ax: 绘制用的图形和坐标轴，为空时新建一个不经过pyplot的图形
         
-        # 彻底清除所有标题和文本
-        self.ax.set_title('')
-        plt.title('')
-        self.fig.suptitle('')
+        返回:
+            fig, ax, main_points, small_terrain_list
+        """
+        if fig is None:
+            fig, ax = ranmap_figure.new_figure()
+        self.fig, self.ax = fig, ax
         
-        # 强制清除所有可能的文本元素（更保守的方法）
+        # 如果是交互模式，设置键盘事件
         try:
-            # 只清除文本对象，不删除其他必要的子元素
-            for txt in self.ax.texts[:]:
-                txt.remove()
-            for txt in self.fig.texts[:]:
-                txt.remove()
-            # 不清除艺术家对象和子元素，避免破坏图形结构
-        except Exception as text_remove_error:
-            print(f"清除文本时出错: {text_remove_error}")
-        
-        # 在tight_layout之前再次清除标题
-        self.ax.set_title('')
-        plt.title('')
-        self.fig.suptitle('')
-        
-        # 显示图形
-        # 不使用tight_layout，因为它在服务器端可能导致fig对象被破坏
-        if self.fig is not None:
-            self.fig.canvas.draw()
+            self.canvas = self.fig.canvas
+            self.canvas.mpl_connect('key_press_event', self.on_key_press)
+        except:
+            # 在非交互模式下（如服务器端）忽略键盘事件
+            pass
         
-        # 在tight_layout之后彻底清除所有标题和文本
-        if self.ax is not None:
-            self.ax.set_title('')
-        plt.title('')
-        if self.fig is not None:
-            self.fig.suptitle('')
+        main_points, small_terrain_list, X, Y, Z, land_mask = self.generate_terrain(copy=False)
+        draw_terrain(self.ax, X, Y, Z, land_mask, self.width, self.height)
         
-        # 再次强制清除所有可能的文本元素（更保守的方法）
-        try:
-            # 只清除文本对象，不删除其他必要的子元素
-            if self.ax is not None:
-                for txt in self.ax.texts[:]:
-                    txt.remove()
-            if self.fig is not None:
-                for txt in self.fig.texts[:]:
-                    txt.remove()
-            # 不清除艺术家对象和子元素，避免破坏图形结构
-        except Exception as text_remove_error:
-            print(f"最终清除文本时出错: {text_remove_error}")
+        with ranmap_trace.span('draw'):
+            self.fig.canvas.draw()
         
         return self.fig, self.ax, main_points, small_terrain_list
     
@@ -534,36 +1326,22 @@ class mapMapGenerator:
         """
         if event.key.lower() == 'r':
             print("重新生成地形地图...")
-            self.generate_map()
+            self.seed = None
+            ranmap_figure.reset_figure(self.fig, self.ax)
+            self.generate_map(self.fig, self.ax)
     
     def show(self):
         """
-        显示地图
+        在交互式窗口中显示地图（唯一使用pyplot的地方）
         """
-        self.generate_map()
-        # 在显示之前彻底清除所有标题和文本
-        if self.ax is not None:
-            self.ax.set_title('')
-        plt.title('')
-        if self.fig is not None:
-            self.fig.suptitle('')
-        
-        # 强制清除所有可能的文本元素（更保守的方法）
-        try:
-            # 只清除文本对象，不删除其他必要的子元素
-            if self.ax is not None:
-                for txt in self.ax.texts[:]:
-                    txt.remove()
-            if self.fig is not None:
-                for txt in self.fig.texts[:]:
-                    txt.remove()
-            # 不清除艺术家对象和子元素，避免破坏图形结构
-        except Exception as text_remove_error:
-            print(f"显示前清除文本时出错: {text_remove_error}")
+        import matplotlib.pyplot as plt
         
+        fig, ax = plt.subplots(1, 1, figsize=ranmap_figure.FIGURE_SIZE)
+        self.generate_map(fig, ax)
         plt.show()
 
-def create_map_map(width=100, height=100, num_points=80):
+def create_map_map(width=100, height=100, num_points=80, resolution=REFERENCE_RESOLUTION,
+                   seed=None):
     """
     创建地形地图（保持向后兼容）
     
@@ -571,11 +1349,15 @@ def create_map_map(width=100, height=100, num_points=80):
         width: 地图宽度
         height: 地图高度
         num_points: 地形边界点数
+        resolution: 高程网格分辨率
+        seed: 随机种子，相同的种子和参数生成相同的地图
     """
-    generator = mapMapGenerator(width, height, num_points)
+    generator = mapMapGenerator(width, height, num_points, resolution, seed)
     return generator.show()
 
-def save_map_map(filename='terrain_map.png', width=100, height=100, num_points=80):
+def save_map_map(filename='terrain_map.png', width=100, height=100, num_points=80,
+                 resolution=REFERENCE_RESOLUTION, seed=None, renderer='matplotlib',
+                 format=None, **encode_options):
     """
     保存地形地图为图片文件
     
@@ -584,34 +1366,25 @@ def save_map_map(filename='terrain_map.png', width=100, height=100, num_points=8
         width: 地图宽度
         height: 地图高度
         num_points: 地形边界点数
-    """
-    generator = mapMapGenerator(width, height, num_points)
-    fig, ax, main_points = generator.generate_map()
+        resolution: 高程网格分辨率
+        seed: 随机种子，相同的种子和参数生成相同的地图
+        renderer: 'matplotlib' 或快速栅格渲染器 'raster'
+        format: 输出格式（见 ranmap_encode.IMAGE_FORMATS，matplotlib渲染器还支持
+                ranmap_encode.VECTOR_FORMATS），为空时由文件扩展名推断，不支持的扩展名抛出ValueError
+        encode_options: 编码参数，如 compress_level、png_filter、strategy、quality
     
-    # 在保存之前彻底清除所有标题和文本
-    ax.set_title('')
-    plt.title('')
-    fig.suptitle('')
-    
-    # 强制清除所有可能的文本元素（更保守的方法）
-    try:
-        # 只清除文本对象，不删除其他必要的子元素
-        for txt in ax.texts[:]:
-            txt.remove()
-        for txt in fig.texts[:]:
-            txt.remove()
-        # 不清除艺术家对象和子元素，避免破坏图形结构
-    except Exception as text_remove_error:
-        print(f"保存前清除文本时出错: {text_remove_error}")
-    
-    # 在保存之前最后一次清除标题
-    ax.set_title('')
-    plt.title('')
-    fig.suptitle('')
-    
-    fig.savefig(filename, dpi=300, bbox_inches='tight')
-    plt.close(fig)
+    返回:
+        本次生成所用的种子
+    """
+    if format is None:
+        format = ranmap_encode.format_from_filename(filename)
+    generator = mapMapGenerator(width, height, num_points, resolution, seed, renderer)
+    image_data, main_points, small_terrain_list = generator.render_image(
+        dpi=300, format=format, encode_options=encode_options)
+    with open(filename, 'wb') as f:
+        f.write(image_data)
     print(f'地形地图已保存为: {filename}')
+    return generator.last_seed
 
 if __name__ == '__main__':
     # 生成并显示随机地形地图
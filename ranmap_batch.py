@@ -0,0 +1,150 @@
+"""
+批量地图生成
+
+generate_batch 将大量地图的生成分发到进程池中并行执行，
+结果按完成顺序以迭代器形式逐个返回，适合为数据集生成成千上万张地图。
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+
+# 每个结果可包含的输出内容
+BATCH_OUTPUTS = ('png', 'elevation', 'points', 'trace')
+
+# 每个工作进程同时排队的任务数，保证进程不空闲，同时不一次性提交全部任务
+TASKS_PER_WORKER = 4
+
+def batch_seeds(count, seed=None):
+    """
+    由一个基础种子派生出 count 个互不相同的地图种子
+
+    参数:
+        count: 种子数量
+        seed: 基础种子，为空时随机；相同的基础种子总是得到相同的种子序列
+
+    返回:
+        63位非负整数种子列表
+    """
+    state = np.random.SeedSequence(seed).generate_state(count, np.uint64)
+    return [int(s >> np.uint64(1)) for s in state]
+
+# 工作进程中与主进程共享的取消标志（multiprocessing.Array），由 init_worker 设置
+_cancel_flags = None
+
+def init_worker(cancel_flags=None):
+    """
+    工作进程初始化：预先导入生成模块，使导入开销只在每个进程启动时付出一次
+    （渲染不经过pyplot，无需切换后端）
+
+    参数:
+        cancel_flags: 共享的取消标志数组，generate_one 的 cancel_slot 为其下标
+    """
+    global _cancel_flags
+    _cancel_flags = cancel_flags
+    import ranmap  # noqa: F401
+
+def generate_one(seed, params=None, outputs=('png',), render_options=None, cancel_slot=None):
+    """
+    用给定种子生成一张地图
+
+    参数:
+        seed: 地图种子
+        params: 传给 mapMapGenerator 的参数字典（width、height、num_points、resolution、renderer）
+        outputs: 需要返回的内容，取自 BATCH_OUTPUTS
+        render_options: 传给 mapMapGenerator.render_image 的参数字典（size、dpi、format、encode_options）
+        cancel_slot: 取消标志的下标，标志被置位时在下一个生成阶段之间抛出 GenerationCancelled
+
+    返回:
+        result: 字典，总是包含 'seed'，按 outputs 包含
+                'png'（编码后的图像字节，格式由 render_options 的 format 决定，默认PNG）、
+                'elevation' 与 'land_mask'（数组）、
+                'points' 与 'small_terrain'（边界点）、
+                'trace'（本次生成记录的追踪事件，见 ranmap_trace.collect；
+                工作进程尚未启用追踪时随之启用）
+    """
+    import ranmap_trace
+
+    if 'trace' not in outputs:
+        return _generate_one(seed, params, outputs, render_options, cancel_slot)
+    if not ranmap_trace.is_enabled():
+        ranmap_trace.enable()
+    with ranmap_trace.collect() as recorded:
+        result = _generate_one(seed, params, outputs, render_options, cancel_slot)
+    result['trace'] = recorded
+    return result
+
+def _generate_one(seed, params, outputs, render_options, cancel_slot):
+    from ranmap import mapMapGenerator
+    from ranmap_pipeline import MapPipeline
+
+    cancel_check = None
+    if cancel_slot is not None and _cancel_flags is not None:
+        cancel_check = lambda: _cancel_flags[cancel_slot] != 0
+
+    # 每张地图使用不同的种子，阶段缓存不会命中；不缓存时高程直接使用工作进程的生成上下文
+    generator = mapMapGenerator(seed=seed, cancel_check=cancel_check,
+                                pipeline=MapPipeline(max_bytes=0), **(params or {}))
+    if 'png' in outputs:
+        png_data, main_points, small_terrain_list = generator.render_image(**(render_options or {}))
+    else:
+        main_points, small_terrain_list = generator.generate_terrain(copy=False)[:2]
+
+    result = {'seed': generator.last_seed}
+    if 'png' in outputs:
+        result['png'] = png_data
+    if 'elevation' in outputs:
+        # 高程数组属于生成上下文的工作区，复制后再返回
+        result['elevation'], result['land_mask'] = (array.copy() for array in generator.last_elevation)
+    if 'points' in outputs:
+        result['points'] = main_points
+        result['small_terrain'] = small_terrain_list
+    return result
+
+def generate_batch(count_or_seeds, params=None, workers=None, outputs=('png',), seed=None):
+    """
+    并行生成一批地图，按完成顺序逐个产出结果
+
+    参数:
+        count_or_seeds: 地图数量（由 seed 派生种子），或显式的种子序列
+        params: 传给 mapMapGenerator 的参数字典，所有地图共用
+        workers: 工作进程数，为空时使用CPU核数；为1时在当前进程内顺序生成
+        outputs: 每个结果需要包含的内容，取自 BATCH_OUTPUTS
+        seed: count_or_seeds 为数量时用于派生种子的基础种子
+
+    返回:
+        迭代器，每项为 generate_one 返回的结果字典
+    """
+    unknown = set(outputs) - set(BATCH_OUTPUTS)
+    if unknown:
+        raise ValueError(f"未知的输出内容: {sorted(unknown)}")
+
+    if isinstance(count_or_seeds, (int, np.integer)):
+        seeds = batch_seeds(int(count_or_seeds), seed)
+    else:
+        seeds = [int(s) for s in count_or_seeds]
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        init_worker()
+        for map_seed in seeds:
+            yield generate_one(map_seed, params, outputs)
+        return
+
+    pending_seeds = iter(seeds)
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        running = set()
+
+        def submit_more():
+            while len(running) < workers * TASKS_PER_WORKER:
+                map_seed = next(pending_seeds, None)
+                if map_seed is None:
+                    return
+                running.add(executor.submit(generate_one, map_seed, params, outputs))
+
+        submit_more()
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            submit_more()
+            for future in done:
+                yield future.result()
@@ -0,0 +1,299 @@
+"""
+生成器与服务器的性能和内存回归基准
+
+用法:
+    python ranmap_bench.py run [-o baseline.json] [--repeat N] [--quick] [-k 关键字]
+    python ranmap_bench.py compare baseline.json [--current current.json] [--threshold 0.2]
+
+run 运行全部基准并把每项的墙钟时间、tracemalloc峰值和进程RSS写入JSON；
+compare 将当前结果（现场运行或读取 --current 文件）与基线比较，
+任一指标超过阈值或基线中的基准在当前结果中缺失即以非零状态退出，便于在CI中拦截性能回归。
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+
+import ranmap
+import ranmap_encode
+import ranmap_render
+
+# 参与比较的指标，以及低于该绝对差值的变化视为噪声。
+# rss_mb 是运行完该基准时整个进程的RSS，受之前运行的基准和 -k 的影响，只记录不比较
+COMPARED_METRICS = {
+    'wall_s': 0.002,
+    'peak_alloc_mb': 0.5,
+}
+
+DEFAULT_THRESHOLD = 0.2
+
+# 等待基准用服务器启动（含预生成第一张地图）的最长时间（秒）
+SERVER_START_TIMEOUT = 60
+
+def _rss_mb():
+    """
+    当前进程的常驻内存（MB），无法获取时返回None
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 2**20
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def _features_plan(points, feature_count, seed):
+    """
+    构造恰好包含 feature_count 个地形特征的地形规划
+    """
+    rng = np.random.default_rng(seed)
+    features = []
+    while len(features) < feature_count:
+        max_elevation, more = ranmap.plan_features(points, 'main', rng)
+        features.extend(more)
+    lattice_shape = (ranmap.REFERENCE_RESOLUTION, ranmap.REFERENCE_RESOLUTION)
+    return [{
+        'points': points,
+        'combined_noise': ranmap.plan_noise(rng),
+        'features': features[:feature_count],
+        'max_elevation': max_elevation,
+        'random_variation': rng.normal(0, max_elevation * 0.05, lattice_shape),
+    }]
+
+def _server_round_trip(renderer, cached=False):
+    """
+    启动本地服务器并测量一次 generate 请求的往返，返回基准函数和清理函数
+
+    每次请求使用新的种子，测量包含排队、生成、编码和传输的完整往返；
+    cached 为真时总是请求同一种子，预热之后每次都命中服务器的渲染缓存。
+    """
+    from ranmap_client import MapConnection
+    from ranmap_server import RandomMapServer
+
+    # 不预生成储备池，避免后台生成与计时的请求争用工作进程
+    server = RandomMapServer(port=0, renderer=renderer, reservoir_depth=0)
+    thread = threading.Thread(target=server.start, daemon=True)
+    thread.start()
+    # 等待启动时预生成的第一张地图完成；start() 不抛出启动失败，以线程是否结束判断
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while not (server.running and server._pregenerate is not None and server._pregenerate.done()):
+        if not thread.is_alive():
+            raise RuntimeError('基准服务器启动失败')
+        if time.monotonic() > deadline:
+            server.stop()
+            raise RuntimeError(f'基准服务器在 {SERVER_START_TIMEOUT} 秒内没有就绪')
+        time.sleep(0.01)
+    # 与GUI相同，所有请求共用一条持久连接
+    connection = MapConnection(port=server.server_socket.getsockname()[1])
+    seeds = itertools.repeat(1) if cached else itertools.count(1)
+
+    def request():
+        response, _ = connection.request({'command': 'generate', 'seed': next(seeds)}, timeout=60)
+        if response.get('status') != 'success':
+            raise RuntimeError(f"服务器请求失败: {response.get('message')}")
+
+    def cleanup():
+        connection.close()
+        server.stop()
+
+    return request, cleanup
+
+def benchmarks(quick=False):
+    """
+    返回 (名称, 准备函数) 列表，准备函数返回 (基准函数, 清理函数或None)
+    """
+    points = ranmap.generate_complex_map(rng=1)
+    resolutions = (100, 400) if quick else (100, 400, 1000)
+    num_points_list = (80, 400) if quick else (80, 400, 2000)
+    feature_counts = (4, 16) if quick else (4, 16, 64)
+    image_size = 512 if quick else 1024
+
+    cases = []
+    for num_points in num_points_list:
+        cases.append((f'coastline[num_points={num_points}]',
+                      lambda n=num_points: (lambda: ranmap.generate_complex_map(num_points=n, rng=1), None)))
+    for resolution in resolutions:
+        cases.append((f'elevation[resolution={resolution}]',
+                      lambda r=resolution: (lambda: ranmap.generate_elevation_data(
+                          points, [], 100, 100, resolution=r, rng=1), None)))
+    def elevation_features(feature_count):
+        plans = _features_plan(points, feature_count, 1)
+        return lambda: ranmap.generate_elevation_data(points, [], 100, 100, resolution=400,
+                                                      plans=plans), None
+    for feature_count in feature_counts:
+        cases.append((f'elevation[features={feature_count}]',
+                      lambda f=feature_count: elevation_features(f)))
+    for renderer in ranmap.RENDERERS:
+        cases.append((f'render[{renderer}]',
+                      lambda name=renderer: (lambda: ranmap.mapMapGenerator(
+                          seed=1, renderer=name).render_png(), None)))
+
+    def raster_only():
+        X, Y, Z, land_mask = ranmap.generate_elevation_data(points, [], 100, 100, return_mask=True, rng=1)
+        return lambda: ranmap_render.render_indexed(Z, land_mask, size=image_size), None
+    cases.append(('raster_only', raster_only))
+
+    def png_encode():
+        image = ranmap_render.render_rgb(*ranmap.generate_elevation_data(
+            points, [], 100, 100, return_mask=True, rng=1)[2:], size=image_size)
+        return lambda: ranmap_render.encode_png(image), None
+    cases.append(('png_encode', png_encode))
+
+    def encode(format):
+        indices, palette = ranmap_render.render_indexed(*ranmap.generate_elevation_data(
+            points, [], 100, 100, return_mask=True, rng=1)[2:], size=image_size)
+        return lambda: ranmap_encode.encode_image(indices, format, palette=palette), None
+    for format in ranmap_encode.available_formats():
+        cases.append((f'encode[{format}]', lambda f=format: encode(f)))
+
+    for renderer in ranmap.RENDERERS:
+        cases.append((f'server_round_trip[{renderer}]',
+                      lambda name=renderer: _server_round_trip(name)))
+    cases.append(('server_cache_hit', lambda: _server_round_trip('matplotlib', cached=True)))
+    return cases
+
+def measure(function, repeat):
+    """
+    测量一个基准：先预热一次，再计时 repeat 次，最后在 tracemalloc 下运行一次求分配峰值
+    """
+    function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'wall_s': statistics.median(times),
+        'wall_min_s': min(times),
+        'peak_alloc_mb': peak / 2**20,
+        'rss_mb': _rss_mb(),
+    }
+
+def run_suite(repeat=5, quick=False, keyword=None):
+    """
+    运行基准，返回可写入JSON的结果字典
+    """
+    results = {}
+    for name, setup in benchmarks(quick):
+        if keyword and keyword not in name:
+            continue
+        function, cleanup = setup()
+        try:
+            results[name] = measure(function, repeat)
+        finally:
+            if cleanup is not None:
+                cleanup()
+        metrics = results[name]
+        print(f"{name:<36}{metrics['wall_s'] * 1e3:>10.2f} ms{metrics['peak_alloc_mb']:>10.1f} MB",
+              flush=True)
+    return {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'repeat': repeat,
+            'quick': quick,
+        },
+        'results': results,
+    }
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD, keyword=None):
+    """
+    比较两次结果，返回 (报告行列表, 回归项列表)
+
+    基线中名称包含 keyword（为空时为全部）但当前结果中没有的基准（例如运行出错或被改名）
+    同样计为回归项，指标为 '(missing)'。
+    """
+    lines = [f"{'benchmark':<36}{'metric':<15}{'baseline':>12}{'current':>12}{'change':>10}"]
+    regressions = []
+    for name in sorted(baseline['results']):
+        if name not in current['results'] and (not keyword or keyword in name):
+            lines.append(f"{name:<36}{'(missing)':<15}{'':>34}  <-- 缺失")
+            regressions.append((name, '(missing)', None, None))
+    for name, metrics in sorted(current['results'].items()):
+        reference = baseline['results'].get(name)
+        if reference is None:
+            lines.append(f"{name:<36}{'(new)':<15}")
+            continue
+        for metric, noise_floor in COMPARED_METRICS.items():
+            old, new = reference.get(metric), metrics.get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old if old else 0.0
+            regressed = new - old > noise_floor and change > threshold
+            marker = '  <-- 回归' if regressed else ''
+            lines.append(f"{name:<36}{metric:<15}{old:>12.4f}{new:>12.4f}{change:>+10.1%}{marker}")
+            if regressed:
+                regressions.append((name, metric, old, new))
+    return lines, regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ranmap 性能与内存基准')
+    subparsers = parser.add_subparsers(dest='mode', required=True)
+
+    run_parser = subparsers.add_parser('run', help='运行基准并保存结果')
+    run_parser.add_argument('-o', '--output', default='bench_baseline.json', help='结果JSON文件')
+
+    compare_parser = subparsers.add_parser('compare', help='与基线比较，回归时返回非零状态')
+    compare_parser.add_argument('baseline', help='基线JSON文件')
+    compare_parser.add_argument('--current', help='当前结果JSON文件，为空时现场运行基准')
+    compare_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                                help='允许的相对增长（默认0.2，即20%%）')
+
+    for sub in (run_parser, compare_parser):
+        sub.add_argument('--repeat', type=int, default=5, help='每项计时次数')
+        sub.add_argument('--quick', action='store_true', help='使用较小的规模')
+        sub.add_argument('-k', '--keyword', help='只运行名称包含该关键字的基准')
+
+    args = parser.parse_args(argv)
+
+    if args.mode == 'run':
+        results = run_suite(args.repeat, args.quick, args.keyword)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f'基准结果已保存为: {args.output}')
+        return 0
+
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    if args.current:
+        with open(args.current, encoding='utf-8') as f:
+            current = json.load(f)
+    else:
+        current = run_suite(args.repeat, args.quick, args.keyword)
+
+    lines, regressions = compare(baseline, current, args.threshold, args.keyword)
+    print('\n'.join(lines))
+    if regressions:
+        missing = sum(1 for regression in regressions if regression[1] == '(missing)')
+        print(f'发现 {len(regressions) - missing} 项性能回归（阈值 {args.threshold:.0%}），'
+              f'{missing} 项基准缺失')
+        return 1
+    print('未发现性能回归')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+"""
+渲染结果的内存缓存
+
+按字节数限制容量的LRU缓存，保存编码好的地图（PNG等字节串），由服务器的所有连接共享。
+同一个键的并发请求只触发一次生成（single-flight），其余请求等待同一结果；
+所有等待的请求都取消后，进行中的生成也随之取消。
+缓存在 asyncio 事件循环中使用。
+"""
+import asyncio
+from collections import OrderedDict
+
+# 默认容量（字节）
+DEFAULT_MAX_BYTES = 64 << 20
+
+class RenderCache:
+    """
+    按字节预算淘汰的LRU缓存
+
+    参数:
+        max_bytes: 缓存值的总字节数上限，超过上限的单个值不缓存
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        # 键 -> [生成任务, 等待的请求数]
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+        # 等待其他请求正在进行的生成而未重复生成的次数
+        self.coalesced = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, key):
+        """
+        返回缓存的值并标记为最近使用，不存在时返回 None（不计入统计）
+        """
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """
+        存入一个字节串，按最近最少使用的顺序淘汰旧值直到总大小不超过预算
+        """
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self._entries[key] = value
+        self.size += size
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    async def get(self, key, factory):
+        """
+        取缓存的值，不存在时调用 factory() 生成并缓存
+
+        参数:
+            key: 可哈希的缓存键
+            factory: 无参数的协程函数，返回字节串，失败时返回 None（不缓存）
+
+        返回:
+            缓存或新生成的值
+        """
+        value = self.lookup(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        entry = self._inflight.get(key)
+        if entry is None:
+            self.misses += 1
+            entry = self._inflight[key] = [asyncio.ensure_future(self._fill(key, factory)), 0]
+        else:
+            self.coalesced += 1
+        task = entry[0]
+        entry[1] += 1
+        try:
+            # 某个请求被取消时不影响其他等待同一结果的请求
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            entry[1] -= 1
+            if entry[1] == 0 and not task.done():
+                # 之后的请求重新开始生成，而不是等待已取消的任务
+                if self._inflight.get(key) is entry:
+                    del self._inflight[key]
+                task.cancel()
+            raise
+
+    async def _fill(self, key, factory):
+        try:
+            value = await factory()
+        finally:
+            entry = self._inflight.get(key)
+            if entry is not None and entry[0] is asyncio.current_task():
+                del self._inflight[key]
+        if value is not None:
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'inflight': len(self._inflight),
+        }
@@ -0,0 +1,213 @@
+"""
+地图服务器的持久连接客户端
+
+MapConnection 保持一条二进制协议连接，所有请求共用：
+- 每个请求带递增的 'id'，可以不等响应继续发送（流水线），
+  接收线程按 'id' 把事件帧和响应帧分发给对应的请求；
+- 连接断开时在途的请求以异常结束，之后的请求重新连接，连接失败时按指数退避重试；
+- 连接和发送在后台线程中进行，submit 立即返回 Future，不会阻塞调用方（例如GUI线程）。
+"""
+import itertools
+import queue
+import socket
+import threading
+import time
+from concurrent.futures import Future
+
+import ranmap_protocol
+
+# 建立连接的超时（秒）
+CONNECT_TIMEOUT = 5
+
+# 重新连接的首次等待和最长等待（秒），每次失败后等待时间加倍
+RECONNECT_DELAY = 0.1
+MAX_RECONNECT_DELAY = 5.0
+
+# 放弃一个请求前尝试连接的次数
+CONNECT_ATTEMPTS = 6
+
+class _Connection:
+    """一条已建立的连接及其上等待响应的请求"""
+    def __init__(self, sock):
+        self.sock = sock
+        # 请求id -> (Future, on_event)
+        self.pending = {}
+        self.closed = False
+
+class MapConnection:
+    """
+    到地图服务器的持久连接，支持多个请求同时在途
+
+    参数:
+        host, port: 服务器地址
+        connect_timeout: 建立连接的超时（秒）
+        connect_attempts: 每个请求放弃前尝试连接的次数
+    """
+    def __init__(self, host='localhost', port=5000, connect_timeout=CONNECT_TIMEOUT,
+                 connect_attempts=CONNECT_ATTEMPTS):
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.connect_attempts = connect_attempts
+        self.connects = 0
+        self._ids = itertools.count(1)
+        self._outgoing = queue.Queue()
+        self._lock = threading.Lock()
+        self._connection = None
+        self._closed = False
+        self._sender = threading.Thread(target=self._send_loop, name='ranmap-client-send',
+                                        daemon=True)
+        self._sender.start()
+
+    def submit(self, header, payload=b'', on_event=None):
+        """
+        发送一个请求，不等待响应
+
+        参数:
+            header: 请求头部字典，'id' 由连接分配
+            on_event: 收到该请求的中间事件帧时调用 on_event(header, payload)（在接收线程中）
+
+        返回:
+            concurrent.futures.Future，结果为最终响应的 (header, payload)；
+            连接失败或断开时为相应的异常
+        """
+        if self._closed:
+            raise ConnectionError('连接已关闭')
+        future = Future()
+        header = dict(header, id=next(self._ids))
+        header.setdefault('accept_encoding', ranmap_protocol.available_encodings())
+        self._outgoing.put((header, payload, future, on_event))
+        return future
+
+    def request(self, header, payload=b'', on_event=None, timeout=None):
+        """
+        发送请求并等待最终响应
+
+        返回:
+            (header, payload)
+        """
+        return self.submit(header, payload, on_event).result(timeout)
+
+    def close(self):
+        """关闭连接，在途和尚未发送的请求以 ConnectionError 结束"""
+        self._closed = True
+        self._outgoing.put(None)
+        connection = self._connection
+        if connection is not None:
+            self._drop(connection, ConnectionError('连接已关闭'))
+
+    def _send_loop(self):
+        while True:
+            item = self._outgoing.get()
+            if item is None:
+                break
+            header, payload, future, on_event = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                self._send(header, payload, future, on_event)
+            except Exception as e:
+                future.set_exception(e)
+        # 关闭后仍在队列中的请求
+        while True:
+            try:
+                item = self._outgoing.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None and item[2].set_running_or_notify_cancel():
+                item[2].set_exception(ConnectionError('连接已关闭'))
+
+    def _send(self, header, payload, future, on_event):
+        # 空闲时被服务器关闭的连接要到发送时才发现，此时换一条新连接重发一次
+        for attempt in range(2):
+            connection = self._ensure_connected()
+            with self._lock:
+                if connection.closed:
+                    continue
+                connection.pending[header['id']] = (future, on_event)
+            try:
+                ranmap_protocol.send_frame(connection.sock, header, payload)
+                return
+            except OSError as e:
+                with self._lock:
+                    connection.pending.pop(header['id'], None)
+                self._drop(connection, e)
+                if attempt:
+                    raise
+        raise ConnectionError('连接已断开')
+
+    def _ensure_connected(self):
+        connection = self._connection
+        if connection is not None and not connection.closed:
+            return connection
+        delay = RECONNECT_DELAY
+        for attempt in range(self.connect_attempts):
+            if self._closed:
+                raise ConnectionError('连接已关闭')
+            try:
+                sock = socket.create_connection((self.host, self.port), self.connect_timeout)
+                break
+            except OSError:
+                if attempt + 1 == self.connect_attempts:
+                    raise
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+        # 响应的等待时间取决于生成耗时，连接建立后不再设置超时
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = _Connection(sock)
+        self._connection = connection
+        self.connects += 1
+        threading.Thread(target=self._receive_loop, args=(connection,),
+                         name='ranmap-client-receive', daemon=True).start()
+        return connection
+
+    def _receive_loop(self, connection):
+        error = ConnectionError('连接已关闭')
+        try:
+            while True:
+                header, payload = ranmap_protocol.recv_frame(connection.sock)
+                request_id = header.get('id')
+                if request_id is None:
+                    if 'event' not in header and header.get('status') == 'error':
+                        # 协议错误，服务器随后关闭连接
+                        error = ranmap_protocol.ProtocolError(header.get('message', '协议错误'))
+                        return
+                    continue
+                with self._lock:
+                    entry = connection.pending.get(request_id)
+                    if entry is not None and 'event' not in header:
+                        del connection.pending[request_id]
+                if entry is None:
+                    continue
+                future, on_event = entry
+                if 'event' not in header:
+                    future.set_result((header, payload))
+                elif on_event is not None:
+                    try:
+                        on_event(header, payload)
+                    except Exception as e:
+                        # 回调出错不影响同一连接上的其他请求
+                        print(f"处理事件帧时出错: {e}")
+        except (OSError, ranmap_protocol.ProtocolError) as e:
+            error = e
+        finally:
+            self._drop(connection, error)
+
+    def _drop(self, connection, error):
+        with self._lock:
+            if connection.closed:
+                return
+            connection.closed = True
+            if self._connection is connection:
+                self._connection = None
+            pending, connection.pending = connection.pending, {}
+        try:
+            # shutdown 唤醒阻塞在 recv 上的接收线程
+            connection.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        connection.sock.close()
+        for future, _ in pending.values():
+            if not future.done():
+                future.set_exception(error)
@@ -0,0 +1,337 @@
+"""
+地图图像的编码输出
+
+支持的格式：
+    png    真彩色PNG，可选择每行的过滤方式和zlib压缩级别、策略
+    png8   8位调色板PNG，地图只有少量颜色时体积远小于真彩色
+    qoi    QOI格式，编码和解码都很快，体积介于两种PNG之间
+    webp   WebP（需要Pillow）
+    jpeg   JPEG（需要Pillow，有损）
+
+PNG和QOI只使用numpy和标准库；WebP和JPEG在没有安装Pillow时不可用。
+矢量格式（VECTOR_FORMATS）不经过本模块，由matplotlib渲染器的 savefig 直接输出。
+"""
+import struct
+import zlib
+
+import numpy as np
+
+import ranmap_trace
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+IMAGE_FORMATS = ('png', 'png8', 'qoi', 'webp', 'jpeg')
+
+CONTENT_TYPES = {
+    'png': 'image/png',
+    'png8': 'image/png',
+    'qoi': 'image/qoi',
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg',
+}
+
+FILE_EXTENSIONS = {
+    'png': '.png',
+    'png8': '.png',
+    'qoi': '.qoi',
+    'webp': '.webp',
+    'jpeg': '.jpg',
+}
+
+# 只能由matplotlib渲染器通过 savefig 输出的矢量格式
+VECTOR_FORMATS = ('pdf', 'svg', 'eps', 'ps')
+
+# PNG行过滤方式，'adaptive' 为每行选择使绝对值之和最小的过滤方式
+PNG_FILTERS = ('none', 'sub', 'up', 'average', 'paeth', 'adaptive')
+
+# zlib压缩策略
+ZLIB_STRATEGIES = {
+    'default': zlib.Z_DEFAULT_STRATEGY,
+    'filtered': zlib.Z_FILTERED,
+    'huffman': zlib.Z_HUFFMAN_ONLY,
+    'rle': getattr(zlib, 'Z_RLE', 3),
+    'fixed': getattr(zlib, 'Z_FIXED', 4),
+}
+
+def available_formats():
+    """
+    当前环境可用的输出格式
+    """
+    return tuple(f for f in IMAGE_FORMATS if f not in ('webp', 'jpeg') or Image is not None)
+
+def format_from_filename(filename, default='png'):
+    """
+    由文件扩展名推断输出格式（IMAGE_FORMATS 或 VECTOR_FORMATS 之一），没有扩展名时返回 default
+
+    异常:
+        ValueError: 不支持的扩展名
+    """
+    name = filename.replace('\\', '/').rsplit('/', 1)[-1]
+    if '.' not in name:
+        return default
+    extension = name.rsplit('.', 1)[-1].lower()
+    if extension == 'jpeg':
+        return 'jpeg'
+    if extension in VECTOR_FORMATS:
+        return extension
+    for format, known in FILE_EXTENSIONS.items():
+        if format != 'png8' and known == '.' + extension:
+            return format
+    raise ValueError(f"不支持的文件扩展名: .{extension}")
+
+def _png_chunk(chunk_type, data):
+    """
+    构造一个PNG数据块
+    """
+    return (struct.pack('>I', len(data)) + chunk_type + data +
+            struct.pack('>I', zlib.crc32(chunk_type + data) & 0xFFFFFFFF))
+
+def _paeth(a, b, c):
+    p = a + b - c
+    pa, pb, pc = np.abs(p - a), np.abs(p - b), np.abs(p - c)
+    return np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+
+def filter_rows(rows, bpp, method='none'):
+    """
+    对PNG扫描行应用过滤
+
+    参数:
+        rows: 形状为 (h, 行字节数) 的uint8数组
+        bpp: 每像素字节数
+        method: PNG_FILTERS 之一
+
+    返回:
+        形状为 (h, 行字节数 + 1) 的uint8数组，每行首字节为过滤类型
+    """
+    if method not in PNG_FILTERS:
+        raise ValueError(f"未知的PNG过滤方式: {method}")
+    h, stride = rows.shape
+    out = np.empty((h, stride + 1), dtype=np.uint8)
+    if method == 'none':
+        out[:, 0] = 0
+        out[:, 1:] = rows
+        return out
+
+    # 过滤使用原始字节（而非解码后的字节），整张图像可以一次向量化计算
+    x = rows.astype(np.int16)
+    left = np.zeros_like(x)
+    left[:, bpp:] = x[:, :-bpp]
+    up = np.zeros_like(x)
+    up[1:] = x[:-1]
+    upper_left = np.zeros_like(x)
+    upper_left[1:, bpp:] = x[:-1, :-bpp]
+    predictors = {
+        'sub': (1, left),
+        'up': (2, up),
+        'average': (3, (left + up) >> 1),
+        'paeth': (4, _paeth(left, up, upper_left)),
+    }
+    if method != 'adaptive':
+        kind, predicted = predictors[method]
+        out[:, 0] = kind
+        out[:, 1:] = (x - predicted).astype(np.uint8)
+        return out
+
+    candidates = [np.zeros_like(x)] + [predicted for _, predicted in predictors.values()]
+    filtered = np.stack([(x - p).astype(np.uint8) for p in candidates])
+    # 以有符号字节绝对值之和作为每行的代价
+    cost = np.abs(filtered.view(np.int8).astype(np.int32)).sum(axis=2)
+    best = cost.argmin(axis=0)
+    out[:, 0] = best
+    out[:, 1:] = filtered[best, np.arange(h)]
+    return out
+
+def _compress(data, compress_level, strategy):
+    if strategy not in ZLIB_STRATEGIES:
+        raise ValueError(f"未知的zlib压缩策略: {strategy}")
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, zlib.MAX_WBITS, 8,
+                                  ZLIB_STRATEGIES[strategy])
+    return compressor.compress(data) + compressor.flush()
+
+def encode_png(image, compress_level=6, png_filter='none', strategy='default'):
+    """
+    将RGB uint8图像编码为真彩色PNG
+
+    参数:
+        image: 形状为 (h, w, 3) 的uint8数组
+        compress_level: zlib压缩级别（0-9）
+        png_filter: 行过滤方式，PNG_FILTERS 之一
+        strategy: zlib压缩策略，ZLIB_STRATEGIES 的键
+
+    返回:
+        PNG文件内容（bytes）
+    """
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    h, w = image.shape[:2]
+    raw = filter_rows(image.reshape(h, w * 3), 3, png_filter)
+    header = struct.pack('>IIBBBBB', w, h, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + _png_chunk(b'IHDR', header) +
+            _png_chunk(b'IDAT', _compress(raw.tobytes(), compress_level, strategy)) +
+            _png_chunk(b'IEND', b''))
+
+def encode_png_indexed(indices, palette, compress_level=6, png_filter='none', strategy='default'):
+    """
+    将颜色索引图编码为8位调色板PNG
+
+    参数:
+        indices: 形状为 (h, w) 的uint8索引图
+        palette: 形状为 (n, 3) 的uint8颜色表，n <= 256
+        其余参数同 encode_png（调色板图像通常不过滤压缩效果最好）
+
+    返回:
+        PNG文件内容（bytes）
+    """
+    indices = np.ascontiguousarray(indices, dtype=np.uint8)
+    palette = np.asarray(palette, dtype=np.uint8)
+    if len(palette) > 256:
+        raise ValueError('调色板最多256种颜色')
+    h, w = indices.shape
+    raw = filter_rows(indices, 1, png_filter)
+    header = struct.pack('>IIBBBBB', w, h, 8, 3, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + _png_chunk(b'IHDR', header) +
+            _png_chunk(b'PLTE', palette.tobytes()) +
+            _png_chunk(b'IDAT', _compress(raw.tobytes(), compress_level, strategy)) +
+            _png_chunk(b'IEND', b''))
+
+def to_indexed(image):
+    """
+    将颜色数不超过256的RGB图像转换为索引图；颜色过多时用Pillow量化，
+    没有Pillow时抛出ValueError
+
+    返回:
+        indices, palette
+    """
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    h, w = image.shape[:2]
+    packed = (image[..., 0].astype(np.uint32) << 16) | (image[..., 1].astype(np.uint32) << 8) | image[..., 2]
+    colors, inverse = np.unique(packed, return_inverse=True)
+    if len(colors) <= 256:
+        palette = np.stack([(colors >> 16) & 0xFF, (colors >> 8) & 0xFF, colors & 0xFF], axis=1)
+        return inverse.reshape(h, w).astype(np.uint8), palette.astype(np.uint8)
+    if Image is None:
+        raise ValueError(f"图像有 {len(colors)} 种颜色，转换为调色板PNG需要Pillow进行量化")
+    quantized = Image.fromarray(image, 'RGB').quantize(256)
+    palette = np.asarray(quantized.getpalette()[:256 * 3], dtype=np.uint8).reshape(-1, 3)
+    return np.asarray(quantized, dtype=np.uint8), palette
+
+_QOI_OP_INDEX = 0x00
+_QOI_OP_DIFF = 0x40
+_QOI_OP_LUMA = 0x80
+_QOI_OP_RUN = 0xC0
+_QOI_OP_RGB = 0xFE
+_QOI_MAX_RUN = 62
+
+def encode_qoi(image):
+    """
+    将RGB uint8图像编码为QOI
+
+    QOI编码器中只有颜色索引表依赖之前的像素，而索引表中某个槽位的值就是此前最后一个
+    落入该槽位的像素，因此整张图像可以向量化编码，结果与逐像素的参考实现一致。
+
+    返回:
+        QOI文件内容（bytes）
+    """
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    h, w = image.shape[:2]
+    pixels = image.reshape(-1, 3).astype(np.int16)
+    n = len(pixels)
+
+    previous = np.empty_like(pixels)
+    previous[0] = 0
+    previous[1:] = pixels[:-1]
+    same = (pixels == previous).all(axis=1)
+    # 编码开始前的“上一个像素”为不透明黑色，开头与之相同的像素编码为游程且不进入索引表
+    leading = np.cumprod(same).astype(bool)
+
+    # 游程：连续相同的像素，每62个或游程结束时输出一个字节
+    run_start = same & ~np.concatenate(([False], same[:-1]))
+    group_start = np.maximum.accumulate(np.where(run_start, np.arange(n), 0))
+    run_position = np.arange(n) - group_start
+    run_end = same & ((run_position % _QOI_MAX_RUN == _QOI_MAX_RUN - 1) |
+                      ~np.concatenate((same[1:], [False])))
+
+    # 颜色索引：同一哈希槽位此前最后出现的像素
+    slot = (pixels[:, 0] * 3 + pixels[:, 1] * 5 + pixels[:, 2] * 7 + 255 * 11) % 64
+    slot = np.where(leading, -1, slot)
+    order = np.argsort(slot, kind='stable')
+    last_seen = np.full(n, -1)
+    in_group = slot[order][1:] == slot[order][:-1]
+    last_seen[order[1:][in_group]] = order[:-1][in_group]
+    index_hit = ~same & (last_seen >= 0)
+    index_hit[index_hit] = (pixels[index_hit] == pixels[last_seen[index_hit]]).all(axis=1)
+
+    difference = (pixels - previous + 128) % 256 - 128
+    dr, dg, db = difference[:, 0], difference[:, 1], difference[:, 2]
+    remaining = ~same & ~index_hit
+    small = remaining & (dr >= -2) & (dr <= 1) & (dg >= -2) & (dg <= 1) & (db >= -2) & (db <= 1)
+    remaining &= ~small
+    drg, dbg = dr - dg, db - dg
+    luma = remaining & (dg >= -32) & (dg <= 31) & (drg >= -8) & (drg <= 7) & (dbg >= -8) & (dbg <= 7)
+    rgb = remaining & ~luma
+
+    sizes = run_end.astype(np.int64) + index_hit + small + 2 * luma + 4 * rgb
+    offsets = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    body = np.zeros(int(sizes.sum()), dtype=np.uint8)
+    body[offsets[run_end]] = _QOI_OP_RUN | (run_position[run_end] % _QOI_MAX_RUN)
+    body[offsets[index_hit]] = slot[index_hit]
+    body[offsets[small]] = (_QOI_OP_DIFF | ((dr[small] + 2) << 4) | ((dg[small] + 2) << 2) |
+                            (db[small] + 2))
+    body[offsets[luma]] = _QOI_OP_LUMA | (dg[luma] + 32)
+    body[offsets[luma] + 1] = ((drg[luma] + 8) << 4) | (dbg[luma] + 8)
+    rgb_offsets = offsets[rgb]
+    body[rgb_offsets] = _QOI_OP_RGB
+    for channel in range(3):
+        body[rgb_offsets + 1 + channel] = pixels[rgb, channel]
+
+    header = b'qoif' + struct.pack('>IIBB', w, h, 3, 0)
+    return header + body.tobytes() + b'\x00' * 7 + b'\x01'
+
+def _encode_pillow(image, format, quality=None, lossless=False):
+    if Image is None:
+        raise ValueError(f"输出格式 {format} 需要Pillow")
+    import io
+    options = {}
+    if quality is not None:
+        options['quality'] = int(quality)
+    if format == 'webp' and lossless:
+        options['lossless'] = True
+    buffer = io.BytesIO()
+    Image.fromarray(np.ascontiguousarray(image, dtype=np.uint8), 'RGB').save(
+        buffer, format='WEBP' if format == 'webp' else 'JPEG', **options)
+    return buffer.getvalue()
+
+@ranmap_trace.traced('encode')
+def encode_image(image, format='png', palette=None, compress_level=6, png_filter='none',
+                 strategy='default', quality=None, lossless=False):
+    """
+    将图像编码为指定格式
+
+    参数:
+        image: RGB uint8图像 (h, w, 3)；给出 palette 时为 (h, w) 的颜色索引图
+        format: IMAGE_FORMATS 之一
+        palette: 索引图的颜色表
+        compress_level, strategy: PNG的zlib压缩级别和策略
+        png_filter: PNG行过滤方式，PNG_FILTERS 之一
+        quality: WebP/JPEG的质量（1-100）
+        lossless: WebP是否无损
+
+    返回:
+        编码后的字节串
+    """
+    if format not in IMAGE_FORMATS:
+        raise ValueError(f"未知的输出格式: {format}")
+    if format == 'png8':
+        if palette is None:
+            image, palette = to_indexed(image)
+        return encode_png_indexed(image, palette, compress_level, png_filter, strategy)
+
+    if palette is not None:
+        image = np.asarray(palette, dtype=np.uint8)[image]
+    if format == 'png':
+        return encode_png(image, compress_level, png_filter, strategy)
+    if format == 'qoi':
+        return encode_qoi(image)
+    return _encode_pillow(image, format, quality, lossless)
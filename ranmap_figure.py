@@ -0,0 +1,109 @@
+"""
+不经过pyplot的matplotlib图形
+
+直接使用 matplotlib.figure.Figure 和 FigureCanvasAgg 创建图形，不注册到pyplot的全局
+图形管理器，也不需要切换后端，多个线程可以同时在各自的图形上绘制。
+FigurePool 复用已创建的图形，每次渲染后清空坐标轴，省去重复构造Figure的开销。
+"""
+import threading
+from contextlib import contextmanager
+
+import matplotlib
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+# 地图图形的尺寸（英寸）
+FIGURE_SIZE = (12, 10)
+
+# 每个图形池最多保留的空闲图形数
+DEFAULT_POOL_SIZE = 4
+
+def new_figure(figsize=FIGURE_SIZE):
+    """
+    创建一个带Agg画布和单个坐标轴的图形
+
+    返回:
+        fig, ax
+    """
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    return fig, ax
+
+def reset_figure(fig, ax):
+    """
+    清除图形上的全部绘制内容，恢复为 new_figure 刚创建时的状态
+    """
+    ax.cla()
+
+def figure_to_rgb(fig, dpi=150, facecolor='white'):
+    """
+    按给定分辨率绘制图形，返回裁剪到内容范围的RGB数组
+
+    裁剪范围与 savefig(bbox_inches='tight') 相同（内容外留 savefig.pad_inches 的边距），
+    供需要原始像素的编码器（调色板PNG、QOI、WebP等）使用，省去PNG编码和解码。
+
+    返回:
+        形状为 (h, w, 3) 的uint8数组
+    """
+    original_dpi = fig.dpi
+    original_facecolor = fig.get_facecolor()
+    fig.set_dpi(dpi)
+    fig.set_facecolor(facecolor)
+    try:
+        canvas = fig.canvas
+        canvas.draw()
+        pixels = np.asarray(canvas.buffer_rgba())
+        bbox = fig.get_tightbbox(canvas.get_renderer()).padded(matplotlib.rcParams['savefig.pad_inches'])
+        # 与 savefig 一致：输出尺寸为裁剪框尺寸取整，原点对齐到最近的像素
+        height, width = pixels.shape[:2]
+        x0 = max(int(round(bbox.x0 * dpi)), 0)
+        x1 = min(x0 + int(bbox.width * dpi), width)
+        # 画布像素的首行对应图形上边缘
+        y0 = max(int(round(height - bbox.y1 * dpi)), 0)
+        y1 = min(y0 + int(bbox.height * dpi), height)
+        return pixels[y0:y1, x0:x1, :3].copy()
+    finally:
+        fig.set_dpi(original_dpi)
+        fig.set_facecolor(original_facecolor)
+
+class FigurePool:
+    """
+    可复用图形的线程安全池
+
+    同时使用的图形数不受限制：池中没有空闲图形时创建新图形，
+    归还时池已满则丢弃。
+    """
+    def __init__(self, size=DEFAULT_POOL_SIZE, figsize=FIGURE_SIZE):
+        self.size = size
+        self.figsize = figsize
+        self._free = []
+        self._lock = threading.Lock()
+        self.created = 0
+
+    @contextmanager
+    def figure(self):
+        """
+        取出一个已清空的图形，用完后自动清空并放回池中
+
+        用法:
+            with pool.figure() as (fig, ax):
+                ...
+        """
+        with self._lock:
+            entry = self._free.pop() if self._free else None
+        if entry is None:
+            entry = new_figure(self.figsize)
+            with self._lock:
+                self.created += 1
+        try:
+            yield entry
+        finally:
+            reset_figure(*entry)
+            with self._lock:
+                if len(self._free) < self.size:
+                    self._free.append(entry)
+
+# 进程内共享的图形池
+FIGURE_POOL = FigurePool()
@@ -0,0 +1,206 @@
+"""
+地图服务器的运行指标
+
+记录各命令的请求数和延迟分布、活动连接数、待处理的生成任务数和发送字节数，
+可输出为字典（stats 命令）或 Prometheus 文本格式（指标端口）。
+"""
+import bisect
+import os
+import time
+from collections import deque
+
+import numpy as np
+
+# 延迟直方图的桶上界（秒）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+# 计算分位数时保留的最近样本数
+LATENCY_WINDOW = 1024
+
+QUANTILES = (50, 95, 99)
+
+def process_rss_bytes(pid=None):
+    """
+    进程的常驻内存（字节），无法获取时返回None
+    """
+    pid = os.getpid() if pid is None else pid
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except ImportError:
+        pass
+    except Exception:
+        return None
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+class LatencyHistogram:
+    """
+    累积的延迟直方图，同时保留最近的样本用于计算分位数
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS, window=LATENCY_WINDOW):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+
+    def quantiles(self):
+        """
+        最近样本的 p50/p95/p99（秒），没有样本时为None
+        """
+        if not self.recent:
+            return dict.fromkeys((f'p{q}' for q in QUANTILES), None)
+        values = np.percentile(np.fromiter(self.recent, float), QUANTILES)
+        return {f'p{q}': float(v) for q, v in zip(QUANTILES, values)}
+
+    def cumulative(self):
+        """
+        Prometheus 风格的累积桶计数 [(上界, 计数)]，最后一项上界为 '+Inf'
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+class ServerMetrics:
+    """
+    服务器指标，只在事件循环线程中更新
+    """
+    def __init__(self):
+        self.started = time.time()
+        # (命令, 状态) -> 请求数
+        self.requests = {}
+        self.latency = {}
+        self.active_connections = 0
+        self.total_connections = 0
+        # 已提交到进程池但尚未完成的生成任务数
+        self.pending_jobs = 0
+        self.bytes_sent = 0
+
+    def observe_request(self, command, status, seconds):
+        key = (str(command), str(status))
+        self.requests[key] = self.requests.get(key, 0) + 1
+        histogram = self.latency.get(key[0])
+        if histogram is None:
+            histogram = self.latency[key[0]] = LatencyHistogram()
+        histogram.observe(seconds)
+
+    def connection_opened(self):
+        self.active_connections += 1
+        self.total_connections += 1
+
+    def connection_closed(self):
+        self.active_connections -= 1
+
+    def snapshot(self):
+        """
+        可JSON序列化的指标字典
+        """
+        requests = {}
+        for (command, status), count in self.requests.items():
+            requests.setdefault(command, {})[status] = count
+        return {
+            'uptime_s': time.time() - self.started,
+            'requests': requests,
+            'latency_s': {command: dict(histogram.quantiles(), count=histogram.count,
+                                        mean=histogram.sum / histogram.count)
+                          for command, histogram in self.latency.items()},
+            'active_connections': self.active_connections,
+            'total_connections': self.total_connections,
+            'pending_jobs': self.pending_jobs,
+            'bytes_sent': self.bytes_sent,
+        }
+
+def _hit_rate(stats):
+    total = stats['hits'] + stats['misses']
+    return stats['hits'] / total if total else 0.0
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def prometheus_text(metrics, cache_stats=None, reservoir_stats=None, worker_rss=None,
+                    scheduler_stats=None):
+    """
+    Prometheus 文本格式（0.0.4）的指标
+
+    参数:
+        metrics: ServerMetrics
+        cache_stats: RenderCache.stats() 的结果
+        reservoir_stats: MapReservoir.stats() 的结果
+        worker_rss: {进程号: 常驻内存字节数}
+        scheduler_stats: GenerationScheduler.stats() 的结果
+    """
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in samples:
+            label_text = ','.join(f'{key}="{_label(v)}"' for key, v in labels)
+            lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+
+    metric('ranmap_uptime_seconds', 'gauge', '服务器运行时间',
+           [((), time.time() - metrics.started)])
+    metric('ranmap_requests_total', 'counter', '按命令和状态统计的请求数',
+           [((('command', command), ('status', status)), count)
+            for (command, status), count in sorted(metrics.requests.items())])
+
+    lines.append('# HELP ranmap_request_duration_seconds 请求处理延迟')
+    lines.append('# TYPE ranmap_request_duration_seconds histogram')
+    for command, histogram in sorted(metrics.latency.items()):
+        label = _label(command)
+        for bound, count in histogram.cumulative():
+            lines.append(f'ranmap_request_duration_seconds_bucket{{command="{label}",le="{bound}"}} {count}')
+        lines.append(f'ranmap_request_duration_seconds_sum{{command="{label}"}} {histogram.sum}')
+        lines.append(f'ranmap_request_duration_seconds_count{{command="{label}"}} {histogram.count}')
+
+    metric('ranmap_active_connections', 'gauge', '当前连接数', [((), metrics.active_connections)])
+    metric('ranmap_connections_total', 'counter', '累计连接数', [((), metrics.total_connections)])
+    metric('ranmap_pending_jobs', 'gauge', '进程池中排队或运行中的生成任务数',
+           [((), metrics.pending_jobs)])
+    metric('ranmap_bytes_sent_total', 'counter', '发送给客户端的字节数', [((), metrics.bytes_sent)])
+
+    if cache_stats is not None:
+        metric('ranmap_cache_hits_total', 'counter', '渲染缓存命中数', [((), cache_stats['hits'])])
+        metric('ranmap_cache_misses_total', 'counter', '渲染缓存未命中数', [((), cache_stats['misses'])])
+        metric('ranmap_cache_coalesced_total', 'counter', '合并到进行中生成的请求数',
+               [((), cache_stats['coalesced'])])
+        metric('ranmap_cache_hit_ratio', 'gauge', '渲染缓存命中率', [((), _hit_rate(cache_stats))])
+        metric('ranmap_cache_bytes', 'gauge', '渲染缓存占用字节数', [((), cache_stats['bytes'])])
+    if reservoir_stats is not None:
+        metric('ranmap_reservoir_hits_total', 'counter', '储备池命中数', [((), reservoir_stats['hits'])])
+        metric('ranmap_reservoir_misses_total', 'counter', '储备池未命中数',
+               [((), reservoir_stats['misses'])])
+        metric('ranmap_reservoir_hit_ratio', 'gauge', '储备池命中率', [((), _hit_rate(reservoir_stats))])
+        metric('ranmap_reservoir_ready', 'gauge', '储备池中就绪的地图数',
+               [(tuple(zip(('resolution', 'renderer', 'format'), pool['key'])), pool['ready'])
+                for pool in reservoir_stats['pools']])
+    if scheduler_stats is not None:
+        metric('ranmap_scheduler_queued', 'gauge', '按优先级统计的排队生成任务数',
+               [((('priority', priority),), count)
+                for priority, count in scheduler_stats['queued'].items()])
+        metric('ranmap_scheduler_running', 'gauge', '运行中的生成任务数',
+               [((), scheduler_stats['running'])])
+        for name, help_text in (('rejected', '队列已满被拒绝的任务数'),
+                                ('cancelled', '被取消的任务数'),
+                                ('completed', '完成的任务数')):
+            metric(f'ranmap_scheduler_{name}_total', 'counter', help_text,
+                   [((), scheduler_stats[name])])
+    if worker_rss:
+        metric('ranmap_worker_rss_bytes', 'gauge', '生成进程的常驻内存',
+               [((('pid', pid),), rss) for pid, rss in sorted(worker_rss.items()) if rss is not None])
+    metric('ranmap_server_rss_bytes', 'gauge', '服务器进程的常驻内存', [((), process_rss_bytes() or 0)])
+    return '\n'.join(lines) + '\n'
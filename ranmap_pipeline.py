@@ -0,0 +1,266 @@
+"""
+分阶段、带缓存的地图生成流水线
+
+生成过程拆分为以下阶段，每个阶段的输出按其输入内容的哈希缓存：
+
+    coastline  海岸线          (seed, width, height, num_points, coastline_spectrum)
+    noise      主地形基础噪声  (海岸线阶段之后的随机数状态, noise_mode)
+    features   地形特征        (海岸线, 噪声, 噪声阶段之后的随机数状态)
+    elevation  高程            (海岸线, 噪声, 特征, resolution, feature_cutoff, dtype, transition_width)
+    render     编码后的图像    (高程, renderer, size, dpi, format, encode_options, colors, contours)
+
+各阶段依次从同一个由种子初始化的随机数流中抽取，与 mapMapGenerator 一次性生成时的
+抽取顺序完全相同，因此同一 (seed, 参数) 在流水线、mapMapGenerator、服务器和批量生成中
+得到同一张地图。阶段之间传递的是随机数生成器的状态，下游阶段以该状态作为输入的一部分：
+海岸线平滑参数不改变抽取的随机数个数，只修改它时噪声阶段的输入不变，直接复用缓存的噪声场；
+只修改渲染参数时复用缓存的高程。附加地形的噪声和特征在特征阶段中按原顺序抽取。
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import ranmap
+import ranmap_encode
+import ranmap_render
+
+# 默认缓存容量（字节）
+DEFAULT_MAX_BYTES = 128 << 20
+
+# 各阶段依赖的参数及其默认值
+DEFAULT_PARAMS = {
+    'width': 100,
+    'height': 100,
+    'num_points': 80,
+    'coastline_spectrum': ranmap.COASTLINE_DETAIL_SPECTRUM,
+    'noise_mode': ranmap.NOISE_MODE,
+    'resolution': ranmap.REFERENCE_RESOLUTION,
+    'feature_cutoff': ranmap.FEATURE_CUTOFF,
+    'dtype': 'float64',
+    'transition_width': ranmap.TRANSITION_WIDTH,
+    'renderer': 'raster',
+    'size': None,
+    'dpi': 150,
+    'format': 'png',
+    'encode_options': None,
+    'colors': ranmap_render.HYPSOMETRIC_COLORS,
+    'contours': True,
+}
+
+STAGE_PARAMS = {
+    'coastline': ('width', 'height', 'num_points', 'coastline_spectrum'),
+    'noise': ('noise_mode',),
+    'features': (),
+    'elevation': ('width', 'height', 'resolution', 'feature_cutoff', 'dtype', 'transition_width'),
+    'render': ('width', 'height', 'renderer', 'size', 'dpi', 'format', 'encode_options',
+               'colors', 'contours'),
+}
+
+STAGES = tuple(STAGE_PARAMS)
+
+def content_key(*parts):
+    """
+    由阶段名、参数和上游阶段的键计算内容哈希
+    """
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+def rng_from_state(state):
+    """
+    由 bit_generator.state 恢复随机数生成器，从上一阶段停止的位置继续抽取
+    """
+    bit_generator = getattr(np.random, state['bit_generator'])()
+    bit_generator.state = state
+    return np.random.Generator(bit_generator)
+
+def nbytes(value):
+    """
+    估计阶段输出占用的内存（数组和字节串的总字节数）
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(nbytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(item) for item in value)
+    return 0
+
+class MapPipeline:
+    """
+    带缓存的分阶段地图生成流水线
+
+    缓存按最近最少使用的顺序淘汰，阶段输出的总字节数不超过 max_bytes，
+    超过上限的单个输出不缓存；max_bytes 为0时不缓存，高程直接使用当前线程的
+    生成上下文工作区（见 ranmap.get_context）。缓存可被多个线程共享，
+    缓存的数组不应被调用方修改。
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        # 各阶段的命中和未命中次数
+        self.hits = dict.fromkeys(STAGES, 0)
+        self.misses = dict.fromkeys(STAGES, 0)
+
+    def _memo(self, stage, key, compute, store=True):
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits[stage] += 1
+                return self._cache[key][0]
+        value = compute()
+        size = nbytes(value)
+        with self._lock:
+            self.misses[stage] += 1
+            if store and size <= self.max_bytes and key not in self._cache:
+                self._cache[key] = (value, size)
+                self.size += size
+                while self.size > self.max_bytes:
+                    _, (_, evicted) = self._cache.popitem(last=False)
+                    self.size -= evicted
+        return value
+
+    def clear(self):
+        """
+        清空缓存
+        """
+        with self._lock:
+            self._cache.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        缓存的条目数、字节数和各阶段的命中情况
+        """
+        with self._lock:
+            return {
+                'entries': len(self._cache),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': dict(self.hits),
+                'misses': dict(self.misses),
+            }
+
+    def run(self, seed=None, until='render', checkpoint=None, **params):
+        """
+        运行流水线，未变化的阶段直接取缓存
+
+        参数:
+            seed: 地图种子，为空时使用新种子
+            until: 运行到哪个阶段为止（STAGES 之一）
+            checkpoint: 无参数的函数，在每个阶段之后调用，可抛出异常中止生成
+                        （如 mapMapGenerator 的取消检查）
+            **params: 覆盖 DEFAULT_PARAMS 中的参数
+
+        返回:
+            result: 字典，包含 'seed'、'keys'（各阶段的内容哈希）以及已运行阶段的输出：
+                    'points'、'small_terrain'、'noise'、'plans'（各地形的规划，见 ranmap.plan_terrain）、
+                    'X'、'Y'、'Z'、'land_mask'、'png'（编码后的图像，格式由 format 决定）
+        """
+        unknown = set(params) - set(DEFAULT_PARAMS)
+        if unknown:
+            raise ValueError(f"未知的流水线参数: {sorted(unknown)}")
+        if until not in STAGES:
+            raise ValueError(f"未知的阶段: {until}")
+        options = dict(DEFAULT_PARAMS, **params)
+        options['dtype'] = np.dtype(options['dtype']).name
+        options['encode_options'] = tuple(sorted((options['encode_options'] or {}).items()))
+        options['colors'] = tuple(options['colors'])
+        stop = STAGES.index(until)
+        if stop == STAGES.index('render'):
+            if options['renderer'] not in ranmap.RENDERERS:
+                raise ValueError(f"未知的渲染器: {options['renderer']}")
+            if options['renderer'] == 'raster' and options['format'] in ranmap_encode.VECTOR_FORMATS:
+                raise ValueError(f"栅格渲染器不支持矢量格式: {options['format']}")
+        seed = ranmap.new_seed() if seed is None else int(seed)
+
+        def stage_key(stage, *upstream):
+            return content_key(stage, tuple(options[name] for name in STAGE_PARAMS[stage]), upstream)
+
+        def done(stage):
+            # 阶段之间检查是否中止，返回是否已运行到 until
+            if checkpoint is not None:
+                checkpoint()
+            return STAGES.index(stage) >= stop
+
+        result = {'seed': seed, 'keys': {}}
+        keys = result['keys']
+
+        keys['coastline'] = stage_key('coastline', seed)
+        result['points'], result['small_terrain'], coastline_state = self._memo(
+            'coastline', keys['coastline'], lambda: self._coastline(seed, options))
+        if done('coastline'):
+            return result
+
+        # 噪声阶段只依赖海岸线阶段之后的随机数状态，海岸线形状变化时可以复用
+        keys['noise'] = stage_key('noise', coastline_state)
+        result['noise'], noise_state = self._memo(
+            'noise', keys['noise'], lambda: self._noise(coastline_state, options))
+        if done('noise'):
+            return result
+
+        keys['features'] = stage_key('features', keys['coastline'], keys['noise'], noise_state)
+        result['plans'] = self._memo('features', keys['features'],
+                                     lambda: self._features(noise_state, options, result))
+        if done('features'):
+            return result
+
+        keys['elevation'] = stage_key('elevation', keys['coastline'], keys['noise'], keys['features'])
+        # 缓存放不下的高程直接写入当前线程的生成上下文，不另外分配
+        cells = options['resolution'] ** 2
+        store = cells * (3 * np.dtype(options['dtype']).itemsize + 1) <= self.max_bytes
+        result['X'], result['Y'], result['Z'], result['land_mask'] = self._memo(
+            'elevation', keys['elevation'], lambda: self._elevation(options, result, store), store)
+        if done('elevation'):
+            return result
+
+        keys['render'] = stage_key('render', keys['elevation'])
+        result['png'] = self._memo('render', keys['render'], lambda: self._render(options, result))
+        return result
+
+    @staticmethod
+    def _coastline(seed, options):
+        rng = np.random.default_rng(seed)
+        width, height = options['width'], options['height']
+        points = ranmap.generate_complex_map(width, height, options['num_points'], rng=rng,
+                                             detail_spectrum=options['coastline_spectrum'])
+        return points, ranmap.generate_small_maps(points, width, height), rng.bit_generator.state
+
+    @staticmethod
+    def _noise(state, options):
+        rng = rng_from_state(state)
+        return ranmap.plan_noise(rng, options['noise_mode']), rng.bit_generator.state
+
+    @staticmethod
+    def _features(state, options, result):
+        rng = rng_from_state(state)
+        plans = [ranmap.plan_map(result['points'], 'main', result['noise'], rng)]
+        for small_map in result['small_terrain']:
+            combined_noise = ranmap.plan_noise(rng, options['noise_mode'])
+            plans.append(ranmap.plan_map(small_map, 'small', combined_noise, rng))
+        return plans
+
+    @staticmethod
+    def _elevation(options, result, store):
+        width, height, resolution = options['width'], options['height'], options['resolution']
+        if store:
+            # 缓存的高程不能与之后的生成共用工作区
+            context = ranmap.GeneratorContext(width, height, resolution, options['dtype'])
+        else:
+            context = ranmap.get_context(width, height, resolution, options['dtype'])
+        return ranmap.generate_elevation_data(result['points'], result['small_terrain'], width, height,
+                                              return_mask=True, resolution=resolution,
+                                              feature_cutoff=options['feature_cutoff'],
+                                              context=context, plans=result['plans'],
+                                              transition_width=options['transition_width'])
+
+    @staticmethod
+    def _render(options, result):
+        return ranmap.render_terrain(result['X'], result['Y'], result['Z'], result['land_mask'],
+                                     options['width'], options['height'], options['renderer'],
+                                     options['size'], options['dpi'], options['format'],
+                                     dict(options['encode_options']), options['colors'],
+                                     options['contours'])
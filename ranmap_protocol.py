@@ -0,0 +1,238 @@
+"""
+地图服务器的二进制通信协议
+
+每个消息（帧）由定长前缀、JSON头部和二进制负载组成：
+
+    magic    4字节  b'RMAP'
+    version  1字节  协议版本
+    header   4字节  头部长度（大端无符号整数）
+    payload  8字节  负载长度（大端无符号整数）
+    头部     UTF-8编码的JSON对象
+    负载     原始字节（例如PNG图像），不再经过base64编码
+
+头部中的 'encoding' 字段表示负载的压缩方式（'zlib'、'zstd' 或不存在），
+请求头部中的 'accept_encoding' 列出客户端能解压的方式。PNG等已压缩格式不再压缩。
+
+一个请求对应一个最终响应帧。请求头部含 'progressive': true 时，服务器可以在最终响应之前
+发送带 'event' 字段的中间帧：'progress'（阶段和耗时）和 'preview'（低分辨率预览图像），
+客户端应读取到不含 'event' 字段的帧为止。
+
+流水线：请求头部含 'id'（任意JSON值）时，客户端可以不等响应继续发送请求，
+服务器并发处理这些请求，并在各自的事件帧和最终响应帧中带回同一 'id'，帧可能不按请求顺序到达。
+不含 'id' 的请求按顺序处理，响应按请求顺序返回。
+
+断开：服务器读到连接的EOF时视为客户端已断开，取消该连接上未完成的请求。
+发送完请求后半关闭（shutdown(SHUT_WR)）并等待响应的客户端，应在请求头部中设置 'half_close': true。
+
+协议协商：服务器根据连接的前4个字节判断，以 b'RMAP' 开头的连接使用本协议，
+其余连接按旧的JSON协议处理，因此旧客户端无需修改。
+"""
+import json
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+PROTOCOL_MAGIC = b'RMAP'
+PROTOCOL_VERSION = 1
+
+_PREFIX = struct.Struct('>4sBIQ')
+PREFIX_SIZE = _PREFIX.size
+
+# 头部长度上限，防止异常数据导致分配过大的内存
+MAX_HEADER_SIZE = 1 << 20
+
+# 负载（解压前后）长度的默认上限；服务器不接受请求负载，读取请求时使用更小的上限
+MAX_PAYLOAD_SIZE = 1 << 30
+
+# 已经压缩过、再压缩没有收益的负载类型
+COMPRESSED_CONTENT_TYPES = ('image/png', 'image/jpeg', 'image/webp')
+
+# 负载小于该长度时不压缩
+MIN_COMPRESS_SIZE = 1024
+
+class ProtocolError(Exception):
+    """协议数据格式错误"""
+
+def available_encodings():
+    """
+    本地可用的压缩方式，按优先顺序排列
+    """
+    return (['zstd'] if zstandard is not None else []) + ['zlib']
+
+def compress(data, encoding, level=None):
+    """
+    按指定方式压缩数据
+    """
+    if encoding == 'zlib':
+        return zlib.compress(data, 6 if level is None else level)
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    raise ProtocolError(f"不支持的压缩方式: {encoding}")
+
+def decompress(data, encoding, max_size=MAX_PAYLOAD_SIZE):
+    """
+    按指定方式解压数据，encoding 为空时原样返回
+
+    异常:
+        ProtocolError: 压缩方式不支持、数据损坏或解压后超过 max_size 字节
+    """
+    if not encoding:
+        return data
+    try:
+        if encoding == 'zlib':
+            decompressor = zlib.decompressobj()
+            result = decompressor.decompress(data, max_size + 1)
+        elif encoding == 'zstd' and zstandard is not None:
+            with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+                result = reader.read(max_size + 1)
+        else:
+            raise ProtocolError(f"不支持的压缩方式: {encoding}")
+    except (zlib.error, getattr(zstandard, 'ZstdError', zlib.error)) as e:
+        raise ProtocolError(f"负载解压失败: {e}")
+    if len(result) > max_size:
+        raise ProtocolError('解压后的负载过长')
+    return result
+
+def choose_encoding(accepted, content_type, size):
+    """
+    为负载选择压缩方式：取双方都支持且优先级最高的一种，
+    已压缩的内容类型和很小的负载不压缩
+
+    返回:
+        压缩方式，或 None
+    """
+    if not accepted or size < MIN_COMPRESS_SIZE or content_type in COMPRESSED_CONTENT_TYPES:
+        return None
+    for encoding in available_encodings():
+        if encoding in accepted:
+            return encoding
+    return None
+
+def encode_frame(header, payload=b'', encoding=None):
+    """
+    构造一帧数据
+
+    参数:
+        header: 可JSON序列化的字典
+        payload: 负载字节
+        encoding: 负载压缩方式，为空时不压缩
+
+    返回:
+        完整帧的字节串
+    """
+    if encoding:
+        payload = compress(payload, encoding)
+        header = dict(header, encoding=encoding)
+    header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+    return _PREFIX.pack(PROTOCOL_MAGIC, PROTOCOL_VERSION, len(header_bytes), len(payload)) + \
+        header_bytes + payload
+
+def parse_prefix(prefix, max_payload=MAX_PAYLOAD_SIZE):
+    """
+    解析定长前缀
+
+    参数:
+        max_payload: 负载长度上限，超过时在读取负载之前抛出 ProtocolError
+
+    返回:
+        (header_length, payload_length)
+    """
+    magic, version, header_length, payload_length = _PREFIX.unpack(prefix)
+    if magic != PROTOCOL_MAGIC:
+        raise ProtocolError('无效的帧标识')
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"不支持的协议版本: {version}")
+    if header_length > MAX_HEADER_SIZE:
+        raise ProtocolError('帧头部过长')
+    if payload_length > max_payload:
+        raise ProtocolError('帧负载过长')
+    return header_length, payload_length
+
+def parse_frame_body(header_bytes, payload, max_payload=MAX_PAYLOAD_SIZE):
+    """
+    解析头部并解压负载，解压后的长度同样不超过 max_payload
+
+    返回:
+        (header, payload)
+    """
+    try:
+        header = json.loads(header_bytes.decode('utf-8'))
+    except ValueError as e:
+        raise ProtocolError(f"无效的帧头部: {e}")
+    if not isinstance(header, dict):
+        raise ProtocolError('帧头部必须是JSON对象')
+    return header, decompress(payload, header.get('encoding'), max_payload)
+
+async def read_frame(reader, max_payload=MAX_PAYLOAD_SIZE):
+    """
+    从 asyncio.StreamReader 读取一帧，负载长度超过 max_payload 时抛出 ProtocolError
+
+    返回:
+        (header, payload)；连接在帧边界处关闭时返回 (None, None)
+    """
+    try:
+        prefix = await reader.readexactly(PREFIX_SIZE)
+    except Exception as e:
+        if getattr(e, 'partial', None) == b'':
+            return None, None
+        raise
+    header_length, payload_length = parse_prefix(prefix, max_payload)
+    header_bytes = await reader.readexactly(header_length)
+    payload = await reader.readexactly(payload_length)
+    return parse_frame_body(header_bytes, payload, max_payload)
+
+def _recv_exactly(sock, size):
+    """
+    从阻塞套接字中读取恰好 size 字节
+    """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if count == 0:
+            raise ConnectionError('连接已关闭')
+        received += count
+    return bytes(buffer)
+
+def recv_frame(sock, max_payload=MAX_PAYLOAD_SIZE):
+    """
+    从阻塞套接字读取一帧，按长度一次性接收，不重复解析
+
+    返回:
+        (header, payload)
+    """
+    header_length, payload_length = parse_prefix(_recv_exactly(sock, PREFIX_SIZE), max_payload)
+    header_bytes = _recv_exactly(sock, header_length)
+    payload = _recv_exactly(sock, payload_length)
+    return parse_frame_body(header_bytes, payload, max_payload)
+
+def send_frame(sock, header, payload=b'', encoding=None):
+    """
+    向阻塞套接字发送一帧
+    """
+    sock.sendall(encode_frame(header, payload, encoding))
+
+def request(sock, header, payload=b'', on_event=None):
+    """
+    发送一个请求帧并等待最终响应帧，自动声明本地支持的压缩方式
+
+    参数:
+        on_event: 收到中间事件帧时调用 on_event(header, payload)，为空时忽略中间帧
+
+    返回:
+        最终响应的 (header, payload)
+    """
+    header = dict(header)
+    header.setdefault('accept_encoding', available_encodings())
+    send_frame(sock, header, payload)
+    while True:
+        response, data = recv_frame(sock)
+        if 'event' not in response:
+            return response, data
+        if on_event is not None:
+            on_event(response, data)
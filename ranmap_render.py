@@ -0,0 +1,204 @@
+"""
+不依赖matplotlib的快速栅格渲染器
+
+将高程数组按与matplotlib渲染相同的8级分层设色量化为颜色索引，
+由相邻像素的分层差异直接得到等高线，最后编码为PNG等格式（见 ranmap_encode），
+整个过程不创建Figure，只使用numpy和标准库。
+"""
+import numpy as np
+
+import ranmap_encode
+import ranmap_trace
+
+# 分层设色颜色（与matplotlib渲染器一致）
+HYPSOMETRIC_COLORS = ('#1E90FF', '#228B22', '#32CD32', '#9ACD32',
+                      '#DAA520', '#CD853F', '#8B4513', '#FFFFFF')
+OCEAN_COLOR = '#1E90FF'
+BAND_ALPHA = 0.7
+CONTOUR_COLOR = '#654321'
+CONTOUR_ALPHA = 0.6
+
+# 默认输出图像较长边的像素数
+DEFAULT_IMAGE_SIZE = 1024
+
+def hex_to_rgb(color):
+    """
+    将 '#RRGGBB' 形式的颜色转换为 0-255 的RGB浮点数组
+    """
+    color = color.lstrip('#')
+    return np.array([int(color[i:i + 2], 16) for i in (0, 2, 4)], dtype=float)
+
+def build_palette(colors=HYPSOMETRIC_COLORS, background=OCEAN_COLOR, alpha=BAND_ALPHA,
+                  line_color=CONTOUR_COLOR, line_alpha=CONTOUR_ALPHA):
+    """
+    预先计算所有可能出现的颜色
+
+    索引0为海洋背景，1..n 为叠加在背景上的各分层颜色，
+    n+1..2n 为在对应分层上再叠加等高线颜色。
+
+    返回:
+        palette: 形状为 (2n+1, 3) 的uint8颜色表
+    """
+    background = hex_to_rgb(background)
+    bands = np.array([hex_to_rgb(c) for c in colors])
+    bands = alpha * bands + (1 - alpha) * background
+    lines = line_alpha * hex_to_rgb(line_color) + (1 - line_alpha) * bands
+    palette = np.vstack([background, bands, lines])
+    return np.round(palette).astype(np.uint8)
+
+def _resample_positions(count, source_count):
+    """
+    计算输出像素中心在源网格上的位置（源网格格点位于两端对齐的均匀位置）
+    """
+    position = (np.arange(count) + 0.5) * (source_count - 1) / count
+    lower = np.minimum(np.floor(position).astype(int), max(source_count - 2, 0))
+    return position, lower, position - lower
+
+def resample_grid(Z, land_mask, out_height, out_width):
+    """
+    将高程网格双线性插值、陆地掩码最近邻采样到输出像素网格
+
+    参数:
+        Z: 高程数组，行对应y从小到大
+        land_mask: 与Z同形状的布尔陆地掩码
+        out_height, out_width: 输出像素尺寸
+
+    返回:
+        Z_out, mask_out: 形状为 (out_height, out_width) 的数组
+    """
+    rows, row_lower, row_t = _resample_positions(out_height, Z.shape[0])
+    cols, col_lower, col_t = _resample_positions(out_width, Z.shape[1])
+    row_upper = np.minimum(row_lower + 1, Z.shape[0] - 1)
+    col_upper = np.minimum(col_lower + 1, Z.shape[1] - 1)
+
+    # 先沿列方向插值，再沿行方向插值
+    left = Z[:, col_lower]
+    right = Z[:, col_upper]
+    Z_cols = left + (right - left) * col_t
+    Z_out = Z_cols[row_lower] + (Z_cols[row_upper] - Z_cols[row_lower]) * row_t[:, None]
+
+    mask_out = land_mask[np.ix_(np.round(rows).astype(int), np.round(cols).astype(int))]
+    return Z_out, mask_out
+
+def quantize_bands(Z, land_mask, levels=len(HYPSOMETRIC_COLORS)):
+    """
+    将陆地高程按陆地高程范围等分为若干层
+
+    返回:
+        bands: 整数数组，陆地为 0..levels-1，海洋为 -1
+    """
+    bands = np.full(Z.shape, -1, dtype=np.int8)
+    if not land_mask.any():
+        return bands
+    land = Z[land_mask]
+    edges = np.linspace(land.min(), land.max(), levels + 1)[1:-1]
+    bands[land_mask] = np.digitize(land, edges)
+    return bands
+
+def band_edges(bands):
+    """
+    标记陆地内部分层发生变化的像素（等高线）
+
+    相邻两个陆地像素分属不同分层时两者都被标记，线宽约为2像素。
+    海岸线不视为等高线。
+    """
+    edges = np.zeros(bands.shape, dtype=bool)
+    land = bands >= 0
+
+    horizontal = land[:, 1:] & land[:, :-1] & (bands[:, 1:] != bands[:, :-1])
+    edges[:, 1:] |= horizontal
+    edges[:, :-1] |= horizontal
+
+    vertical = land[1:] & land[:-1] & (bands[1:] != bands[:-1])
+    edges[1:] |= vertical
+    edges[:-1] |= vertical
+    return edges
+
+def image_shape(width, height, size=None):
+    """
+    根据地图宽高比和较长边像素数计算输出图像尺寸
+
+    返回:
+        (out_height, out_width)
+    """
+    size = int(size or DEFAULT_IMAGE_SIZE)
+    scale = size / max(width, height)
+    return max(int(round(height * scale)), 1), max(int(round(width * scale)), 1)
+
+@ranmap_trace.traced('raster')
+def render_indexed(Z, land_mask, width=100, height=100, size=None,
+                   colors=HYPSOMETRIC_COLORS, contours=True):
+    """
+    将高程数据渲染为颜色索引图
+
+    参数:
+        Z: 高程数组，行对应y从小到大
+        land_mask: 陆地掩码
+        width, height: 地图的世界坐标尺寸（决定宽高比）
+        size: 输出图像较长边的像素数，为空时使用 DEFAULT_IMAGE_SIZE
+        colors: 分层颜色
+        contours: 是否绘制等高线
+
+    返回:
+        indices: 形状为 (out_height, out_width) 的uint8索引图，首行为地图上边缘
+        palette: 对应的颜色表
+    """
+    out_height, out_width = image_shape(width, height, size)
+    Z_out, mask_out = resample_grid(np.asarray(Z, dtype=float), np.asarray(land_mask, dtype=bool),
+                                    out_height, out_width)
+    bands = quantize_bands(Z_out, mask_out, len(colors))
+
+    indices = (bands + 1).astype(np.uint8)
+    if contours:
+        indices[band_edges(bands)] += len(colors)
+
+    # 图像坐标的y轴向下，翻转使北方朝上
+    return indices[::-1], build_palette(colors)
+
+def render_rgb(Z, land_mask, width=100, height=100, size=None, **kwargs):
+    """
+    将高程数据渲染为RGB图像
+
+    返回:
+        形状为 (out_height, out_width, 3) 的uint8数组
+    """
+    indices, palette = render_indexed(Z, land_mask, width, height, size, **kwargs)
+    return palette[indices]
+
+@ranmap_trace.traced('png_encode')
+def encode_png(image, compress_level=6):
+    """
+    将RGB uint8图像编码为PNG
+
+    参数:
+        image: 形状为 (h, w, 3) 的uint8数组
+        compress_level: zlib压缩级别
+
+    返回:
+        PNG文件内容（bytes）
+    """
+    return ranmap_encode.encode_png(image, compress_level)
+
+def render_png(Z, land_mask, width=100, height=100, size=None, compress_level=6, **kwargs):
+    """
+    将高程数据直接渲染并编码为PNG
+
+    返回:
+        PNG文件内容（bytes）
+    """
+    return encode_png(render_rgb(Z, land_mask, width, height, size, **kwargs), compress_level)
+
+def render_image(Z, land_mask, width=100, height=100, size=None, format='png',
+                 encode_options=None, **kwargs):
+    """
+    将高程数据渲染并编码为指定格式，调色板PNG直接使用颜色索引图
+
+    参数:
+        format: ranmap_encode.IMAGE_FORMATS 之一
+        encode_options: 传给 ranmap_encode.encode_image 的参数字典
+
+    返回:
+        编码后的字节串
+    """
+    indices, palette = render_indexed(Z, land_mask, width, height, size, **kwargs)
+    return ranmap_encode.encode_image(indices, format, palette=palette, **(encode_options or {}))
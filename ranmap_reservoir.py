@@ -0,0 +1,150 @@
+"""
+预生成地图储备池
+
+为每组生成参数在后台预先生成若干张编码好的地图，请求新地图时直接取出，
+取出后异步补充。储备池为空时请求等待正在生成的下一张地图，而不是另起一次生成。
+储备池在 asyncio 事件循环中使用，地图的实际生成由调用方提供的协程完成。
+"""
+import asyncio
+from collections import OrderedDict, deque
+
+# 每组参数预生成的地图数
+DEFAULT_DEPTH = 2
+
+# 同时保留储备的参数组数，超出时淘汰最久未使用的一组
+DEFAULT_MAX_KEYS = 4
+
+class _Pool:
+    __slots__ = ('items', 'waiters', 'task')
+
+    def __init__(self):
+        self.items = deque()
+        self.waiters = deque()
+        self.task = None
+
+class MapReservoir:
+    """
+    按参数分组的地图储备池
+
+    参数:
+        produce: 协程函数 produce(key) -> (数据, 种子)，失败时数据为 None 或抛出异常
+        depth: 每组参数保留的地图数
+        max_keys: 同时保留储备的参数组数
+    """
+    def __init__(self, produce, depth=DEFAULT_DEPTH, max_keys=DEFAULT_MAX_KEYS):
+        self.produce = produce
+        self.depth = depth
+        self.max_keys = max_keys
+        self._pools = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _pool(self, key):
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = self._pools[key] = _Pool()
+            while len(self._pools) > self.max_keys:
+                # 淘汰时保留仍有请求在等待的参数组
+                for old_key, old in self._pools.items():
+                    if old_key != key and not old.waiters:
+                        self._discard(old_key)
+                        break
+                else:
+                    break
+        self._pools.move_to_end(key)
+        return pool
+
+    def _discard(self, key):
+        pool = self._pools.pop(key)
+        if pool.task is not None:
+            pool.task.cancel()
+
+    def _refill(self, key, pool):
+        """确保该参数组有一个补充任务在运行"""
+        if self.depth > 0 or pool.waiters:
+            if pool.task is None or pool.task.done():
+                pool.task = asyncio.ensure_future(self._produce_loop(key, pool))
+
+    async def _produce_loop(self, key, pool):
+        while len(pool.items) < self.depth or pool.waiters:
+            try:
+                data, seed = await self.produce(key)
+            except Exception as e:
+                # 异常（例如生成队列已满）原样交给等待者，不再继续补充
+                while pool.waiters:
+                    waiter = pool.waiters.popleft()
+                    if not waiter.done():
+                        waiter.set_exception(e)
+                return
+            if data is None:
+                # 生成失败：通知等待者，不再继续补充以免反复失败
+                while pool.waiters:
+                    waiter = pool.waiters.popleft()
+                    if not waiter.done():
+                        waiter.set_result((None, seed))
+                return
+            while pool.waiters:
+                waiter = pool.waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result((data, seed))
+                    break
+            else:
+                pool.items.append((data, seed))
+
+    def prime(self, key):
+        """开始在后台为一组参数预生成地图"""
+        self._refill(key, self._pool(key))
+
+    def take(self, key):
+        """
+        立即取出一张就绪的地图，返回 (数据, 种子)；储备池为空时返回 None，
+        调用方自行生成，储备池在后台补充
+        """
+        item = self._take(key)
+        if item is None:
+            self.misses += 1
+        return item
+
+    def _take(self, key):
+        pool = self._pool(key)
+        item = pool.items.popleft() if pool.items else None
+        if item is not None:
+            self.hits += 1
+        self._refill(key, pool)
+        return item
+
+    async def get(self, key):
+        """
+        取出一张地图，返回 (数据, 种子)；储备池为空时等待下一张生成完成
+
+        异常:
+            生成时抛出的异常
+        """
+        item = self._take(key)
+        if item is not None:
+            return item
+        self.misses += 1
+        pool = self._pool(key)
+        waiter = asyncio.get_running_loop().create_future()
+        pool.waiters.append(waiter)
+        self._refill(key, pool)
+        item = await waiter
+        self._refill(key, pool)
+        return item
+
+    def stats(self):
+        """
+        储备池状态：总命中/未命中次数，以及每组参数的就绪地图数和等待中的请求数
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'depth': self.depth,
+            'pools': [{'key': list(key), 'ready': len(pool.items), 'waiting': len(pool.waiters)}
+                      for key, pool in self._pools.items()],
+        }
+
+    def close(self):
+        """取消所有补充任务"""
+        for key in list(self._pools):
+            self._discard(key)
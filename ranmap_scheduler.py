@@ -0,0 +1,175 @@
+"""
+地图生成任务调度器
+
+位于服务器和生成进程池之间：
+- 排队任务数有上限，队列已满时立即拒绝（SchedulerFull），由服务器返回“繁忙”响应；
+- 按优先级分类（PRIORITIES 中靠前的优先），同一优先级内按客户端轮转，
+  避免单个客户端的大量请求占满进程池；
+- 请求方取消等待时，排队中的任务直接移除，运行中的任务通过共享取消标志
+  在下一个生成阶段之间停止（见 mapMapGenerator.cancel_check）。
+调度器在 asyncio 事件循环中使用。
+"""
+import asyncio
+import functools
+import multiprocessing
+from collections import OrderedDict, deque
+
+# 优先级分类，靠前的优先：交互式客户端、批量客户端、后台预生成
+PRIORITIES = ('interactive', 'bulk', 'background')
+
+DEFAULT_PRIORITY = 'interactive'
+
+# 默认排队任务数上限
+DEFAULT_MAX_QUEUE = 64
+
+class SchedulerFull(Exception):
+    """排队任务数已达上限"""
+
+def create_cancel_flags(workers):
+    """
+    创建与工作进程共享的取消标志数组，每个同时运行的任务占用一个
+    """
+    return multiprocessing.Array('b', workers, lock=False)
+
+class _Job:
+    __slots__ = ('function', 'args', 'future', 'priority', 'client', 'slot', 'started')
+
+    def __init__(self, function, args, future, priority, client):
+        self.function = function
+        self.args = args
+        self.future = future
+        self.priority = priority
+        self.client = client
+        self.slot = None
+        self.started = False
+
+class GenerationScheduler:
+    """
+    带优先级、按客户端公平轮转和取消功能的生成任务调度器
+
+    参数:
+        executor: 执行任务的进程池
+        workers: 同时运行的任务数（通常等于进程池大小）
+        max_queue: 排队（尚未运行）的任务数上限
+        cancel_flags: create_cancel_flags 创建的共享标志，为空时运行中的任务不能取消
+    """
+    def __init__(self, executor, workers, max_queue=DEFAULT_MAX_QUEUE, cancel_flags=None):
+        self.executor = executor
+        self.workers = workers
+        self.max_queue = max_queue
+        self.cancel_flags = cancel_flags
+        # 优先级 -> {客户端: 任务队列}，按客户端轮转
+        self._queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self._free_slots = list(range(len(cancel_flags))) if cancel_flags is not None else []
+        self.queued = 0
+        self.running = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.cancelled = 0
+        self.completed = 0
+
+    async def run(self, function, *args, priority=DEFAULT_PRIORITY, client=None):
+        """
+        提交任务并等待结果，任务以 function(*args, cancel_slot=下标) 的形式在进程池中运行
+
+        参数:
+            priority: PRIORITIES 之一
+            client: 客户端标识，同一优先级内各客户端轮流执行
+
+        异常:
+            SchedulerFull: 队列已满
+            ValueError: 未知的优先级
+        """
+        if priority not in self._queues:
+            raise ValueError(f"未知的优先级: {priority}")
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise SchedulerFull('生成队列已满')
+
+        job = _Job(function, args, asyncio.get_running_loop().create_future(), priority, client)
+        self._queues[priority].setdefault(client, deque()).append(job)
+        self.queued += 1
+        self.submitted += 1
+        self._dispatch()
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            self._cancel(job)
+            raise
+
+    def _cancel(self, job):
+        if not job.started:
+            clients = self._queues[job.priority]
+            queue = clients.get(job.client)
+            if queue is not None and job in queue:
+                queue.remove(job)
+                if not queue:
+                    del clients[job.client]
+                self.queued -= 1
+                self.cancelled += 1
+        elif job.slot is not None:
+            # 运行中的任务在下一个生成阶段之间停止
+            self.cancel_flags[job.slot] = 1
+            self.cancelled += 1
+
+    def _next_job(self):
+        for priority in PRIORITIES:
+            clients = self._queues[priority]
+            if clients:
+                client, queue = next(iter(clients.items()))
+                job = queue.popleft()
+                if queue:
+                    clients.move_to_end(client)
+                else:
+                    del clients[client]
+                self.queued -= 1
+                return job
+        return None
+
+    def _dispatch(self):
+        while self.running < self.workers:
+            job = self._next_job()
+            if job is None:
+                return
+            job.started = True
+            if self._free_slots:
+                job.slot = self._free_slots.pop()
+                self.cancel_flags[job.slot] = 0
+            self.running += 1
+            asyncio.ensure_future(self._execute(job))
+
+    async def _execute(self, job):
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(
+                self.executor, functools.partial(job.function, *job.args, cancel_slot=job.slot))
+        except asyncio.CancelledError:
+            job.future.cancel()
+            raise
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+            self.completed += 1
+        finally:
+            self.running -= 1
+            if job.slot is not None:
+                self._free_slots.append(job.slot)
+            self._dispatch()
+
+    def stats(self):
+        """
+        调度器状态：各优先级排队数、运行数和累计的提交、拒绝、取消、完成次数
+        """
+        return {
+            'queued': {priority: sum(len(queue) for queue in clients.values())
+                       for priority, clients in self._queues.items()},
+            'running': self.running,
+            'max_queue': self.max_queue,
+            'submitted': self.submitted,
+            'rejected': self.rejected,
+            'cancelled': self.cancelled,
+            'completed': self.completed,
+        }
@@ -1,261 +1,803 @@
-import socket
-import threading
+import asyncio
+import codecs
 import json
 import base64
-import io
 import sys
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
 # 添加当前目录到Python路径
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from ranmap import mapMapGenerator
-import matplotlib.pyplot as plt
+from ranmap import REFERENCE_RESOLUTION, RENDERERS, new_seed
+from ranmap_batch import generate_one, init_worker
+import ranmap_encode
+import ranmap_protocol
+import ranmap_trace
+from ranmap_reservoir import MapReservoir, DEFAULT_DEPTH
+from ranmap_cache import RenderCache, DEFAULT_MAX_BYTES
+from ranmap_metrics import ServerMetrics, process_rss_bytes, prometheus_text
+from ranmap_scheduler import (GenerationScheduler, SchedulerFull, create_cancel_flags,
+                              PRIORITIES, DEFAULT_PRIORITY, DEFAULT_MAX_QUEUE)
+
+# 单个请求的最大长度（字符）
+MAX_REQUEST_SIZE = 1 << 20
+
+# 二进制协议请求帧的负载上限（字节），现有命令都不使用请求负载
+MAX_REQUEST_PAYLOAD = 0
+
+_decoder = json.JSONDecoder()
+
+# matplotlib渲染器的输出分辨率
+RENDER_DPI = 150
+
+# 默认输出格式，请求可用 'format' 选择 ranmap_encode.available_formats() 中的其他格式
+DEFAULT_FORMAT = 'png'
+
+# 请求的 'encode_options' 中允许的编码参数（见 ranmap_encode.encode_image）
+ENCODE_OPTIONS = ('compress_level', 'png_filter', 'strategy', 'quality', 'lossless')
+
+# 整数编码参数的取值范围
+ENCODE_OPTION_RANGES = {'compress_level': (0, 9), 'quality': (1, 100)}
+
+# 请求可使用的网格分辨率范围，更大的值按 MAX_RESOLUTION 生成；
+# 等高线至少需要 2x2 的网格
+MIN_RESOLUTION = 2
+MAX_RESOLUTION = 1000
+
+# 渐进式预览使用的网格分辨率和图像较长边像素数
+PREVIEW_RESOLUTION = 40
+PREVIEW_SIZE = 256
+
+# 分别统计指标的命令，其他命令计入 'unknown'
+COMMANDS = ('generate', 'get_image', 'save_image', 'stats', 'stop_server')
+
+# 处理请求期间检查客户端是否已断开的间隔（秒）
+DISCONNECT_POLL_INTERVAL = 0.05
+
+# 二进制协议中每个连接同时处理的带 'id' 请求数上限，超过时暂停读取该连接的新请求
+MAX_PIPELINED_REQUESTS = 16
+
+class _PrefixedReader:
+    """先返回协议检测时已读取的数据，再从底层 StreamReader 读取"""
+    def __init__(self, initial, reader):
+        self.initial = initial
+        self.reader = reader
+    
+    def at_eof(self):
+        return not self.initial and self.reader.at_eof()
+    
+    async def readexactly(self, n):
+        if not self.initial:
+            return await self.reader.readexactly(n)
+        head, self.initial = self.initial[:n], self.initial[n:]
+        if len(head) == n:
+            return head
+        try:
+            return head + await self.reader.readexactly(n - len(head))
+        except asyncio.IncompleteReadError as e:
+            raise asyncio.IncompleteReadError(head + e.partial, n)
 
 class RandomMapServer:
-    def __init__(self, host='localhost', port=5000):
+    def __init__(self, host='localhost', port=5000, resolution=REFERENCE_RESOLUTION,
+                 renderer='matplotlib', workers=None, reservoir_depth=DEFAULT_DEPTH,
+                 cache_bytes=DEFAULT_MAX_BYTES, metrics_port=None, max_queue=DEFAULT_MAX_QUEUE,
+                 max_resolution=MAX_RESOLUTION):
         self.host = host
         self.port = port
+        self.resolution = resolution
+        # 请求中的分辨率不超过该值，避免单个请求在工作进程中分配过大的网格
+        self.max_resolution = max_resolution
+        self.renderer = renderer
+        # 地图生成进程数，为空时使用CPU核数
+        self.workers = workers or os.cpu_count() or 1
+        # 每组参数预生成的地图数，为0时不预生成
+        self.reservoir_depth = reservoir_depth
+        self.reservoir = None
+        # 所有连接共享的渲染结果缓存，按 (种子, 生成参数, 输出选项) 索引
+        self.cache = RenderCache(cache_bytes)
+        # Prometheus 文本格式指标的HTTP端口，为空时不启动
+        self.metrics_port = metrics_port
+        self.metrics = ServerMetrics()
+        self.metrics_socket = None
         self.server_socket = None
         self.running = False
+        # 当前地图的图像数据（bytes）及其MIME类型
         self.current_image_data = None
+        self.current_content_type = ranmap_encode.CONTENT_TYPES[DEFAULT_FORMAT]
+        self.current_seed = None
+        self.loop = None
+        self.executor = None
+        # 生成任务调度器，排队任务数超过 max_queue 时拒绝新请求
+        self.max_queue = max_queue
+        self.scheduler = None
+        self._stop_event = None
+        self._pregenerate = None
+        
+    async def render(self, resolution=None, seed=None, renderer=None, size=None,
+                     priority=DEFAULT_PRIORITY, client=None, format=DEFAULT_FORMAT,
+                     encode_options=None):
+        """
+        生成地图，返回(图像数据, 种子)，失败时图像数据为None
         
-    def generate_map_image(self):
-        """生成地图并返回base64编码的图像数据"""
+        size 为栅格渲染器输出图像较长边的像素数，为空时使用默认值。
+        format、encode_options 为输出格式和编码参数（见 ranmap_encode.encode_image）。
+        结果按种子和参数缓存，同一地图的并发请求只生成一次。
+        生成任务按 priority 和 client 由调度器排队，在独立进程中进行，
+        不占用事件循环，也不共享pyplot的全局状态。
+        
+        异常:
+            SchedulerFull: 生成队列已满
+        """
+        params = {
+            'width': 100, 'height': 100, 'num_points': 80,
+            'resolution': int(resolution or self.resolution),
+            'renderer': renderer or self.renderer,
+        }
+        # 先确定种子，使新地图同样进入缓存，之后按种子请求时直接命中
+        seed = new_seed() if seed is None else int(seed)
+        encode_options = dict(encode_options or {})
+        options = {'size': size, 'dpi': RENDER_DPI, 'format': format,
+                   'encode_options': encode_options}
+        key = ((seed,) + tuple(sorted(params.items())) +
+               (('size', size), ('dpi', RENDER_DPI), ('format', format)) +
+               tuple(sorted(encode_options.items())))
+        image_data = await self.cache.get(
+            key, lambda: self._render_uncached(seed, params, options, priority, client))
+        return image_data, seed
+    
+    async def _render_uncached(self, seed, params, options=None, priority=DEFAULT_PRIORITY,
+                               client=None):
+        """经调度器在进程池中生成一张地图，返回图像数据，失败时返回None"""
+        print(f"[{datetime.now()}] 开始生成地图...")
+        # 启用追踪时工作进程随结果返回本次生成的事件，合并到服务器的追踪缓冲区
+        outputs = ('png', 'trace') if ranmap_trace.is_enabled() else ('png',)
+        self.metrics.pending_jobs += 1
         try:
-            print(f"[{datetime.now()}] 开始生成地图...")
-            
-            # 设置随机数种子以确保每次生成不同的地图
-            import random
-            import time
-            import numpy as np
-            random.seed(time.time())
-            np.random.seed(int(time.time() * 1000) % 2**32)
-            
-            # 使用非GUI后端避免线程问题
-            import matplotlib
-            matplotlib.use('Agg')  # 使用非交互式后端
-            import matplotlib.pyplot as plt
-            
-            # 重新导入ranmap模块以确保使用正确的后端
-            from ranmap import mapMapGenerator
-            
-            generator = mapMapGenerator(width=100, height=100, num_points=80)
-            fig, ax, main_points, small_terrain_list = generator.generate_map()
+            result = await self.scheduler.run(generate_one, seed, params, outputs, options,
+                                              priority=priority, client=client)
+        except SchedulerFull:
+            raise
+        except Exception as e:
+            print(f"[{datetime.now()}] 生成地图时出错: {e}")
+            return None
+        finally:
+            self.metrics.pending_jobs -= 1
+        if 'trace' in result:
+            ranmap_trace.merge(result['trace'])
+        print(f"[{datetime.now()}] 地图生成完成 (seed={result['seed']})")
+        return result['png']
+    
+    def _map_key(self, resolution=None, renderer=None, format=DEFAULT_FORMAT):
+        """储备池中区分地图的生成参数"""
+        return int(resolution or self.resolution), renderer or self.renderer, format
+    
+    @staticmethod
+    def _request_seed(request):
+        """
+        请求中的种子（非负整数，可以是数字字符串），未指定时为 None
+        
+        异常:
+            ValueError: 种子类型或取值无效
+        """
+        seed = request.get('seed')
+        if seed is None:
+            return None
+        if isinstance(seed, bool) or not isinstance(seed, (int, str)):
+            raise ValueError(f'无效的种子: {seed!r}')
+        try:
+            seed = int(seed)
+        except ValueError:
+            raise ValueError(f'无效的种子: {seed!r}')
+        if seed < 0:
+            raise ValueError(f'种子必须是非负整数: {seed}')
+        return seed
+    
+    def _generation_params(self, request):
+        """
+        请求的种子、分辨率和渲染器 (seed, resolution, renderer)，未指定的种子为 None
+        
+        分辨率超过 max_resolution 时按 max_resolution 生成。
+        
+        异常:
+            ValueError: 参数类型或取值无效
+        """
+        seed = self._request_seed(request)
+        
+        resolution = request.get('resolution')
+        if resolution is None:
+            resolution = self.resolution
+        elif isinstance(resolution, bool) or not isinstance(resolution, int):
+            raise ValueError(f'无效的分辨率: {resolution!r}')
+        if resolution < MIN_RESOLUTION:
+            raise ValueError(f'分辨率必须是不小于 {MIN_RESOLUTION} 的整数: {resolution}')
+        resolution = min(resolution, self.max_resolution)
+        
+        renderer = request.get('renderer') or self.renderer
+        if renderer not in RENDERERS:
+            raise ValueError(f'未知的渲染器: {renderer!r}')
+        return seed, resolution, renderer
+    
+    @staticmethod
+    def _output_options(request):
+        """
+        请求的输出格式和编码参数 (format, encode_options)
+        
+        异常:
+            ValueError: 格式不可用，或编码参数未知、类型或取值无效
+        """
+        format = request.get('format') or DEFAULT_FORMAT
+        if not isinstance(format, str) or format not in ranmap_encode.available_formats():
+            raise ValueError(f'不支持的输出格式: {format}')
+        encode_options = request.get('encode_options') or {}
+        if not isinstance(encode_options, dict):
+            raise ValueError('encode_options 必须是对象')
+        unknown = set(encode_options) - set(ENCODE_OPTIONS)
+        if unknown:
+            raise ValueError(f'未知的编码参数: {sorted(unknown)}')
+        # 参数值会成为缓存键的一部分，必须是可哈希的基本类型
+        for name, value in encode_options.items():
+            if name in ENCODE_OPTION_RANGES:
+                low, high = ENCODE_OPTION_RANGES[name]
+                if isinstance(value, bool) or not isinstance(value, int) or not low <= value <= high:
+                    raise ValueError(f'{name} 必须是 {low} 到 {high} 之间的整数')
+            elif name == 'png_filter':
+                if not isinstance(value, str) or value not in ranmap_encode.PNG_FILTERS:
+                    raise ValueError(f'png_filter 必须是 {list(ranmap_encode.PNG_FILTERS)} 之一')
+            elif name == 'strategy':
+                if not isinstance(value, str) or value not in ranmap_encode.ZLIB_STRATEGIES:
+                    raise ValueError(f'strategy 必须是 {list(ranmap_encode.ZLIB_STRATEGIES)} 之一')
+            elif not isinstance(value, bool):
+                raise ValueError(f'{name} 必须是布尔值')
+        return format, encode_options
+    
+    async def _produce(self, key):
+        resolution, renderer, format = key
+        # 预生成让位于客户端请求；队列已满时 SchedulerFull 交给等待的请求
+        return await self.render(resolution, None, renderer, priority='background',
+                                 client='reservoir', format=format)
+    
+    async def _render_progressive(self, seed, resolution, renderer, emit, priority=DEFAULT_PRIORITY,
+                                  client=None, format=DEFAULT_FORMAT, encode_options=None):
+        """
+        先发送低分辨率预览，再返回完整地图 (图像数据, 种子)
+        
+        预览与完整地图使用同一种子，在粗网格上用栅格渲染器生成小PNG，
+        先于完整地图提交到进程池；完整地图已就绪（储备池或缓存命中）时不发送预览。
+        """
+        if seed is None:
+            # 储备池中的地图使用默认编码参数
+            item = None if encode_options else self.reservoir.take(
+                self._map_key(resolution, renderer, format))
+            if item is not None:
+                return item
+            seed = new_seed()
+        start = time.perf_counter()
+        
+        def elapsed_ms():
+            return round((time.perf_counter() - start) * 1e3, 1)
+        
+        preview = asyncio.ensure_future(self.render(PREVIEW_RESOLUTION, seed, 'raster', PREVIEW_SIZE,
+                                                    priority, client))
+        final = asyncio.ensure_future(self.render(resolution, seed, renderer, None, priority, client,
+                                                  format, encode_options))
+        try:
+            await emit({'event': 'progress', 'stage': 'queued', 'seed': seed, 'elapsed_ms': 0.0})
             
-            # 彻底清除所有标题和文本
-            ax.set_title('')
-            plt.title('')
-            fig.suptitle('')
+            await asyncio.wait((preview, final), return_when=asyncio.FIRST_COMPLETED)
+            if not final.done():
+                preview_data, _ = await preview
+                if preview_data:
+                    await emit({'event': 'preview', 'seed': seed, 'content_type': 'image/png',
+                                'resolution': PREVIEW_RESOLUTION, 'elapsed_ms': elapsed_ms()},
+                               preview_data)
+                    await emit({'event': 'progress', 'stage': 'preview', 'seed': seed,
+                                'elapsed_ms': elapsed_ms()})
             
-            # 强制清除所有可能的文本元素（更保守的方法）
+            image_data, seed = await final
+        finally:
+            # 请求被取消或失败时同时取消两个生成
+            preview.cancel()
+            final.cancel()
+        await emit({'event': 'progress', 'stage': 'render', 'seed': seed, 'elapsed_ms': elapsed_ms()})
+        return image_data, seed
+    
+    async def handle_request(self, request, emit=None, client=None):
+        """
+        处理一条命令并记录请求数和延迟，参数和返回值同 _dispatch
+        
+        生成队列已满时返回 code 为 503 的错误响应。
+        """
+        command = request.get('command')
+        start = time.perf_counter()
+        status = 'error'
+        try:
             try:
-                # 只清除文本对象，不删除其他必要的子元素
-                for txt in ax.texts[:]:
-                    txt.remove()
-                for txt in fig.texts[:]:
-                    txt.remove()
-                # 不清除艺术家对象和子元素，避免破坏图形结构
-            except Exception as text_remove_error:
-                print(f"清除文本时出错: {text_remove_error}")
-            
-            # 在保存之前再次清除标题
-            ax.set_title('')
-            plt.title('')
-            fig.suptitle('')
-            
-            # 将图像保存到内存
-            buffer = io.BytesIO()
-            fig.savefig(buffer, format='PNG', dpi=150, bbox_inches='tight', 
-                       facecolor='white', edgecolor='none')
-            buffer.seek(0)
-            
-            # 在保存后彻底清除所有标题和文本（防止savefig添加标题）
-            ax.set_title('')
-            plt.title('')
-            fig.suptitle('')
-            
-            # 再次强制清除所有可能的文本元素（更保守的方法）
+                response, payload = await self._dispatch(request, emit, client)
+                status = response.get('status', status)
+            except SchedulerFull:
+                status = 'rejected'
+                response, payload = {
+                    'status': 'error',
+                    'code': 503,
+                    'message': '服务器繁忙，请稍后重试'
+                }, None
+            return response, payload
+        except asyncio.CancelledError:
+            status = 'cancelled'
+            raise
+        finally:
+            self.metrics.observe_request(command if command in COMMANDS else 'unknown', status,
+                                         time.perf_counter() - start)
+    
+    async def _dispatch(self, request, emit=None, client=None):
+        """
+        处理一条命令
+        
+        参数:
+            request: 请求字典，'priority' 为生成任务的优先级（PRIORITIES 之一，默认交互式），
+                     'format' 与 'encode_options' 为生成地图的输出格式和编码参数；
+                     save_image 的 'seed' 为要保存的地图，与当前地图不符时不保存
+            emit: 协程函数 emit(header, payload)，在最终响应之前发送中间事件；
+                  为空时（旧的JSON协议）不使用渐进式预览
+            client: 客户端标识，同一优先级内各客户端轮流生成
+        
+        返回:
+            response: 响应字典
+            payload: 响应附带的图像数据（bytes），没有时为 None
+        """
+        command = request.get('command')
+        priority = request.get('priority', DEFAULT_PRIORITY)
+        if priority not in PRIORITIES:
+            return {
+                'status': 'error',
+                'message': f'未知的优先级: {priority}'
+            }, None
+        
+        if command == 'generate':
+            print(f"[{datetime.now()}] 收到重新生成请求")
             try:
-                # 只清除文本对象，不删除其他必要的子元素
-                for txt in ax.texts[:]:
-                    txt.remove()
-                for txt in fig.texts[:]:
-                    txt.remove()
-                # 不清除艺术家对象和子元素，避免破坏图形结构
-            except Exception as text_remove_error:
-                print(f"保存后清除文本时出错: {text_remove_error}")
-            
-            # 最后一次清除标题
-            ax.set_title('')
-            plt.title('')
-            fig.suptitle('')
-            
-            # 转换为base64
-            image_data = base64.b64encode(buffer.getvalue()).decode('utf-8')
+                seed, resolution, renderer = self._generation_params(request)
+                format, encode_options = self._output_options(request)
+            except ValueError as e:
+                return {
+                    'status': 'error',
+                    'message': str(e)
+                }, None
+            if emit is not None and request.get('progressive'):
+                image_data, seed = await self._render_progressive(seed, resolution, renderer, emit,
+                                                                  priority, client, format,
+                                                                  encode_options)
+            else:
+                item = None
+                if seed is None and not encode_options:
+                    # 未指定种子时直接取预生成的地图；储备池为空时按请求的优先级生成，
+                    # 不等待后台优先级的补充任务
+                    item = self.reservoir.take(self._map_key(resolution, renderer, format))
+                if item is not None:
+                    image_data, seed = item
+                else:
+                    image_data, seed = await self.render(resolution, seed, renderer, None, priority,
+                                                         client, format, encode_options)
             
-            # 清理
-            plt.close(fig)
-            buffer.close()
+            if image_data:
+                self.current_image_data = image_data
+                self.current_content_type = ranmap_encode.CONTENT_TYPES[format]
+                self.current_seed = seed
+                return {
+                    'status': 'success',
+                    'seed': seed,
+                    'content_type': self.current_content_type,
+                    'message': '地图已生成'
+                }, image_data
+            return {
+                'status': 'error',
+                'message': '生成地图失败'
+            }, None
+        
+        if command == 'get_image':
+            if self.current_image_data is None and self._pregenerate is not None:
+                await asyncio.shield(self._pregenerate)
+            if self.current_image_data is None:
+                self.current_image_data, self.current_seed = await self.render(
+                    priority=priority, client=client)
             
-            print(f"[{datetime.now()}] 地图生成完成")
-            return image_data
+            if self.current_image_data:
+                return {
+                    'status': 'success',
+                    'seed': self.current_seed,
+                    'content_type': self.current_content_type,
+                    'message': '当前地图'
+                }, self.current_image_data
+            return {
+                'status': 'error',
+                'message': '无法获取地图'
+            }, None
+        
+        if command == 'save_image':
+            filename = request.get('filename', 'terrain_map.png')
+            try:
+                seed = self._request_seed(request)
+            except ValueError as e:
+                return {
+                    'status': 'error',
+                    'message': str(e)
+                }, None
+            if self.current_image_data is None and self._pregenerate is not None:
+                await asyncio.shield(self._pregenerate)
+            if seed is not None and seed != self.current_seed:
+                # 客户端看到的地图不是当前地图（仍在生成，或已被其他请求替换），不保存其他地图
+                return {
+                    'status': 'error',
+                    'message': f'当前地图不是种子 {seed} 的地图，未保存'
+                }, None
+            if self.current_image_data:
+                try:
+                    await asyncio.to_thread(self._write_file, filename, self.current_image_data)
+                    return {
+                        'status': 'success',
+                        'message': f'图片已保存为: {filename}'
+                    }, None
+                except Exception as e:
+                    return {
+                        'status': 'error',
+                        'message': f'保存失败: {e}'
+                    }, None
+            return {
+                'status': 'error',
+                'message': '没有可保存的图片'
+            }, None
+        
+        if command == 'stats':
+            response = {
+                'status': 'success',
+                'reservoir': self.reservoir.stats(),
+                'cache': self.cache.stats(),
+                'scheduler': self.scheduler.stats(),
+                'metrics': self.metrics.snapshot(),
+                'worker_rss': {str(pid): rss for pid, rss in self.worker_rss().items()},
+                'message': '服务器状态'
+            }
+            if ranmap_trace.is_enabled():
+                # 包括工作进程中记录的各生成阶段
+                response['trace'] = ranmap_trace.summary()
+            return response, None
+        
+        if command == 'stop_server':
+            print(f"[{datetime.now()}] 收到停止服务器请求")
+            # 先发送响应，再在下一轮事件循环中停止服务器
+            asyncio.get_running_loop().call_soon(self._stop_event.set)
+            return {
+                'status': 'success',
+                'message': '服务器正在停止'
+            }, None
+        
+        return {
+            'status': 'error',
+            'message': '未知命令'
+        }, None
+    
+    def worker_rss(self):
+        """
+        各生成进程的常驻内存 {进程号: 字节数}
+        
+        ProcessPoolExecutor 没有公开工作进程列表，这里读取私有属性 _processes
+        （CPython 中为 {进程号: 进程} 字典，由执行器的管理线程增删）。
+        该属性不存在、类型不符或读取时正被修改都返回空字典，只影响指标，不影响服务。
+        """
+        processes = getattr(self.executor, '_processes', None)
+        if not isinstance(processes, dict):
+            return {}
+        try:
+            pids = list(processes)
+        except RuntimeError:
+            # 管理线程正在增删工作进程
+            return {}
+        return {pid: process_rss_bytes(pid) for pid in pids if isinstance(pid, int)}
+    
+    async def _handle_while_connected(self, request, reader, writer, emit=None):
+        """
+        处理一条请求；客户端在处理期间断开连接时取消处理，
+        排队或运行中的生成随之取消（运行中的生成在下一个阶段之间停止）
+        
+        读端收到EOF即视为断开：正常关闭连接的客户端同样只发送FIN，在写入失败之前
+        无法与半关闭区分。发送完请求后半关闭（shutdown(SHUT_WR)）并等待响应的客户端
+        须在请求中设置 'half_close': true，这时只在连接已关闭（写入失败）时取消。
+        """
+        task = asyncio.ensure_future(self.handle_request(request, emit,
+                                                         writer.get_extra_info('peername')))
+        half_close = request.get('half_close') is True
+        while True:
+            done, _ = await asyncio.wait((task,), timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if writer.is_closing() or (not half_close and reader.at_eof()):
+                task.cancel()
+                raise ConnectionResetError('客户端已断开，请求已取消')
+    
+    async def _send(self, writer, data):
+        writer.write(data)
+        self.metrics.bytes_sent += len(data)
+        await writer.drain()
+    
+    @staticmethod
+    def _write_file(filename, data):
+        with open(filename, 'wb') as f:
+            f.write(data)
+    
+    @staticmethod
+    def _parse_requests(buffer):
+        """
+        从缓冲区中解析出所有完整的JSON请求
+        
+        返回:
+            requests: 解析出的请求（无效JSON以 None 表示）
+            buffer: 剩余的不完整数据
+        """
+        requests = []
+        while True:
+            buffer = buffer.lstrip()
+            if not buffer:
+                return requests, buffer
+            try:
+                request, end = _decoder.raw_decode(buffer)
+            except json.JSONDecodeError as e:
+                # 错误出现在数据末尾时说明请求尚未接收完整，继续等待
+                incomplete = e.pos >= len(buffer) or e.msg.startswith('Unterminated string')
+                if incomplete and len(buffer) < MAX_REQUEST_SIZE:
+                    return requests, buffer
+                requests.append(None)
+                return requests, ''
+            requests.append(request if isinstance(request, dict) else None)
+            buffer = buffer[end:]
+    
+    async def handle_client(self, reader, writer):
+        """
+        处理客户端连接，连接内的请求按顺序处理
+        
+        以 ranmap_protocol.PROTOCOL_MAGIC 开头的连接使用二进制分帧协议，
+        其余连接使用旧的JSON协议（图像以base64编码放在 'image' 字段中）。
+        """
+        address = writer.get_extra_info('peername')
+        print(f"[{datetime.now()}] 客户端连接: {address}")
+        self.metrics.connection_opened()
+        try:
+            # 读取足够判断协议的数据
+            magic = ranmap_protocol.PROTOCOL_MAGIC
+            data = b''
+            while len(data) < len(magic) and magic.startswith(data):
+                chunk = await reader.read(65536)
+                if not chunk:
+                    break
+                data += chunk
             
+            if data.startswith(magic):
+                await self._serve_binary(_PrefixedReader(data, reader), writer)
+            elif data:
+                await self._serve_json(data, reader, writer)
+                    
+        except asyncio.CancelledError:
+            # 服务器停止时仍打开的连接
+            pass
         except Exception as e:
-            print(f"[{datetime.now()}] 生成地图时出错: {e}")
-            return None
+            print(f"[{datetime.now()}] 客户端处理错误: {e}")
+        finally:
+            self.metrics.connection_closed()
+            writer.close()
     
-    def handle_client(self, client_socket):
-        """处理客户端请求"""
+    async def _serve_binary(self, reader, writer):
+        """
+        二进制分帧协议：每个请求帧得到一个响应帧，图像作为原始字节负载发送
+        
+        带 'id' 的请求并发处理（流水线），其事件帧和响应帧带回同一 'id'，可能不按请求顺序到达；
+        不带 'id' 的请求按顺序处理。连接断开时取消未完成的请求，
+        设置了 'half_close' 的请求在客户端半关闭后仍发送响应。
+        """
+        send_lock = asyncio.Lock()
+        slots = asyncio.Semaphore(MAX_PIPELINED_REQUESTS)
+        pipelined = set()
+        
+        async def send(header, payload=b'', encoding=None):
+            # 并发的请求各自发送完整的帧，帧之间不交错
+            async with send_lock:
+                await self._send(writer, ranmap_protocol.encode_frame(header, payload, encoding))
+        
+        async def run_pipelined(request):
+            try:
+                await self._serve_frame(request, send,
+                                        lambda emit: self._handle_while_connected(
+                                            request, reader, writer, emit))
+            except (ConnectionError, OSError):
+                pass
+            finally:
+                slots.release()
+        
         try:
             while True:
-                data = client_socket.recv(1024).decode('utf-8')
-                if not data:
-                    break
-                
                 try:
-                    request = json.loads(data)
-                    command = request.get('command')
-                    
-                    if command == 'generate':
-                        print(f"[{datetime.now()}] 收到重新生成请求")
-                        image_data = self.generate_map_image()
-                        
-                        if image_data:
-                            response = {
-                                'status': 'success',
-                                'image': image_data,
-                                'message': '地图已生成'
-                            }
-                        else:
-                            response = {
-                                'status': 'error',
-                                'message': '生成地图失败'
-                            }
-                    
-                    elif command == 'get_image':
-                        if self.current_image_data is None:
-                            self.current_image_data = self.generate_map_image()
-                        
-                        if self.current_image_data:
-                            response = {
-                                'status': 'success',
-                                'image': self.current_image_data,
-                                'message': '当前地图'
-                            }
-                        else:
-                            response = {
-                                'status': 'error',
-                                'message': '无法获取地图'
-                            }
-                    
-                    elif command == 'save_image':
-                        filename = request.get('filename', 'terrain_map.png')
-                        if self.current_image_data:
-                            try:
-                                image_bytes = base64.b64decode(self.current_image_data)
-                                with open(filename, 'wb') as f:
-                                    f.write(image_bytes)
-                                response = {
-                                    'status': 'success',
-                                    'message': f'图片已保存为: {filename}'
-                                }
-                            except Exception as e:
-                                response = {
-                                    'status': 'error',
-                                    'message': f'保存失败: {e}'
-                                }
-                        else:
-                            response = {
-                                'status': 'error',
-                                'message': '没有可保存的图片'
-                            }
-                    
-                    elif command == 'stop_server':
-                        print(f"[{datetime.now()}] 收到停止服务器请求")
-                        response = {
-                            'status': 'success',
-                            'message': '服务器正在停止'
-                        }
-                        # 在新线程中延迟停止服务器，确保响应能发送给客户端
-                        import threading
-                        def delayed_stop():
-                            import time
-                            time.sleep(0.5)  # 等待响应发送
-                            self.stop()
-                            print(f"[{datetime.now()}] 服务器已停止")
-                            sys.exit(0)
-                        
-                        stop_thread = threading.Thread(target=delayed_stop)
-                        stop_thread.daemon = True
-                        stop_thread.start()
-                    
-                    else:
-                        response = {
-                            'status': 'error',
-                            'message': '未知命令'
-                        }
-                    
-                    # 发送响应
-                    response_json = json.dumps(response)
-                    client_socket.send(response_json.encode('utf-8'))
-                    
-                except json.JSONDecodeError:
+                    request, _ = await ranmap_protocol.read_frame(reader, MAX_REQUEST_PAYLOAD)
+                except ranmap_protocol.ProtocolError as e:
+                    # 帧边界已无法确定，回复错误后关闭连接
+                    await send({'status': 'error', 'message': str(e)})
+                    return
+                if request is None:
+                    if pipelined:
+                        await asyncio.gather(*pipelined, return_exceptions=True)
+                    return
+                
+                if 'id' in request:
+                    await slots.acquire()
+                    task = asyncio.ensure_future(run_pipelined(request))
+                    pipelined.add(task)
+                    task.add_done_callback(pipelined.discard)
+                else:
+                    await self._serve_frame(request, send,
+                                            lambda emit: self._handle_while_connected(
+                                                request, reader, writer, emit))
+        finally:
+            for task in pipelined:
+                task.cancel()
+            if pipelined:
+                await asyncio.gather(*pipelined, return_exceptions=True)
+    
+    @staticmethod
+    async def _serve_frame(request, send, handle):
+        """
+        处理一个请求帧并发送响应帧，请求带 'id' 时事件和响应中带回该 'id'
+        
+        处理出错时发送错误响应，保证每个请求都得到一个最终响应帧；连接错误向上传递。
+        
+        参数:
+            send: 协程函数 send(header, payload, encoding)
+            handle: handle(emit) 返回处理请求的协程，结果为 (response, payload)
+        """
+        async def emit(header, payload=b''):
+            if 'id' in request:
+                header = dict(header, id=request['id'])
+            await send(header, payload)
+        
+        try:
+            response, payload = await handle(emit)
+        except (ConnectionError, OSError):
+            raise
+        except Exception as e:
+            print(f"[{datetime.now()}] 处理请求时出错: {e}")
+            response, payload = {
+                'status': 'error',
+                'message': f'处理请求时出错: {e}'
+            }, None
+        if 'id' in request:
+            response['id'] = request['id']
+        payload = payload or b''
+        encoding = None
+        if payload:
+            response.setdefault('content_type', 'image/png')
+            encoding = ranmap_protocol.choose_encoding(request.get('accept_encoding'),
+                                                       response['content_type'], len(payload))
+        await send(response, payload, encoding)
+    
+    async def _serve_json(self, data, reader, writer):
+        """旧的JSON协议"""
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        buffer = ''
+        while data:
+            requests, buffer = self._parse_requests(buffer + decoder.decode(data))
+            for request in requests:
+                if request is None:
                     response = {
                         'status': 'error',
                         'message': '无效的JSON格式'
                     }
-                    client_socket.send(json.dumps(response).encode('utf-8'))
-                    
+                else:
+                    try:
+                        response, payload = await self._handle_while_connected(request, reader, writer)
+                    except (ConnectionError, OSError):
+                        raise
+                    except Exception as e:
+                        print(f"[{datetime.now()}] 处理请求时出错: {e}")
+                        response, payload = {
+                            'status': 'error',
+                            'message': f'处理请求时出错: {e}'
+                        }, None
+                    if payload:
+                        response['image'] = base64.b64encode(payload).decode('ascii')
+                
+                # 发送响应
+                await self._send(writer, json.dumps(response).encode('utf-8'))
+            
+            data = await reader.read(65536)
+    
+    async def _handle_metrics(self, reader, writer):
+        """最简单的HTTP端点：GET /metrics 返回 Prometheus 文本格式的指标"""
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[1].split('?')[0] in ('/', '/metrics'):
+                status = '200 OK'
+                body = prometheus_text(self.metrics, self.cache.stats(), self.reservoir.stats(),
+                                       self.worker_rss(), self.scheduler.stats()).encode('utf-8')
+            else:
+                status = '404 Not Found'
+                body = b'not found\n'
+            writer.write(f'HTTP/1.1 {status}\r\n'
+                         f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         f'Content-Length: {len(body)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode('latin-1') + body)
+            await writer.drain()
         except Exception as e:
-            print(f"[{datetime.now()}] 客户端处理错误: {e}")
+            print(f"[{datetime.now()}] 指标请求处理错误: {e}")
         finally:
-            client_socket.close()
+            writer.close()
     
-    def start(self):
-        """启动服务器"""
+    async def _pregenerate_first_map(self):
         try:
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
-            
+            image_data, seed = await self.reservoir.get(self._map_key())
+        except Exception as e:
+            # get_image 随后按需生成
+            print(f"[{datetime.now()}] 预生成地图失败: {e}")
+            return
+        if self.current_image_data is None:
+            self.current_image_data, self.current_seed = image_data, seed
+    
+    async def serve(self):
+        """服务器主协程：事件循环处理连接，地图生成交给进程池"""
+        self.loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        cancel_flags = create_cancel_flags(self.workers)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                            initargs=(cancel_flags,))
+        self.scheduler = GenerationScheduler(self.executor, self.workers, self.max_queue, cancel_flags)
+        self.reservoir = MapReservoir(self._produce, self.reservoir_depth)
+        metrics_server = None
+        try:
+            server = await asyncio.start_server(self.handle_client, self.host, self.port,
+                                                reuse_address=True)
+            self.server_socket = server.sockets[0]
             self.running = True
-            print(f"[{datetime.now()}] 服务器启动在 {self.host}:{self.port}")
+            print(f"[{datetime.now()}] 服务器启动在 {self.host}:{self.server_socket.getsockname()[1]} "
+                  f"({self.workers} 个生成进程)")
             
-            # 预生成第一张地图
-            self.current_image_data = self.generate_map_image()
+            if self.metrics_port is not None:
+                metrics_server = await asyncio.start_server(self._handle_metrics, self.host,
+                                                            self.metrics_port, reuse_address=True)
+                self.metrics_socket = metrics_server.sockets[0]
+                print(f"[{datetime.now()}] 指标端点: http://{self.host}:"
+                      f"{self.metrics_socket.getsockname()[1]}/metrics")
             
-            while self.running:
-                try:
-                    client_socket, address = self.server_socket.accept()
-                    print(f"[{datetime.now()}] 客户端连接: {address}")
-                    
-                    client_thread = threading.Thread(
-                        target=self.handle_client, 
-                        args=(client_socket,)
-                    )
-                    client_thread.daemon = True
-                    client_thread.start()
-                    
-                except socket.error as e:
-                    if self.running:
-                        print(f"[{datetime.now()}] 套接字错误: {e}")
-                    break
-                    
+            # 预生成第一张地图并填充储备池，不阻塞连接处理
+            self._pregenerate = asyncio.ensure_future(self._pregenerate_first_map())
+            
+            async with server:
+                await self._stop_event.wait()
+        finally:
+            self.running = False
+            if metrics_server is not None:
+                metrics_server.close()
+                await metrics_server.wait_closed()
+            self.reservoir.close()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            print(f"[{datetime.now()}] 服务器已停止")
+    
+    def start(self):
+        """启动服务器（阻塞直到服务器停止）"""
+        try:
+            asyncio.run(self.serve())
         except Exception as e:
             print(f"[{datetime.now()}] 服务器启动失败: {e}")
-        finally:
-            if self.server_socket:
-                self.server_socket.close()
     
     def stop(self):
-        """停止服务器"""
+        """停止服务器（可从其他线程调用）"""
+        if self.loop is not None and self._stop_event is not None and not self.loop.is_closed():
+            try:
+                self.loop.call_soon_threadsafe(self._stop_event.set)
+            except RuntimeError:
+                # 事件循环已经结束
+                pass
         self.running = False
-        if self.server_socket:
-            self.server_socket.close()
-        print(f"[{datetime.now()}] 服务器已停止")
 
 if __name__ == '__main__':
     server = RandomMapServer()
@@ -0,0 +1,249 @@
+"""
+生成流程的轻量级计时追踪
+
+在代码中用 span(name) 或 @traced(name) 标记各阶段，启用后记录每个区间的
+墙钟时间、线程CPU时间和（可选的）内存分配变化，可导出为 Chrome trace JSON
+（chrome://tracing 或 Perfetto 中打开）或汇总表。
+
+未启用时 span 只返回一个共享的空上下文，开销可以忽略。
+通过环境变量 RANMAP_TRACE 启用：'1' 只计时，'alloc' 同时用 tracemalloc 统计内存分配；
+也可以在运行时调用 enable() / disable()。
+最多保留 max_events 个最近的事件（环境变量 RANMAP_TRACE_MAX_EVENTS 或 enable 的参数），
+长时间运行的服务器开启追踪时内存占用有上限。
+
+生成在其他进程中进行时（服务器的进程池），工作进程用 collect() 收集一次调用记录的事件，
+随结果返回，主进程再用 merge() 合并到自己的缓冲区；事件保留原进程号，
+时间戳来自系统范围的单调时钟，可以与主进程的事件对齐。
+"""
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+# 默认保留的最近事件数，更早的事件被丢弃
+DEFAULT_MAX_EVENTS = 100000
+
+_lock = threading.Lock()
+_events = deque(maxlen=DEFAULT_MAX_EVENTS)
+_enabled = False
+_track_allocations = False
+# 是否由本模块启动了 tracemalloc（停止追踪时一并关闭）
+_started_tracemalloc = False
+
+# 未启用时复用的空上下文
+_NULL_SPAN = nullcontext()
+
+# 每个线程当前打开的 collect() 列表
+_local = threading.local()
+
+def enable(allocations=False, max_events=None):
+    """
+    启用追踪
+
+    参数:
+        allocations: 是否用 tracemalloc 统计每个区间的内存分配变化（开销较大）
+        max_events: 保留的最近事件数上限，为空时不改变当前上限
+    """
+    global _enabled, _track_allocations, _started_tracemalloc
+    if max_events is not None:
+        set_max_events(max_events)
+    _enabled = True
+    _track_allocations = allocations
+    if allocations and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracemalloc = True
+
+def disable():
+    """
+    停止追踪（已记录的事件保留）
+    """
+    global _enabled, _track_allocations, _started_tracemalloc
+    _enabled = False
+    _track_allocations = False
+    if _started_tracemalloc:
+        tracemalloc.stop()
+        _started_tracemalloc = False
+
+def is_enabled():
+    return _enabled
+
+def set_max_events(max_events):
+    """
+    设置保留的最近事件数上限，超出的旧事件立即丢弃
+    """
+    global _events
+    if max_events < 1:
+        raise ValueError('max_events 必须是正整数')
+    with _lock:
+        _events = deque(_events, maxlen=int(max_events))
+
+def clear():
+    """
+    清除已记录的事件
+    """
+    with _lock:
+        _events.clear()
+
+def events():
+    """
+    返回已记录事件的副本，每个事件为字典：
+    name, start（秒）, wall, cpu（秒）, alloc（字节或None）, pid, tid, args
+    """
+    with _lock:
+        return list(_events)
+
+def merge(recorded):
+    """
+    将其他进程记录的事件（见 collect）加入本进程的缓冲区，同样受 max_events 限制
+    """
+    with _lock:
+        _events.extend(recorded)
+
+@contextmanager
+def collect():
+    """
+    收集当前线程在上下文中记录的事件（同时照常写入缓冲区）
+
+    用法:
+        with collect() as recorded:
+            ...
+        # recorded 为期间结束的区间事件列表
+    """
+    recorded = []
+    collectors = _local.__dict__.setdefault('collectors', [])
+    collectors.append(recorded)
+    try:
+        yield recorded
+    finally:
+        collectors.remove(recorded)
+
+class _Span:
+    __slots__ = ('name', 'args', 'start', 'cpu_start', 'alloc_start')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.alloc_start = tracemalloc.get_traced_memory()[0] if _track_allocations else None
+        self.cpu_start = time.thread_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self.start
+        cpu = time.thread_time() - self.cpu_start
+        alloc = None
+        if self.alloc_start is not None and tracemalloc.is_tracing():
+            alloc = tracemalloc.get_traced_memory()[0] - self.alloc_start
+        event = {
+            'name': self.name,
+            'start': self.start,
+            'wall': wall,
+            'cpu': cpu,
+            'alloc': alloc,
+            'pid': os.getpid(),
+            'tid': threading.get_ident(),
+            'args': self.args,
+        }
+        with _lock:
+            _events.append(event)
+        for recorded in getattr(_local, 'collectors', ()):
+            recorded.append(event)
+        return False
+
+def span(name, **args):
+    """
+    标记一个计时区间，用作上下文管理器
+
+    参数:
+        name: 区间名称，同名区间在汇总表中合并
+        **args: 附加到 Chrome trace 事件上的参数
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+def traced(name):
+    """
+    将整个函数调用标记为一个计时区间的装饰器
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Span(name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def chrome_trace(recorded=None):
+    """
+    将事件转换为 Chrome trace 格式的字典
+
+    参数:
+        recorded: 事件列表，为空时使用全部已记录事件
+    """
+    recorded = events() if recorded is None else recorded
+    trace_events = []
+    for event in recorded:
+        args = dict(event['args'], cpu_ms=round(event['cpu'] * 1e3, 3))
+        if event['alloc'] is not None:
+            args['alloc_kb'] = round(event['alloc'] / 1024, 1)
+        trace_events.append({
+            'name': event['name'],
+            'cat': 'ranmap',
+            'ph': 'X',
+            'ts': event['start'] * 1e6,
+            'dur': event['wall'] * 1e6,
+            'pid': event['pid'],
+            'tid': event['tid'],
+            'args': args,
+        })
+    return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+def export_chrome_trace(filename, recorded=None):
+    """
+    将事件写入 Chrome trace JSON 文件
+    """
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump(chrome_trace(recorded), f)
+
+def summary(recorded=None):
+    """
+    按区间名称汇总的文本表格：调用次数、总墙钟时间、平均时间、CPU时间和内存分配
+
+    注意嵌套区间的时间会同时计入外层区间。
+    """
+    recorded = events() if recorded is None else recorded
+    totals = {}
+    for event in recorded:
+        entry = totals.setdefault(event['name'], [0, 0.0, 0.0, None])
+        entry[0] += 1
+        entry[1] += event['wall']
+        entry[2] += event['cpu']
+        if event['alloc'] is not None:
+            entry[3] = (entry[3] or 0) + event['alloc']
+
+    header = f"{'span':<28}{'count':>7}{'wall ms':>12}{'mean ms':>10}{'cpu ms':>12}{'alloc KB':>12}"
+    lines = [header, '-' * len(header)]
+    for name, (count, wall, cpu, alloc) in sorted(totals.items(), key=lambda item: -item[1][1]):
+        alloc_text = '-' if alloc is None else f"{alloc / 1024:.1f}"
+        lines.append(f"{name:<28}{count:>7}{wall * 1e3:>12.2f}{wall * 1e3 / count:>10.2f}"
+                     f"{cpu * 1e3:>12.2f}{alloc_text:>12}")
+    return '\n'.join(lines)
+
+# 按环境变量初始化
+_max_events = os.environ.get('RANMAP_TRACE_MAX_EVENTS', '').strip()
+if _max_events:
+    set_max_events(int(_max_events))
+_mode = os.environ.get('RANMAP_TRACE', '').strip().lower()
+if _mode in ('1', 'true', 'yes', 'on'):
+    enable()
+elif _mode == 'alloc':
+    enable(allocations=True)
@@ -0,0 +1,10 @@
+import os
+import sys
+
+import matplotlib
+
+# 测试中不打开任何窗口
+matplotlib.use('Agg')
+
+# 模块位于仓库根目录
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,245 @@
+"""
+ranmap_encode 编码器的往返测试：用按规范逐字节实现的解码器解码，与原图比较
+"""
+import struct
+import zlib
+
+import numpy as np
+import pytest
+
+import ranmap_encode
+
+def _random_image(seed, h=13, w=17):
+    return np.random.default_rng(seed).integers(0, 256, (h, w, 3), dtype=np.uint8)
+
+def _smooth_image(h=24, w=31):
+    # 相邻像素差值小，覆盖QOI的DIFF/LUMA和PNG过滤后的小残差
+    y, x = np.mgrid[:h, :w]
+    return np.stack([x * 3, y * 5, (x + y) * 2], axis=-1).astype(np.uint8)
+
+def _few_colors_image(seed, h=20, w=20):
+    palette = np.array([[0, 0, 0], [255, 0, 0], [12, 200, 40], [90, 90, 255]], dtype=np.uint8)
+    return palette[np.random.default_rng(seed).integers(0, len(palette), (h, w))]
+
+def _chunks(data):
+    assert data[:8] == b'\x89PNG\r\n\x1a\n'
+    position = 8
+    while position < len(data):
+        length, = struct.unpack('>I', data[position:position + 4])
+        chunk_type = data[position + 4:position + 8]
+        body = data[position + 8:position + 8 + length]
+        crc, = struct.unpack('>I', data[position + 8 + length:position + 12 + length])
+        assert crc == zlib.crc32(chunk_type + body) & 0xFFFFFFFF
+        yield chunk_type, body
+        position += 12 + length
+
+def _paeth(a, b, c):
+    p = a + b - c
+    pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    return b if pb <= pc else c
+
+def _decode_png(data):
+    """
+    按PNG规范解码8位真彩色或调色板PNG，返回 (像素数组, 调色板, 各行过滤类型)
+    """
+    chunks = list(_chunks(data))
+    assert chunks[0][0] == b'IHDR' and chunks[-1][0] == b'IEND'
+    w, h, depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', chunks[0][1])
+    assert depth == 8 and interlace == 0
+    bpp = {2: 3, 3: 1}[color_type]
+    palette = None
+    for chunk_type, body in chunks:
+        if chunk_type == b'PLTE':
+            palette = np.frombuffer(body, dtype=np.uint8).reshape(-1, 3)
+    raw = zlib.decompress(b''.join(body for chunk_type, body in chunks if chunk_type == b'IDAT'))
+    stride = w * bpp
+    assert len(raw) == h * (stride + 1)
+    rows, kinds = [], []
+    previous = [0] * stride
+    for y in range(h):
+        line = raw[y * (stride + 1):(y + 1) * (stride + 1)]
+        kind, filtered = line[0], line[1:]
+        row = [0] * stride
+        for i in range(stride):
+            a = row[i - bpp] if i >= bpp else 0
+            b = previous[i]
+            c = previous[i - bpp] if i >= bpp else 0
+            predicted = (0, a, b, (a + b) >> 1, _paeth(a, b, c))[kind]
+            row[i] = (filtered[i] + predicted) & 0xFF
+        rows.append(row)
+        kinds.append(kind)
+        previous = row
+    pixels = np.array(rows, dtype=np.uint8).reshape(h, w, bpp)
+    if color_type == 3:
+        pixels = pixels[..., 0]
+    return pixels, palette, kinds
+
+def _qoi_hash(r, g, b, a):
+    return (r * 3 + g * 5 + b * 7 + a * 11) % 64
+
+def _decode_qoi(data):
+    """
+    按QOI规范逐字节解码，返回形状为 (h, w, 3) 的数组
+    """
+    assert data[:4] == b'qoif'
+    w, h, channels, _ = struct.unpack('>IIBB', data[4:14])
+    assert channels == 3
+    assert data[-8:] == b'\x00' * 7 + b'\x01'
+    index = [(0, 0, 0, 0)] * 64
+    px = (0, 0, 0, 255)
+    pixels = []
+    position = 14
+    end = len(data) - 8
+    while len(pixels) < w * h:
+        b1 = data[position]
+        position += 1
+        run = 1
+        if b1 == 0xFE:
+            px = tuple(data[position:position + 3]) + (px[3],)
+            position += 3
+        elif b1 >> 6 == 0:
+            px = index[b1]
+        elif b1 >> 6 == 1:
+            px = ((px[0] + (b1 >> 4 & 3) - 2) & 0xFF, (px[1] + (b1 >> 2 & 3) - 2) & 0xFF,
+                  (px[2] + (b1 & 3) - 2) & 0xFF, px[3])
+        elif b1 >> 6 == 2:
+            b2 = data[position]
+            position += 1
+            dg = (b1 & 0x3F) - 32
+            px = ((px[0] + dg + (b2 >> 4) - 8) & 0xFF, (px[1] + dg) & 0xFF,
+                  (px[2] + dg + (b2 & 0x0F) - 8) & 0xFF, px[3])
+        else:
+            run = (b1 & 0x3F) + 1
+            assert run <= 62, '游程字节不能与RGB/RGBA操作码冲突'
+        index[_qoi_hash(*px)] = px
+        pixels.extend([px[:3]] * run)
+    assert position == end, 'QOI数据在像素之后有多余的字节'
+    assert len(pixels) == w * h, '游程超出图像末尾'
+    return np.array(pixels, dtype=np.uint8).reshape(h, w, 3)
+
+@pytest.mark.parametrize('method', ranmap_encode.PNG_FILTERS)
+@pytest.mark.parametrize('bpp', [1, 3])
+def test_filter_rows_round_trip(method, bpp):
+    rows = _random_image(1).reshape(13, -1) if bpp == 3 else _random_image(1)[..., 0]
+    filtered = ranmap_encode.filter_rows(rows, bpp, method)
+    assert filtered.shape == (rows.shape[0], rows.shape[1] + 1)
+    kinds = set(filtered[:, 0].tolist())
+    if method == 'adaptive':
+        assert kinds <= {0, 1, 2, 3, 4}
+    else:
+        assert kinds == {ranmap_encode.PNG_FILTERS.index(method)}
+    data = zlib.compress(filtered.tobytes())
+    h, stride = rows.shape
+    header = struct.pack('>IIBBBBB', stride // bpp, h, 8, {1: 3, 3: 2}[bpp], 0, 0, 0)
+    png = (b'\x89PNG\r\n\x1a\n' + ranmap_encode._png_chunk(b'IHDR', header) +
+           (ranmap_encode._png_chunk(b'PLTE', bytes(768)) if bpp == 1 else b'') +
+           ranmap_encode._png_chunk(b'IDAT', data) + ranmap_encode._png_chunk(b'IEND', b''))
+    decoded, _, _ = _decode_png(png)
+    np.testing.assert_array_equal(decoded.reshape(h, stride), rows)
+
+def test_filter_rows_rejects_unknown_method():
+    with pytest.raises(ValueError):
+        ranmap_encode.filter_rows(np.zeros((2, 6), dtype=np.uint8), 3, 'median')
+
+@pytest.mark.parametrize('strategy', ranmap_encode.ZLIB_STRATEGIES)
+@pytest.mark.parametrize('method', ranmap_encode.PNG_FILTERS)
+@pytest.mark.parametrize('image', [_random_image(2), _smooth_image(), _few_colors_image(3)],
+                         ids=['random', 'smooth', 'few_colors'])
+def test_encode_png_round_trip(image, method, strategy):
+    data = ranmap_encode.encode_png(image, png_filter=method, strategy=strategy)
+    decoded, palette, _ = _decode_png(data)
+    assert palette is None
+    np.testing.assert_array_equal(decoded, image)
+
+@pytest.mark.parametrize('method', ranmap_encode.PNG_FILTERS)
+@pytest.mark.parametrize('image', [_few_colors_image(4), _smooth_image() // 32 * 32],
+                         ids=['few_colors', 'banded'])
+def test_encode_png_indexed_round_trip(image, method):
+    indices, palette = ranmap_encode.to_indexed(image)
+    data = ranmap_encode.encode_png_indexed(indices, palette, png_filter=method)
+    decoded, decoded_palette, _ = _decode_png(data)
+    np.testing.assert_array_equal(decoded, indices)
+    np.testing.assert_array_equal(decoded_palette[decoded], image)
+
+def test_encode_png_indexed_uses_full_palette():
+    palette = np.random.default_rng(5).integers(0, 256, (256, 3), dtype=np.uint8)
+    indices = np.arange(256, dtype=np.uint8).reshape(16, 16)
+    decoded, decoded_palette, _ = _decode_png(ranmap_encode.encode_png_indexed(indices, palette))
+    np.testing.assert_array_equal(decoded, indices)
+    np.testing.assert_array_equal(decoded_palette, palette)
+    with pytest.raises(ValueError):
+        ranmap_encode.encode_png_indexed(indices, np.zeros((257, 3), dtype=np.uint8))
+
+def test_png8_output_matches_pillow():
+    Image = pytest.importorskip('PIL.Image')
+    import io
+    image = _few_colors_image(6)
+    for format in ('png', 'png8'):
+        data = ranmap_encode.encode_image(image, format)
+        decoded = np.asarray(Image.open(io.BytesIO(data)).convert('RGB'))
+        np.testing.assert_array_equal(decoded, image)
+
+def _qoi_cases():
+    red = np.array([255, 0, 0], dtype=np.uint8)
+    # 开头与初始的“上一个像素”（黑色）相同的游程，长度跨过62的倍数
+    leading_black = np.zeros((5, 40, 3), dtype=np.uint8)
+    leading_black[3, 7:] = red
+    leading_black[4, 20] = [1, 2, 3]
+    # 图像中间和末尾长度超过62的游程，以及恰好62、63、124的游程
+    runs = np.concatenate([np.full((n, 3), color, dtype=np.uint8) for n, color in
+                           [(1, [9, 9, 9]), (62, red), (63, [0, 255, 0]), (124, [0, 0, 0]),
+                            (1, [7, 8, 9]), (200, [10, 20, 30])]])
+    return {
+        'single_black': np.zeros((1, 1, 3), dtype=np.uint8),
+        'all_black': np.zeros((9, 30, 3), dtype=np.uint8),
+        'leading_black': leading_black,
+        'long_runs': runs.reshape(1, -1, 3),
+        'random': _random_image(7, 19, 23),
+        'smooth': _smooth_image(),
+        'few_colors': _few_colors_image(8),
+    }
+
+def _encode_qoi_reference(image):
+    """
+    逐像素的QOI参考编码器（与规范中的参考实现相同）
+    """
+    h, w = image.shape[:2]
+    out = bytearray(b'qoif' + struct.pack('>IIBB', w, h, 3, 0))
+    index = [None] * 64
+    previous = (0, 0, 0)
+    run = 0
+    pixels = [tuple(int(v) for v in px) for px in image.reshape(-1, 3)]
+    for i, px in enumerate(pixels):
+        if px == previous:
+            run += 1
+            if run == 62 or i == len(pixels) - 1:
+                out.append(0xC0 | (run - 1))
+                run = 0
+            continue
+        if run:
+            out.append(0xC0 | (run - 1))
+            run = 0
+        slot = _qoi_hash(*px, 255)
+        if index[slot] == px:
+            out.append(slot)
+        else:
+            index[slot] = px
+            dr, dg, db = ((px[c] - previous[c] + 128) % 256 - 128 for c in range(3))
+            if -2 <= dr <= 1 and -2 <= dg <= 1 and -2 <= db <= 1:
+                out.append(0x40 | (dr + 2) << 4 | (dg + 2) << 2 | (db + 2))
+            elif -32 <= dg <= 31 and -8 <= dr - dg <= 7 and -8 <= db - dg <= 7:
+                out += bytes((0x80 | (dg + 32), (dr - dg + 8) << 4 | (db - dg + 8)))
+            else:
+                out += bytes((0xFE,) + px)
+        previous = px
+    return bytes(out) + b'\x00' * 7 + b'\x01'
+
+@pytest.mark.parametrize('name', list(_qoi_cases()))
+def test_encode_qoi_round_trip(name):
+    image = _qoi_cases()[name]
+    data = ranmap_encode.encode_qoi(image)
+    np.testing.assert_array_equal(_decode_qoi(data), image)
+    # 向量化编码与逐像素参考实现逐字节一致
+    assert data == _encode_qoi_reference(image)
@@ -0,0 +1,67 @@
+"""
+分阶段流水线的测试：与 mapMapGenerator 一致、阶段复用和按字节限制的缓存
+"""
+import numpy as np
+import pytest
+
+import ranmap
+import ranmap_batch
+from ranmap_pipeline import MapPipeline
+
+@pytest.mark.parametrize('renderer', ranmap.RENDERERS)
+def test_pipeline_matches_generator(renderer):
+    generator = ranmap.mapMapGenerator(seed=7, resolution=60, renderer=renderer,
+                                       pipeline=MapPipeline(max_bytes=0))
+    expected = generator.render_png()[0]
+    assert MapPipeline().run(seed=7, resolution=60, renderer=renderer)['png'] == expected
+    # 批量生成和服务器工作进程使用同一条路径
+    assert ranmap_batch.generate_one(7, {'resolution': 60, 'renderer': renderer})['png'] == expected
+
+def test_pipeline_matches_monolithic_elevation():
+    rng = np.random.default_rng(11)
+    points = ranmap.generate_complex_map(rng=rng)
+    X, Y, Z = ranmap.generate_elevation_data(points, [], 100, 100, resolution=70, rng=rng)
+    result = MapPipeline().run(seed=11, until='elevation', resolution=70)
+    np.testing.assert_array_equal(result['Z'], Z)
+
+def test_render_change_reuses_elevation():
+    pipeline = MapPipeline()
+    first = pipeline.run(seed=3, resolution=50, renderer='raster', size=128)
+    second = pipeline.run(seed=3, resolution=50, renderer='matplotlib', dpi=40)
+    assert pipeline.hits['elevation'] == 1 and pipeline.misses['elevation'] == 1
+    assert pipeline.misses['render'] == 2
+    assert second['Z'] is first['Z']
+    assert second['png'] != first['png']
+
+def test_coastline_change_reuses_noise():
+    pipeline = MapPipeline()
+    first = pipeline.run(seed=5, until='elevation', resolution=50)
+    second = pipeline.run(seed=5, until='elevation', resolution=50, coastline_spectrum=(0.2, 2.0))
+    assert pipeline.hits['noise'] == 1
+    assert pipeline.misses['coastline'] == 2 and pipeline.misses['elevation'] == 2
+    assert second['noise'] is first['noise']
+    assert not np.array_equal(second['points'], first['points'])
+
+def test_generator_reuses_its_pipeline():
+    generator = ranmap.mapMapGenerator(seed=5, resolution=50, renderer='raster')
+    generator.render_png(size=64)
+    generator.render_png(size=128)
+    assert generator.pipeline.hits['elevation'] == 1
+
+def test_cache_is_bounded_by_bytes():
+    pipeline = MapPipeline(max_bytes=1 << 20)
+    for seed in range(6):
+        pipeline.run(seed=seed, until='elevation', resolution=100)
+    stats = pipeline.stats()
+    assert 0 < stats['bytes'] <= 1 << 20
+    # 单个放不下的高程不缓存，直接使用生成上下文的工作区
+    result = pipeline.run(seed=0, until='elevation', resolution=300)
+    assert pipeline.stats()['bytes'] <= 1 << 20
+    assert result['Z'] is ranmap.get_context(100, 100, 300).Z
+
+def test_uncached_pipeline_keeps_nothing():
+    pipeline = MapPipeline(max_bytes=0)
+    pipeline.run(seed=1, resolution=40)
+    pipeline.run(seed=1, resolution=40)
+    assert pipeline.stats()['entries'] == 0
+    assert pipeline.hits['render'] == 0
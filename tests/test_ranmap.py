@@ -0,0 +1,98 @@
+"""
+ranmap 地形生成的回归测试
+"""
+import numpy as np
+import pytest
+
+import ranmap
+import ranmap_noise
+
+def test_context_cache_is_bounded():
+    ranmap.clear_contexts()
+    for resolution in range(20, 80, 10):
+        ranmap.get_context(100, 100, resolution)
+    contexts = ranmap._context_cache.contexts
+    assert len(contexts) == ranmap.MAX_CACHED_CONTEXTS
+    # 最近使用的上下文被保留并复用
+    assert [key[2] for key in contexts] == [60, 70]
+    context = ranmap.get_context(100, 100, 60)
+    assert context is ranmap.get_context(100, 100, 60)
+    assert list(contexts)[-1][2] == 60
+    ranmap.clear_contexts()
+    assert len(contexts) == 0
+
+def test_generation_does_not_depend_on_cached_context():
+    generator = ranmap.mapMapGenerator(seed=7, resolution=50, renderer='raster')
+    expected = generator.render_png()[0]
+    # 在其他分辨率生成若干次，使原来的上下文被淘汰
+    for resolution in (30, 40, 60):
+        ranmap.mapMapGenerator(seed=7, resolution=resolution, renderer='raster').render_png()
+    assert generator.render_png()[0] == expected
+    ranmap.clear_contexts()
+    assert generator.render_png()[0] == expected
+
+def _coastlines(seed):
+    rng = np.random.default_rng(seed)
+    points = ranmap.generate_complex_map(100, 100, 80, rng=rng)
+    return points, ranmap.generate_small_maps(points, 100, 100), rng
+
+@pytest.mark.parametrize('dtype', ['float64', 'float32'])
+@pytest.mark.parametrize('transition_width', [ranmap.TRANSITION_WIDTH, 5.0])
+def test_tiled_elevation_matches_monolithic(dtype, transition_width, tmp_path):
+    points, small_maps, _ = _coastlines(3)
+    context = ranmap.GeneratorContext(100, 100, 300, dtype)
+    _, _, expected = ranmap.generate_elevation_data(points, small_maps, 100, 100, resolution=300,
+                                                    rng=11, context=context,
+                                                    transition_width=transition_width)
+    x, y, Z = ranmap.generate_elevation_data_tiled(points, small_maps, 100, 100, resolution=300,
+                                                   tile_size=64, filename=str(tmp_path / 'z.npy'),
+                                                   rng=11, dtype=dtype,
+                                                   transition_width=transition_width)
+    assert Z.dtype == np.dtype(dtype)
+    np.testing.assert_array_equal(x, context.x)
+    np.testing.assert_array_equal(y, context.y)
+    # 逐位一致，而不只是近似
+    np.testing.assert_array_equal(Z, expected)
+
+def test_exact_distance_matches_brute_force():
+    points, _, rng = _coastlines(5)
+    boundary = np.asarray(points, dtype=float)
+    start, end = boundary, np.roll(boundary, -1, axis=0)
+    keep = np.hypot(*(end - start).T) > 0
+    start, end = start[keep], end[keep]
+
+    def brute_force(query):
+        px, py = query[:, :1], query[:, 1:]
+        return ranmap._segment_distance(px, py, start[:, 0], start[:, 1],
+                                        end[:, 0], end[:, 1]).min(axis=1)
+
+    # 散点（包括远离海岸和网格范围之外的点）与网格两种查询
+    query = rng.uniform(-50, 150, (2000, 2))
+    np.testing.assert_allclose(ranmap.distance_to_coast(points, query, signed=False),
+                               brute_force(query), rtol=1e-12, atol=1e-12)
+    x = np.linspace(0, 100, 90)
+    y = np.linspace(0, 100, 70)
+    X, Y = np.meshgrid(x, y)
+    expected = brute_force(np.column_stack((X.ravel(), Y.ravel()))).reshape(X.shape)
+    signed = ranmap.distance_to_coast(points, (x, y))
+    np.testing.assert_allclose(np.abs(signed), expected, rtol=1e-12, atol=1e-12)
+    # 符号与栅格化的陆地掩码一致
+    mask = ranmap.rasterize_polygon(boundary, x, y)
+    assert ((signed > 0) == mask)[expected > 1e-9].all()
+    # 截断距离只改变超过上限的点
+    capped = ranmap.distance_to_coast(points, query, signed=False, max_distance=5.0)
+    np.testing.assert_allclose(capped, np.minimum(brute_force(query), 5.0), rtol=1e-12, atol=1e-12)
+
+@pytest.mark.parametrize('shape', [(64, 64), (37, 90)])
+def test_spectral_noise_matches_gaussian(shape):
+    octaves = ((1.5, 0.5), (4.0, 0.3), (12.0, 0.2))
+    spectral = ranmap_noise.fractal_noise(shape, octaves, np.random.default_rng(2), 'spectral')
+    gaussian = ranmap_noise.fractal_noise(shape, octaves, np.random.default_rng(2), 'gaussian')
+    np.testing.assert_allclose(spectral, gaussian, rtol=0, atol=1e-10 * np.abs(gaussian).max())
+
+def test_spectral_elevation_matches_gaussian():
+    points, small_maps, _ = _coastlines(9)
+    elevations = [ranmap.generate_elevation_data(points, small_maps, 100, 100, resolution=120,
+                                                 rng=4, noise_mode=mode)[2]
+                  for mode in ('spectral', 'gaussian')]
+    np.testing.assert_allclose(*elevations, rtol=0, atol=1e-9)
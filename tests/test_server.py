@@ -0,0 +1,102 @@
+"""
+地图服务器的端到端测试：在后台线程中启动服务器，通过套接字发送请求
+"""
+import socket
+import threading
+import time
+
+import pytest
+
+import ranmap_protocol
+from ranmap_client import MapConnection
+from ranmap_server import RandomMapServer
+
+# 足够慢、在客户端断开时仍在排队或运行的生成
+SLOW_REQUEST = {'command': 'generate', 'seed': 12345, 'resolution': 1000}
+
+@pytest.fixture
+def server():
+    server = RandomMapServer(port=0, workers=1, reservoir_depth=0)
+    thread = threading.Thread(target=server.start, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10
+    # 等待启动时预生成的第一张地图完成，使测试中的生成立即开始运行
+    while not (server.running and server._pregenerate is not None and server._pregenerate.done()):
+        assert thread.is_alive() and time.monotonic() < deadline, '服务器启动失败'
+        time.sleep(0.01)
+    yield server
+    server.stop()
+    thread.join(10)
+
+def _connect(server):
+    sock = socket.create_connection(('localhost', server.server_socket.getsockname()[1]), 5)
+    sock.settimeout(30)
+    return sock
+
+def _stats(server):
+    with _connect(server) as sock:
+        response, _ = ranmap_protocol.request(sock, {'command': 'stats'})
+    return response
+
+def _wait_cancelled(server, count=1, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = _stats(server)
+        if stats['scheduler']['cancelled'] >= count:
+            return stats
+        time.sleep(0.1)
+    pytest.fail(f"生成没有被取消: {stats['scheduler']}")
+
+def test_closed_connection_cancels_generation(server):
+    completed = _stats(server)['scheduler']['completed']
+    sock = _connect(server)
+    ranmap_protocol.send_frame(sock, SLOW_REQUEST)
+    time.sleep(0.2)
+    sock.close()
+    stats = _wait_cancelled(server)
+    assert stats['scheduler']['completed'] == completed
+
+def test_map_connection_close_cancels_pipelined_generation(server):
+    connection = MapConnection('localhost', server.server_socket.getsockname()[1])
+    future = connection.submit(SLOW_REQUEST)
+    time.sleep(0.2)
+    connection.close()
+    with pytest.raises(ConnectionError):
+        future.result(5)
+    _wait_cancelled(server)
+
+def test_half_close_is_answered_when_requested(server):
+    with _connect(server) as sock:
+        ranmap_protocol.send_frame(sock, {'command': 'generate', 'seed': 7, 'resolution': 40,
+                                          'renderer': 'raster', 'half_close': True})
+        sock.shutdown(socket.SHUT_WR)
+        response, payload = ranmap_protocol.recv_frame(sock)
+    assert response['status'] == 'success'
+    assert response['seed'] == 7
+    assert payload.startswith(b'\x89PNG')
+    assert _stats(server)['scheduler']['cancelled'] == 0
+
+@pytest.mark.parametrize('resolution', [1, 0, -5, 2.5, 'abc', True])
+def test_invalid_resolution_is_rejected_before_generating(server, resolution):
+    with _connect(server) as sock:
+        response, _ = ranmap_protocol.request(sock, {'command': 'generate', 'seed': 1,
+                                                     'resolution': resolution})
+    assert response['status'] == 'error'
+    assert '分辨率' in response['message']
+    assert _stats(server)['scheduler']['submitted'] == 1  # 只有启动时的预生成
+
+def test_save_image_only_saves_the_requested_seed(server, tmp_path):
+    with _connect(server) as sock:
+        response, payload = ranmap_protocol.request(sock, {'command': 'generate', 'seed': 7,
+                                                           'resolution': 40, 'renderer': 'raster'})
+        assert response['seed'] == 7
+        stale = tmp_path / 'stale.png'
+        response, _ = ranmap_protocol.request(sock, {'command': 'save_image', 'seed': 8,
+                                                     'filename': str(stale)})
+        assert response['status'] == 'error'
+        assert not stale.exists()
+        saved = tmp_path / 'saved.png'
+        response, _ = ranmap_protocol.request(sock, {'command': 'save_image', 'seed': 7,
+                                                     'filename': str(saved)})
+    assert response['status'] == 'success'
+    assert saved.read_bytes() == payload
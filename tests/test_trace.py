@@ -0,0 +1,39 @@
+"""
+追踪事件的收集与跨进程合并
+"""
+import os
+
+import pytest
+
+import ranmap_batch
+import ranmap_trace
+
+@pytest.fixture
+def tracing():
+    was_enabled = ranmap_trace.is_enabled()
+    ranmap_trace.enable()
+    ranmap_trace.clear()
+    yield
+    ranmap_trace.clear()
+    if not was_enabled:
+        ranmap_trace.disable()
+
+def test_collect_captures_spans_of_the_block(tracing):
+    with ranmap_trace.span('outside'):
+        pass
+    with ranmap_trace.collect() as recorded:
+        with ranmap_trace.span('inside'):
+            pass
+    assert [event['name'] for event in recorded] == ['inside']
+    assert [event['name'] for event in ranmap_trace.events()] == ['outside', 'inside']
+
+def test_generate_one_returns_trace_for_merging(tracing):
+    result = ranmap_batch.generate_one(3, {'resolution': 40, 'renderer': 'raster'},
+                                       ('png', 'trace'))
+    names = {event['name'] for event in result['trace']}
+    assert {'coastline', 'elevation', 'raster'} <= names
+    # 模拟主进程合并工作进程的事件
+    ranmap_trace.clear()
+    ranmap_trace.merge(result['trace'])
+    assert len(ranmap_trace.events()) == len(result['trace'])
+    assert {event['pid'] for event in ranmap_trace.events()} == {os.getpid()}